@@ -0,0 +1,65 @@
+import optparse
+import os
+import sys
+import time
+from pathlib import Path
+import pandas as pd
+
+# assume script is run from project root => path to be able to import src
+sys.path.append(str(Path.cwd()))
+sys.path.append(str(Path.cwd() / "src"))
+
+from preprocessing.remove_commentary import remove_commentary
+from src.constants import PATH_TRANSLATED_DATA
+
+"""
+Measures how remove_commentary (find_commentary_spans + remove_commentary_spans) scales with the number of worker processes.
+Runs on the first n speeches of the translated dataset and checks that every worker count gives the same text.
+"""
+
+def benchmark(df: pd.DataFrame, worker_counts: list[int], repeats: int = 3) -> pd.DataFrame:
+    results = []
+    reference = None
+    for n_workers in worker_counts:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            cleaned = remove_commentary(df.copy(), n_workers=n_workers)
+            times.append(time.perf_counter() - start)
+
+        if reference is None:
+            reference = cleaned
+        assert cleaned["translatedText"].equals(reference["translatedText"]), f"Different output with {n_workers} workers"
+        results.append({"n_workers": n_workers, "seconds": min(times)})
+
+    results = pd.DataFrame(results)
+    results["speedup"] = results["seconds"].iloc[0] / results["seconds"]
+    results["efficiency"] = results["speedup"] / results["n_workers"]
+    return results
+
+
+if __name__ == "__main__":
+    optParser = optparse.OptionParser()
+    optParser.add_option('-n', '--n_rows', action='store', type='int',
+                         default=100000, dest='n_rows',
+                         help='Number of speeches to clean in each run')
+    optParser.add_option('-r', '--repeats', action='store', type='int',
+                         default=3, dest='repeats',
+                         help='Runs per worker count (the fastest one is reported)')
+    optParser.add_option('-o', '--out', action='store',
+                         default=None, dest='out',
+                         help='Optional csv file to write the results to')
+    opts, _ = optParser.parse_args()
+
+    df = pd.read_parquet(PATH_TRANSLATED_DATA, columns=["translatedText"])
+    df = df[~df["translatedText"].isna()].head(opts.n_rows)
+    print(f"Benchmarking on {len(df)} speeches ({df['translatedText'].str.len().sum() / 1e6:.1f}M characters)")
+
+    # powers of two up to the number of cores, and all cores
+    n_cores = os.cpu_count() or 1
+    worker_counts = sorted({2 ** i for i in range(n_cores.bit_length()) if 2 ** i <= n_cores} | {n_cores})
+
+    results = benchmark(df, worker_counts, opts.repeats)
+    print(results.to_string(index=False))
+    if opts.out:
+        results.to_csv(opts.out, index=False)
@@ -0,0 +1,107 @@
+import optparse
+import random
+import sys
+from collections import Counter
+from pathlib import Path
+import pandas as pd
+
+# assume script is run from project root => path to be able to import src
+sys.path.append(str(Path.cwd()))
+sys.path.append(str(Path.cwd() / "src"))
+
+from preprocessing.remove_commentary import RULES, comments_from_spans, find_commentary_spans, identify_removable_parts, remove_commentary_spans, remove_from_text
+from src.constants import PATH_TRANSLATED_DATA
+
+"""
+Checks that remove_commentary_spans (cutting the comments out at their spans) gives the same text as remove_from_text
+(replacing every removable comment in the order of RULES) on random texts that hit the cases in which it falls back
+to remove_from_text, and optionally on the first speeches of the translated dataset.
+"""
+
+WORDS = ["the", "parliament", "we", "need", "migration", "policy", "europe", "must", "act", "now", "mr", "president", "vote", "rule"]
+# removable (when repeated) and kept comments
+COMMENTS = ["Applause", "The sitting was closed", "speaker", "The speaker agreed", "mic off", "Microphone switched off",
+            "end of speech", "Parliament approved the request", "loud protests from the left", "rule 149", "a b",
+            "The President cut off the speaker", "this is part of the debate and stays", "Article 7", "explanation of vote"]
+
+
+def random_comment(rng: random.Random, cases: Counter) -> str:
+    comment = rng.choice(COMMENTS)
+    if rng.random() < 0.15:
+        # brackets inside the comment, e.g. nested comments
+        inner = random_comment(rng, cases)
+        comment = f"{comment} {rng.choice(['(', '['])}{inner}{rng.choice([')', ']'])}"
+        cases["brackets in comment"] += 1
+    return comment
+
+
+def random_text(rng: random.Random, cases: Counter) -> str:
+    pieces = []
+    for _ in range(rng.randint(0, 12)):
+        kind = rng.random()
+        if kind < 0.55:
+            pieces.append(" ".join(rng.choices(WORDS, k=rng.randint(1, 6))))
+        elif kind < 0.9:
+            opening, closing = rng.choice([("(", ")"), ("[", "]")])
+            pieces.append(f"{opening}{random_comment(rng, cases)}{closing}")
+        elif kind < 0.95:
+            # () and [] pairs that overlap, each type is matched on its own
+            first, second = rng.sample(COMMENTS, 2)
+            pieces.append(f"({first} [{second}) {rng.choice(WORDS)}]")
+            cases["overlapping () and []"] += 1
+        else:
+            # unbalanced brackets
+            pieces.append(rng.choice(["(", ")", "[", "]"]) + rng.choice(WORDS))
+            cases["unbalanced"] += 1
+    if rng.random() < 0.1 and pieces:
+        # the same comment again, so splicing only some occurrences could differ
+        pieces.append(pieces[rng.randrange(len(pieces))])
+        cases["repeated piece"] += 1
+    return rng.choice(["", " ", "  "]).join(pieces) + rng.choice(["", " ", "\n"])
+
+
+def compare(texts: list[str]) -> list[int]:
+    """
+    Positions of the texts for which remove_commentary_spans differs from remove_from_text, which was only called for
+    the speeches with removable comments (the others were left as they are)
+    """
+    spans = [find_commentary_spans(text) for text in texts]
+    counts = Counter(comment for text, s in zip(texts, spans) for comment in comments_from_spans(text, s))
+    removable = identify_removable_parts(counts)
+    mismatches = []
+    for i, (text, s) in enumerate(zip(texts, spans)):
+        comments = comments_from_spans(text, s)
+        to_remove = [comment for rule in RULES for comment in comments if rule in removable.get(comment, ())]
+        expected = remove_from_text(text, to_remove) if to_remove else text
+        if remove_commentary_spans(text, s, removable) != expected:
+            mismatches.append(i)
+    return mismatches
+
+
+if __name__ == "__main__":
+    optParser = optparse.OptionParser()
+    optParser.add_option('-n', '--n_texts', action='store', type='int',
+                         default=4000, dest='n_texts',
+                         help='Number of random texts to compare on')
+    optParser.add_option('-s', '--seed', action='store', type='int',
+                         default=0, dest='seed',
+                         help='Seed of the random texts')
+    optParser.add_option('-d', '--dataset_rows', action='store', type='int',
+                         default=0, dest='dataset_rows',
+                         help='Also compare on the first n speeches of the translated dataset')
+    opts, _ = optParser.parse_args()
+
+    rng, cases = random.Random(opts.seed), Counter()
+    texts = [random_text(rng, cases) for _ in range(opts.n_texts)]
+    print(f"Comparing on {len(texts)} random texts, cases:", dict(cases))
+    mismatches = compare(texts)
+    for i in mismatches[:5]:
+        print("Different text for:", repr(texts[i]))
+    assert not mismatches, f"{len(mismatches)} of {len(texts)} random texts differ"
+
+    if opts.dataset_rows:
+        speeches = pd.read_parquet(PATH_TRANSLATED_DATA, columns=["translatedText"])["translatedText"].dropna().head(opts.dataset_rows).tolist()
+        mismatches = compare(speeches)
+        assert not mismatches, f"{len(mismatches)} of {len(speeches)} speeches differ"
+        print(f"Same text for all {len(speeches)} speeches")
+    print("Same text for all random texts")
@@ -0,0 +1,81 @@
+import optparse
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# assume script is run from project root => path to be able to import src
+sys.path.append(str(Path.cwd()))
+sys.path.append(str(Path.cwd() / "src"))
+
+from preprocessing.segment_sentences import segment_sentences, get_sentence_lists
+from preprocessing.remove_repeating_sentences import boundary_sentence_scores, GREETINGS_PERCENTILE, ENDINGS_PERCENTILE
+from src.constants import PATH_TRANSLATED_DATA
+
+"""
+Agreement report of the TF-IDF backends of remove_repeating_greetings / remove_repeating_endings:
+for the first n speeches of the translated dataset, compares which first/last sentences the "hashed" backend
+removes to the removal masks of the "exact" one, together with the time and peak memory of both.
+"""
+
+# (position, percentile) of remove_repeating_greetings and remove_repeating_endings
+STEPS = {"greetings": (0, GREETINGS_PERCENTILE), "endings": (-1, ENDINGS_PERCENTILE)}
+
+
+def _measure(func, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / 1e6
+
+
+def agreement(exact_mask: np.ndarray, hashed_mask: np.ndarray) -> dict:
+    both = int((exact_mask & hashed_mask).sum())
+    either = int((exact_mask | hashed_mask).sum())
+    return {
+        "removed_exact": int(exact_mask.sum()),
+        "removed_hashed": int(hashed_mask.sum()),
+        "removed_both": both,
+        "jaccard": both / either if either else 1.0,
+        # share of all speeches on which both backends take the same decision
+        "agreement": float((exact_mask == hashed_mask).mean()),
+    }
+
+
+def compare_backends(sentence_list: pd.Series) -> pd.DataFrame:
+    results = []
+    for step, (position, percentile) in STEPS.items():
+        masks, stats = {}, {}
+        for backend in ["exact", "hashed"]:
+            scores, seconds, peak_mb = _measure(boundary_sentence_scores, sentence_list, position, backend=backend)
+            masks[backend] = scores <= np.percentile(scores, percentile)
+            stats.update({f"seconds_{backend}": seconds, f"peak_mb_{backend}": peak_mb})
+        results.append({"step": step, "n_speeches": len(sentence_list), **agreement(masks["exact"], masks["hashed"]), **stats})
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    optParser = optparse.OptionParser()
+    optParser.add_option('-n', '--n_rows', action='store', type='int',
+                         default=100000, dest='n_rows',
+                         help='Number of speeches to score')
+    optParser.add_option('-o', '--out', action='store',
+                         default=None, dest='out',
+                         help='Optional csv file to write the report to')
+    opts, _ = optParser.parse_args()
+
+    df = pd.read_parquet(PATH_TRANSLATED_DATA, columns=["translatedText"])
+    df = df[~df["translatedText"].isna()].head(opts.n_rows)
+    df = segment_sentences(df, "translatedText")
+    df = df[df["translatedText"].str.len() != 0]
+    print(f"Comparing TF-IDF backends on {len(df)} speeches")
+
+    report = compare_backends(get_sentence_lists(df, "translatedText"))
+    print(report.to_string(index=False))
+    if opts.out:
+        report.to_csv(opts.out, index=False)
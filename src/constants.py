@@ -1,6 +1,8 @@
 from tueplots.constants.color import rgb
 
 PATH_RAW_DATA = "data/intermed/speech_output.csv" 
+# PATH_RAW_DATA converted once to parquet, partitioned by period (see src/ingest_raw_data.py)
+PATH_RAW_DATASET = "data/intermed/speech_output"
 PATH_TRANSLATED_DATA = "data/intermed/speech_translated.parquet"
 PATH_DF_TRANSLATION_TEST = "data/translation/df_translation_test.parquet"
 
@@ -15,6 +17,37 @@ PATH_MIGRATION_SPEECHES_EMBEDDED = "data/final/migration_with_embeddings.parquet
 PATH_MIGRATION_SPEECHES_SIMILARITIES = "data/final/migration_with_similarities.parquet"
 PATH_VOCAB_EMBEDDED = "data/final/vocab_embeddings.parquet" # formerly known as VOCAB_EMBEDDGINGS.parquet
 PATH_MODEL = "data/lda/final_model/model.model"
+# inference-only export of PATH_MODEL with memory-mapped arrays (see src/lda/lda_artifact.py)
+PATH_LDA_ARTIFACT = "data/lda/final_model/artifact"
+# versions of the final model updated online with ingested speeches (see src/lda/update_lda_model.py)
+PATH_LDA_VERSIONS = "data/lda/final_model/versions"
+# lemmas of the speeches for LDA, one JSON line per speech keyed by speech id (written by src/lda/create_lda_models.py)
+PATH_PREPROCESSED = "data/lda/preprocessed_texts_all_translated.jsonl"
+# the same lemmas as memory-mapped token ids, in the order of the LDA corpus (see src/lda/token_store.py)
+PATH_TOKEN_STORE = "data/lda/tokens"
+# document frequencies of the token store, to try thresholds of the dictionary (see src/lda/dictionary_profile.py)
+PATH_DF_PROFILE = "data/lda/df_profile"
+# speech ids of the documents of the LDA corpus, in the order of the corpus (written by src/lda/create_lda_models.py)
+PATH_CORPUS_IDS = "data/lda/corpus_final_ids.parquet"
+# the LDA corpus as memory-mapped CSR arrays keyed by speech id (see src/lda/corpus_store.py)
+PATH_CORPUS_STORE = "data/lda/corpus_store"
+# topic probabilities of the speeches, one file per final LDA model, keyed by speech id
+PATH_TOPIC_CACHE = "data/lda/topics"
+# embeddings of the speeches, one file per embedding model, keyed by speech id
+PATH_EMBEDDING_CACHE = "data/cache/embeddings"
+
+# outputs of single preprocessing steps, keyed by the hash of their input and code (see src/stage_cache.py)
+PATH_STAGE_CACHE = "data/cache/stages"
+# intermediate chunks of the out-of-core preprocessing (see src/preprocess_streaming.py)
+PATH_STREAMING_SPILL = "data/cache/streaming"
+# clusters of near-duplicate speeches found by find_near_duplicate_speeches (preprocess_data.py --near_duplicates)
+PATH_DUPLICATE_CLUSTERS = "data/intermed/duplicate_clusters.parquet"
+# JSON reports (and optional profiles) of every preprocessing run (see src/instrumentation.py)
+PATH_RUN_REPORTS = "data/reports/runs"
+# state of the preprocessing, LDA and embedding stages frozen for the incremental ingest (see src/ingest_incremental.py)
+PATH_FROZEN_STATE = "data/frozen"
+# partitions of speeches appended by the incremental ingest, one file per run next to the full outputs
+PATH_INCREMENTS = "data/final/increments"
 
 # filepaths for original & intermediate data of CHES prepro/merging pipeline ("preprocessing_checks/pre5_..."")
 PATH_ORIGINAL_CHES_RAW_CSV = "data/original/ches/1999-2024_CHES_dataset_means.csv"
@@ -77,7 +77,7 @@ def principle_component_regression(df: pd.DataFrame, target_var: str = "party",
 def get_weighted_aggregated_embeddings_for_each_year(df: pd.DataFrame, embedding_column: str, aggregate_on: str):
     yearly_data = df.copy()
     yearly_data['year'] = pd.to_datetime(df['date']).dt.year
-    groupped = yearly_data.groupby(by=[aggregate_on, 'year'])
+    groupped = yearly_data.groupby(by=[aggregate_on, 'year'], observed=True)
     aggregated_embeddings = groupped[[embedding_column, 'migration_prob']].apply(lambda row: np.stack(row[embedding_column]).T @ np.stack(row['migration_prob']) / sum(row['migration_prob'])).reset_index()
     aggregated_embeddings.columns = [aggregate_on, 'year', embedding_column]
     return aggregated_embeddings
@@ -87,5 +87,5 @@ def get_weighted_aggregated_embeddings_for_each_year(df: pd.DataFrame, embedding
 def get_aggregated_embeddings_for_each_year(df: pd.DataFrame, embedding_column: str, aggregate_on: str):
     yearly_data = df.copy()
     yearly_data['year'] = pd.to_datetime(df['date']).dt.year
-    aggregated_embeddings = yearly_data.groupby(by=[aggregate_on, 'year'])[embedding_column].agg(lambda emb: np.stack(emb).mean(axis=0) )
+    aggregated_embeddings = yearly_data.groupby(by=[aggregate_on, 'year'], observed=True)[embedding_column].agg(lambda emb: np.stack(emb).mean(axis=0) )
     return aggregated_embeddings.reset_index()
@@ -1,11 +1,41 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
 from transformers import AutoModel
 from sentence_transformers import SentenceTransformer
 import torch 
 
+from src.constants import PATH_EMBEDDING_CACHE
+from src.schema import SPEECH_ID
+
 DEVICE = "cuda" if torch.cuda.is_available() else "mps" if torch.mps.is_available() else "cpu" 
 
 def get_model(model_id, device=DEVICE): 
     return SentenceTransformer(model_id, trust_remote_code=True).to(device)
 
 def embedd_texts(model, texts, task="text-matching", batch_size=32, show_progress_bar=False):
-    return model.encode(texts, task=task, batch_size=batch_size, show_progress_bar=show_progress_bar)
\ No newline at end of file
+    return model.encode(texts, task=task, batch_size=batch_size, show_progress_bar=show_progress_bar)
+
+def _text_hash(text: str) -> str: 
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+def embedd_speeches(model_id, df, text_column="translatedText", cache_dir=PATH_EMBEDDING_CACHE, **kwargs): 
+    """
+    Embeddings of the texts of the speeches in df (one array per row), reusing the ones cached for the same speech id and text.
+    Only the other speeches are embedded (with the model loaded on demand) and added to the cache of the model in cache_dir.
+    """
+    cache_path = os.path.join(cache_dir, f"{model_id.replace('/', '__')}.parquet")
+    cached = pd.read_parquet(cache_path) if os.path.exists(cache_path) else pd.DataFrame({"text_hash": [], "embedding": []}, index=pd.Index([], name=SPEECH_ID))
+    # the embedded text can change (e.g. cleaning) while the original speech and thus its id stays the same
+    requested = pd.DataFrame({"text_hash": [_text_hash(text) for text in df[text_column]]}, index=pd.Index(df[SPEECH_ID], name=SPEECH_ID))
+    hits = cached["text_hash"].reindex(requested.index) == requested["text_hash"]
+    missing = ~hits.to_numpy() & ~requested.index.duplicated()
+    if missing.any(): 
+        embeddings = embedd_texts(get_model(model_id), df[text_column][missing].tolist(), **kwargs)
+        new = pd.DataFrame({"text_hash": requested["text_hash"][missing], "embedding": [np.asarray(x) for x in embeddings]}, index=requested.index[missing])
+        cached = pd.concat([cached[~cached.index.isin(new.index)], new])
+        os.makedirs(cache_dir, exist_ok=True)
+        cached.to_parquet(cache_path)
+    return [np.asarray(x) for x in cached["embedding"].reindex(requested.index)]
@@ -0,0 +1,375 @@
+import json
+import optparse
+import os
+import pickle
+import sys
+from collections import Counter
+from pathlib import Path
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from gensim import corpora
+from gensim.models import LdaMulticore
+
+# assume script is run from project root => path to be able to import src
+sys.path.append(str(Path.cwd()))
+
+from preprocessing import add_party_orientation_year_agenda, keep_relevant_legislation_years, remove_commentary, segment_sentences, remove_duplicate_speeches, remove_non_party_speeches, remove_repeating_greetings, remove_repeating_endings, rename_party_duplicates, assign_topics_
+from preprocessing.remove_commentary import extract_commentary
+from preprocessing.remove_repeating_sentences import repeating_sentences_cut_off, GREETINGS_PERCENTILE, ENDINGS_PERCENTILE
+from preprocessing.segment_sentences import SENTENCE_OFFSETS_COLUMN
+from preprocessing.assign_lda_topics import FINAL_MODEL_PATH, PATH_CORPUS, PATH_DICTIONARY
+from src.constants import PATH_TRANSLATED_DATA, PATH_ALL_SPEECHES, PATH_FROZEN_STATE, PATH_INCREMENTS, N_TOPICS, MIGRATION_TOPIC_ID, MIGRATION_THRESHOLD, EMBEDDING_MODEL, PATH_CORPUS_IDS, PATH_CORPUS_STORE
+from src.lda.corpus_store import document, get_corpus_store
+from src.lda.update_lda_model import base_version, update_model, version_model_path
+from src.lda.create_lda_models import preprocess_documents
+from src.parallel import set_n_workers
+from src.pipeline import run_pipeline
+from src.schema import apply_schema, add_speech_ids
+from src.stage_cache import hash_file
+from src.instrumentation import measure, write_run_report, run_id
+
+"""
+Incremental ingest of new plenary sessions: only the speeches that are new (by date and speechnumber) go through the
+steps, using the state of the corpus-global steps frozen after a full run (--freeze, see freeze and ingest).
+"""
+
+KEY_COLUMNS = ["date", "speechnumber"]
+TEXT_COLUMN = "translatedText"
+# documents of the LDA corpus the baseline perplexity is computed on
+BASELINE_PERPLEXITY_DOCS = 5000
+DRIFT_THRESHOLDS = {
+    # relative deviation of the share of speeches whose first/last sentence is removed from the share when freezing
+    # (absolute deviation if the share was 0)
+    "greetings_removed_deviation": 0.5,
+    "endings_removed_deviation": 0.5,
+    # decrease of the share of lemmas that are in the LDA dictionary
+    "lda_coverage_decrease": 0.05,
+    # relative increase of the LDA perplexity (per word)
+    "lda_perplexity_increase": 0.25,
+    # Hellinger distance between the mean topic distributions of the increment and the frozen corpus
+    "topic_hellinger": 0.1,
+    # speeches ingested since freezing relative to the frozen corpus
+    "ingested_share": 0.2,
+    # highest Hellinger distance between the word distributions of a topic before and after the online update (only with --update_lda)
+    "lda_topic_drift": 0.2,
+}
+# steps up to the removal of the repeating sentences, the same as in preprocess_data.build_steps so their cached outputs are reused
+ROW_STEPS = [remove_non_party_speeches, keep_relevant_legislation_years, remove_duplicate_speeches, add_party_orientation_year_agenda, rename_party_duplicates, remove_commentary, segment_sentences]
+
+
+def _state_path(name: str, directory: str = PATH_FROZEN_STATE) -> str:
+    return os.path.join(directory, name)
+
+
+def _key_index(df: pd.DataFrame) -> pd.MultiIndex:
+    return pd.MultiIndex.from_arrays([df["date"].astype(str), df["speechnumber"].astype(np.int64)], names=KEY_COLUMNS)
+
+
+def _text_hashes(texts: pd.Series) -> np.ndarray:
+    return pd.util.hash_pandas_object(texts, index=False).to_numpy()
+
+
+def _lda_coverage_and_bows(documents: list[list[str]], dictionary: corpora.Dictionary) -> tuple[float, list]:
+    bows = [dictionary.doc2bow(document) for document in documents]
+    n_lemmas = sum(len(document) for document in documents)
+    return sum(count for bow in bows for _, count in bow) / max(n_lemmas, 1), bows
+
+
+def _hellinger(p: np.ndarray, q: np.ndarray) -> float:
+    return float(np.sqrt(0.5 * ((np.sqrt(p) - np.sqrt(q)) ** 2).sum()))
+
+
+def _n_sentences(df: pd.DataFrame) -> pd.Series:
+    return df[SENTENCE_OFFSETS_COLUMN].map(len) // 2
+
+
+def _removed_share(before: pd.DataFrame, after: pd.DataFrame) -> float:
+    """Share of the non-empty speeches of before that lost a sentence (or were dropped) in after"""
+    n_before = _n_sentences(before)
+    n_before = n_before[n_before > 0]
+    n_after = _n_sentences(after).reindex(n_before.index, fill_value=0)
+    return float((n_after < n_before).mean()) if len(n_before) else 0.0
+
+
+def freeze(tfidf_backend: str = "exact", directory: str = PATH_FROZEN_STATE):
+    """
+    Freeze the state of the corpus-global steps after a full run (preprocess_data.py -l): the keys of all speeches, the
+    hashes of their texts (remove_duplicate_speeches), the corpus counts of the bracketed comments (remove_commentary),
+    the TF-IDF vectorizers and score cut-offs of remove_repeating_greetings / remove_repeating_endings and the baselines
+    of the drift statistics (see DRIFT_THRESHOLDS). The LDA model, its dictionary and the embedding model are used as they are
+    """
+    print("Reading dataset")
+    df = apply_schema(add_speech_ids(pd.read_parquet(PATH_TRANSLATED_DATA)))
+    input_key = hash_file(PATH_TRANSLATED_DATA)
+    keys = _key_index(df).to_frame(index=False)
+
+    # same step keys as in preprocess_data, so these are loaded from the stage cache if it is up to date
+    filtered = run_pipeline(df, ROW_STEPS[:ROW_STEPS.index(remove_duplicate_speeches) + 1], input_key)
+    text_hashes = _text_hashes(filtered["text"])
+    comment_counts = pd.Series(Counter(extract_commentary(filtered, text_column=TEXT_COLUMN).tolist()), dtype=np.int64)
+    del filtered
+
+    df = run_pipeline(df, ROW_STEPS, input_key)
+    frozen = {}
+    for name, process, position, percentile in [("greetings", remove_repeating_greetings, 0, GREETINGS_PERCENTILE), ("endings", remove_repeating_endings, -1, ENDINGS_PERCENTILE)]: 
+        vectorizer, cut_off = repeating_sentences_cut_off(df, position, percentile, backend=tfidf_backend)
+        before, df = df, process(df.copy(), vectorizer=vectorizer, cut_off=cut_off)
+        # ties at the cut-off can remove more than percentile % of the sentences
+        frozen[name] = (vectorizer, {"percentile": percentile, "cut_off": cut_off, "removed": _removed_share(before, df)})
+    del df, before
+
+    print("Computing LDA baselines")
+    lda_model = LdaMulticore.load(FINAL_MODEL_PATH)
+    dictionary = corpora.Dictionary.load(PATH_DICTIONARY)
+    topics = pd.read_parquet(PATH_ALL_SPEECHES, columns=[f"topic_{i}" for i in range(N_TOPICS)])
+    corpus_store = get_corpus_store(PATH_CORPUS_STORE, PATH_CORPUS, PATH_CORPUS_IDS)
+    n_documents = len(corpus_store["keys"])
+    baseline_docs = [document(corpus_store, i) for i in np.linspace(0, n_documents - 1, min(BASELINE_PERPLEXITY_DOCS, n_documents)).astype(int)]
+
+    state = {
+        "frozen_at": datetime.now().isoformat(),
+        "input_hash": input_key,
+        "tfidf_backend": tfidf_backend,
+        **{name: parameters for name, (_, parameters) in frozen.items()},
+        "n_speeches": len(topics),
+        "n_ingested": 0,
+        # index of the next ingested speech, continuing the row positions of the translated dataset
+        "next_index": len(keys),
+        "baseline": {
+            # filter_extremes keeps the collection frequencies of the kept tokens, num_pos counts all lemmas
+            "lda_coverage": sum(dictionary.cfs.values()) / dictionary.num_pos,
+            "lda_perplexity": float(np.exp2(-lda_model.log_perplexity(baseline_docs))),
+            "topic_mean": topics.mean().tolist(),
+        },
+        "increments": [],
+        # version of the LDA model updated online (see --update_lda), None for the selected final model
+        "lda_version": None,
+    }
+
+    os.makedirs(directory, exist_ok=True)
+    keys.to_parquet(_state_path("keys.parquet", directory))
+    np.save(_state_path("text_hashes.npy", directory), text_hashes)
+    comment_counts.rename("count").to_frame().to_parquet(_state_path("comment_counts.parquet", directory))
+    for name, (vectorizer, _) in frozen.items():
+        # the terms pruned by min_df/max_df are only kept for inspection, but would be most of the pickle
+        if hasattr(vectorizer, "stop_words_"): 
+            vectorizer.stop_words_ = None
+        with open(_state_path(f"{name}_vectorizer.pkl", directory), "wb") as f:
+            pickle.dump(vectorizer, f)
+    with open(_state_path("state.json", directory), "w") as f:
+        json.dump(state, f, indent=2)
+    print(f"Froze state of {len(topics)} speeches to {directory}")
+
+
+def load_state(directory: str = PATH_FROZEN_STATE) -> dict:
+    if not os.path.exists(_state_path("state.json", directory)):
+        raise FileNotFoundError(f"No frozen state in {directory}, run with --freeze after a full preprocessing run first")
+    with open(_state_path("state.json", directory)) as f:
+        state = json.load(f)
+    state["keys"] = pd.read_parquet(_state_path("keys.parquet", directory))
+    state["text_hashes"] = np.load(_state_path("text_hashes.npy", directory))
+    state["comment_counts"] = pd.read_parquet(_state_path("comment_counts.parquet", directory))["count"]
+    for name in ["greetings", "endings"]:
+        with open(_state_path(f"{name}_vectorizer.pkl", directory), "rb") as f:
+            state[name]["vectorizer"] = pickle.load(f)
+    return state
+
+
+def save_state(state: dict, directory: str = PATH_FROZEN_STATE):
+    """Write the parts of the state an ingest changes (keys, text hashes, comment counts, counters)"""
+    state["keys"].to_parquet(_state_path("keys.parquet", directory))
+    np.save(_state_path("text_hashes.npy", directory), state["text_hashes"])
+    state["comment_counts"].rename("count").to_frame().to_parquet(_state_path("comment_counts.parquet", directory))
+    serializable = {key: value for key, value in state.items() if key not in ["keys", "text_hashes", "comment_counts"]}
+    serializable.update({name: {key: value for key, value in state[name].items() if key != "vectorizer"} for name in ["greetings", "endings"]})
+    # state.json last: an ingest interrupted before this point leaves the previous state.json
+    with open(_state_path("state.json.tmp", directory), "w") as f:
+        json.dump(serializable, f, indent=2)
+    os.replace(_state_path("state.json.tmp", directory), _state_path("state.json", directory))
+
+
+def preprocess_increment(df: pd.DataFrame, state: dict) -> tuple[pd.DataFrame, dict]:
+    """Row-local steps on the new speeches, the corpus-global ones with the frozen state. Returns the speeches and drift statistics"""
+    for process in [remove_non_party_speeches, keep_relevant_legislation_years]:
+        df = process(df)
+
+    # same as remove_duplicate_speeches, against the texts of the frozen corpus and all earlier increments
+    text_hashes = _text_hashes(df["text"])
+    is_duplicate = np.isin(text_hashes, state["text_hashes"]) | pd.Series(text_hashes).duplicated().to_numpy()
+    print(f"Removed {is_duplicate.sum()} duplicate speeches")
+    df = df[~is_duplicate]
+    state["text_hashes"] = np.concatenate([state["text_hashes"], text_hashes[~is_duplicate]])
+    if len(df) == 0: 
+        return df, {}
+
+    df = add_party_orientation_year_agenda(df)
+    df = rename_party_duplicates(df)
+
+    # comments are classified by their counts in the whole corpus, which now includes the new speeches
+    new_counts = pd.Series(Counter(extract_commentary(df, text_column=TEXT_COLUMN).tolist()), dtype=np.int64)
+    state["comment_counts"] = state["comment_counts"].add(new_counts, fill_value=0).astype(np.int64)
+    df = remove_commentary(df, comment_counts=state["comment_counts"])
+    df = segment_sentences(df)
+
+    statistics = {}
+    for name, process in [("greetings", remove_repeating_greetings), ("endings", remove_repeating_endings)]:
+        frozen = state[name]
+        before = df
+        df = process(df.copy(), vectorizer=frozen["vectorizer"], cut_off=frozen["cut_off"])
+        removed = _removed_share(before, df)
+        statistics[f"{name}_removed"] = removed
+        # relative to the frozen share, or absolute if no sentences were removed when freezing
+        statistics[f"{name}_removed_deviation"] = abs(removed - frozen["removed"]) / (frozen["removed"] or 1)
+    return df, statistics
+
+
+def assign_increment_topics(df: pd.DataFrame, state: dict, update_lda: bool = False, part: str | None = None) -> tuple[pd.DataFrame, dict]:
+    """
+    Topics of the new speeches with the frozen LDA model and dictionary, and the drift statistics of LDA.
+    With update_lda, the current model is first updated online with the new speeches (as a new version, see src/lda/update_lda_model.py)
+    """
+    current = state.get("lda_version")
+    lda_model = LdaMulticore.load(FINAL_MODEL_PATH if current is None else version_model_path(current))
+    dictionary = corpora.Dictionary.load(PATH_DICTIONARY)
+    documents = preprocess_documents(df[TEXT_COLUMN].tolist())
+    coverage, bows = _lda_coverage_and_bows(documents, dictionary)
+    # perplexity of the model before it saw the new speeches
+    perplexity = float(np.exp2(-lda_model.log_perplexity(bows))) if any(bows) else float("nan")
+    version = None
+    if update_lda: 
+        parent = base_version(FINAL_MODEL_PATH, PATH_DICTIONARY) if current is None else current
+        lda_model, _, version = update_model(documents, parent, source=part)
+    df = assign_topics_(df, lda_model, N_TOPICS, bows)
+
+    baseline = state["baseline"]
+    topic_mean = df[[f"topic_{i}" for i in range(N_TOPICS)]].mean().to_numpy()
+    statistics = {
+        "lda_coverage": coverage,
+        "lda_coverage_decrease": baseline["lda_coverage"] - coverage,
+        "lda_perplexity": perplexity,
+        "lda_perplexity_increase": perplexity / baseline["lda_perplexity"] - 1,
+        "topic_hellinger": _hellinger(topic_mean, np.asarray(baseline["topic_mean"])),
+    }
+    if version is not None: 
+        statistics.update({"lda_version": version["version"], "lda_topic_drift": version["max_topic_drift"], "lda_mean_topic_drift": version["mean_topic_drift"]})
+    return df, statistics
+
+
+def embed_migration_speeches(df_migration: pd.DataFrame) -> pd.DataFrame:
+    # only imported when embedding, loading torch is slow
+    from src.embeddings import embedd_speeches
+    df_migration[EMBEDDING_MODEL] = embedd_speeches(EMBEDDING_MODEL, df_migration, TEXT_COLUMN, show_progress_bar=True)
+    return df_migration
+
+
+def _write_partition(df: pd.DataFrame, name: str, part: str, directory: str = PATH_INCREMENTS) -> str:
+    os.makedirs(os.path.join(directory, name), exist_ok=True)
+    path = os.path.join(directory, name, f"part-{part}.parquet")
+    df.to_parquet(path)
+    return path
+
+
+def read_with_increments(path: str, name: str, directory: str = PATH_INCREMENTS, columns: list[str] | None = None) -> pd.DataFrame:
+    """Output of the full run at path (e.g. PATH_ALL_SPEECHES) with all partitions name (e.g. "full") appended by the incremental ingest"""
+    partition_dir = os.path.join(directory, name)
+    parts = sorted(os.listdir(partition_dir)) if os.path.isdir(partition_dir) else []
+    frames = [pd.read_parquet(path, columns=columns), *(pd.read_parquet(os.path.join(partition_dir, part), columns=columns) for part in parts)]
+    return pd.concat(frames) if len(frames) > 1 else frames[0]
+
+
+def ingest(path_in: str, embed: bool = False, update_lda: bool = False, directory: str = PATH_FROZEN_STATE) -> dict:
+    """
+    Ingest the speeches of path_in (translated, same columns as PATH_TRANSLATED_DATA) that are not ingested yet, returns the drift report.
+    One partition per output is appended to PATH_INCREMENTS (see read_with_increments). If a drift statistic exceeds its
+    threshold in DRIFT_THRESHOLDS, a full refit (preprocessing, LDA, --freeze) is recommended.
+    With update_lda, the LDA model is updated online with the new speeches before their topics are assigned (as a new
+    version, see src/lda/update_lda_model.py), which the frozen state records as current once the ingest is done
+    """
+    state = load_state(directory)
+    df = apply_schema(add_speech_ids(pd.read_parquet(path_in)))
+    keys = _key_index(df)
+    is_new = ~keys.isin(_key_index(state["keys"])) & ~keys.duplicated()
+    print(f"{is_new.sum()} of {len(df)} speeches are new")
+    df = df[is_new]
+    df.index = pd.RangeIndex(state["next_index"], state["next_index"] + len(df))
+    state["next_index"] += len(df)
+    state["keys"] = pd.concat([state["keys"], keys[is_new].to_frame(index=False)], ignore_index=True)
+
+    part = run_id()
+    with measure("preprocess_increment", kind="pipeline"):
+        df, statistics = preprocess_increment(df, state)
+    if len(df) > 0: 
+        with measure("assign_increment_topics", kind="pipeline"):
+            df, lda_statistics = assign_increment_topics(df, state, update_lda=update_lda, part=part)
+        statistics.update(lda_statistics)
+    state["n_ingested"] += len(df)
+    statistics["ingested_share"] = state["n_ingested"] / state["n_speeches"]
+
+    drifted = sorted(name for name, threshold in DRIFT_THRESHOLDS.items() if statistics.get(name, 0) > threshold)
+    report = {"part": part, "input": path_in, "n_speeches": len(df), "statistics": statistics, "thresholds": DRIFT_THRESHOLDS,
+              "drifted": drifted, "refit_recommended": bool(drifted)}
+
+    if len(df) > 0:
+        df["migration_prob"] = df[f"topic_{MIGRATION_TOPIC_ID}"]
+        df_migration = df[df["migration_prob"] >= MIGRATION_THRESHOLD].drop(columns=[f"topic_{i}" for i in range(N_TOPICS)])
+        _write_partition(df, "full", part)
+        _write_partition(df_migration, "migration", part)
+        if embed and len(df_migration) > 0:
+            _write_partition(embed_migration_speeches(df_migration.copy()), "migration_embedded", part)
+        print(f"Appended {len(df)} speeches ({len(df_migration)} about migration) as partition {part}")
+
+    os.makedirs(os.path.join(PATH_INCREMENTS, "drift"), exist_ok=True)
+    with open(os.path.join(PATH_INCREMENTS, "drift", f"{part}.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    # the state is only updated after the outputs are written, so a failed ingest can simply be repeated
+    state["increments"].append(part)
+    if "lda_version" in statistics:
+        # the updated model only becomes current with the state, a repeated ingest updates the same version again
+        state["lda_version"] = statistics["lda_version"]
+    save_state(state, directory)
+
+    if drifted:
+        print("Drift above threshold for", ", ".join(f"{name} ({statistics[name]:.3f})" for name in drifted), "=> a full refit is recommended")
+    return report
+
+
+if __name__ == "__main__":
+    optParser = optparse.OptionParser(usage="%prog [--freeze | -i NEW_SPEECHES.parquet]")
+    optParser.add_option('--freeze', action='store_true',
+                         default=False, dest='freeze',
+                         help='Freeze the state of the corpus-global steps after a full run (preprocess_data.py -l)')
+
+    optParser.add_option('-i', '--input', action='store',
+                         default=None, dest='input',
+                         help='Parquet file of new translated speeches (same columns as ' + PATH_TRANSLATED_DATA + ')')
+
+    optParser.add_option('-e', '--embed', action='store_true',
+                         default=False, dest='embed',
+                         help='Also embed the new migration speeches with ' + EMBEDDING_MODEL)
+
+    optParser.add_option('-u', '--update_lda', action='store_true',
+                         default=False, dest='update_lda',
+                         help='Update the LDA model online with the new speeches (as a new version) before assigning their topics')
+
+    optParser.add_option('--tfidf_backend', action='store', type='choice', choices=['exact', 'hashed'],
+                         default='exact', dest='tfidf_backend',
+                         help='TF-IDF backend of the frozen vectorizers (only with --freeze)')
+
+    optParser.add_option('-w', '--workers', action='store', type='int',
+                         default=None, dest='workers',
+                         help='Number of worker processes for the text cleaning steps (default: number of cores)')
+
+    opts, _ = optParser.parse_args()
+    if opts.freeze == (opts.input is not None):
+        optParser.error("Pass either --freeze or --input")
+    if opts.workers is not None:
+        set_n_workers(opts.workers)
+
+    if opts.freeze:
+        freeze(opts.tfidf_backend)
+        write_run_report(options=vars(opts))
+    else:
+        report = ingest(opts.input, embed=opts.embed, update_lda=opts.update_lda)
+        write_run_report(options=vars(opts), drift=report)
@@ -0,0 +1,101 @@
+import optparse
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+
+# assume script is run from project root => path to be able to import src
+sys.path.append(str(Path.cwd()))
+from src.constants import PATH_RAW_DATA, PATH_RAW_DATASET
+from src.schema import SPEECH_ID, speech_ids
+
+"""
+Converts the raw speech CSV (see src/transform_pls_rds_to_csv.R) once into a parquet dataset partitioned by period,
+so the later stages read only the columns they need (read_raw_data) instead of parsing the whole CSV every time.
+
+The CSV is parsed in blocks of CSV_BLOCK_SIZE bytes by Arrow's multithreaded reader with the explicit types of RAW_SCHEMA,
+and every speech gets the row key ROW_KEY: its position in the CSV, i.e. the index the translation scripts used
+to get from pd.read_csv(...).reset_index(), and its stable SPEECH_ID (see src/schema.py).
+"""
+
+RAW_SCHEMA = pa.schema([
+    ("speaker", pa.string()),
+    ("text", pa.string()),
+    ("party", pa.string()),
+    ("date", pa.string()),
+    ("agenda", pa.string()),
+    ("speechnumber", pa.int64()),
+    ("procedure_ID", pa.string()),
+    ("partyfacts_ID", pa.float64()),
+    ("period", pa.int64()),
+    ("chair", pa.bool_()),
+    ("MEP", pa.bool_()),
+    ("commission", pa.bool_()),
+    ("written", pa.bool_()),
+    ("multispeaker", pa.bool_()),
+    ("link", pa.string()),
+    ("translatedText", pa.string()),
+    ("translationInSpeech", pa.bool_()),
+])
+ROW_KEY = "row_id"
+PARTITION_COLUMN = "period"
+CSV_BLOCK_SIZE = 64 << 20
+
+
+def _partitioning() -> ds.Partitioning:
+    return ds.partitioning(pa.schema([RAW_SCHEMA.field(PARTITION_COLUMN)]), flavor="hive")
+
+
+def ingest_raw_csv(path_csv: str = PATH_RAW_DATA, path_dataset: str = PATH_RAW_DATASET, block_size: int = CSV_BLOCK_SIZE) -> int:
+    """Convert the raw CSV to the parquet dataset at path_dataset (replacing it), returns the number of speeches"""
+    reader = pacsv.open_csv(
+        path_csv,
+        read_options=pacsv.ReadOptions(block_size=block_size, use_threads=True),
+        # fwrite writes missing values as empty fields and logicals as TRUE/FALSE
+        convert_options=pacsv.ConvertOptions(column_types=RAW_SCHEMA, include_columns=RAW_SCHEMA.names, strings_can_be_null=True,
+                                             true_values=["TRUE", "True", "true"], false_values=["FALSE", "False", "false"]),
+    )
+    schema = RAW_SCHEMA.append(pa.field(ROW_KEY, pa.int64())).append(pa.field(SPEECH_ID, pa.string()))
+    n_rows = 0
+
+    def batches():
+        nonlocal n_rows
+        for batch in reader:
+            ids = speech_ids(batch.select(["date", "speechnumber", "text"]).to_pandas())
+            yield pa.RecordBatch.from_arrays([*batch.columns, pa.array(np.arange(n_rows, n_rows + batch.num_rows)), pa.array(ids, pa.string())], schema=schema)
+            n_rows += batch.num_rows
+
+    if os.path.exists(path_dataset):
+        shutil.rmtree(path_dataset)
+    ds.write_dataset(batches(), path_dataset, schema=schema, format="parquet", partitioning=_partitioning())
+    return n_rows
+
+
+def read_raw_data(columns: list[str] | None = None, path_dataset: str = PATH_RAW_DATASET) -> pd.DataFrame:
+    """Speeches of the raw dataset with only the given columns (in the order of the CSV, then SPEECH_ID), indexed by their row key"""
+    names = [name for name in [*RAW_SCHEMA.names, SPEECH_ID] if columns is None or name in columns]
+    table = ds.dataset(path_dataset, format="parquet", partitioning=_partitioning()).to_table(columns=[*names, ROW_KEY])
+    df = table.to_pandas().set_index(ROW_KEY).sort_index()
+    df.index.name = None
+    return df
+
+
+if __name__ == "__main__":
+    optParser = optparse.OptionParser()
+    optParser.add_option('-i', '--input', action='store',
+                         default=PATH_RAW_DATA, dest='input',
+                         help='Raw speech CSV')
+    optParser.add_option('-o', '--output', action='store',
+                         default=PATH_RAW_DATASET, dest='output',
+                         help='Directory of the partitioned parquet dataset')
+
+    opts, _ = optParser.parse_args()
+    print("Converting", opts.input)
+    n_rows = ingest_raw_csv(opts.input, opts.output)
+    print(f"Wrote {n_rows} speeches to {opts.output}")
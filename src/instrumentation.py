@@ -0,0 +1,201 @@
+"""
+Instrumentation of the preprocessing: measure() records wall time, CPU time, peak RSS, rows and bytes of text
+of a block of code, instrument() does the same for every call of a function. The records of one invocation are
+written as a JSON run report (write_run_report), so runs can be compared to find regressions.
+sampling_profiler() additionally writes the Python stacks of all threads in the collapsed format of flamegraph.pl / speedscope.
+
+Notes on the numbers:
+- cpu_seconds is the CPU time of the measuring thread, child_cpu_seconds the one of child processes (e.g. the process
+  pool of src/parallel.py) that finished while measuring
+- text_bytes are estimated from a sample of TEXT_BYTES_SAMPLE rows, not counted
+- peak RSS is sampled every RSS_SAMPLE_INTERVAL seconds for the whole process (and its children), so steps running
+  concurrently (see src/pipeline.py) share their peaks
+"""
+
+import collections
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import psutil
+
+from src.constants import PATH_RUN_REPORTS
+
+RSS_SAMPLE_INTERVAL = 0.05
+PROFILE_SAMPLE_INTERVAL = 0.005
+# rows of a frame whose text is measured to estimate the text bytes of the whole frame
+TEXT_BYTES_SAMPLE = 1000
+# threads of the instrumentation itself, left out of the profiles
+THREAD_PREFIX = "instrumentation-"
+
+_records = []
+_records_lock = threading.Lock()
+_started_at = datetime.now()
+
+
+def text_bytes(df: pd.DataFrame, sample_size: int = TEXT_BYTES_SAMPLE) -> int:
+    """
+    UTF-8 bytes of all string columns of df, extrapolated from sample_size evenly spaced rows, so measuring a step
+    neither copies its columns nor scans all of their values
+    """
+    if len(df) == 0:
+        return 0
+    positions = np.linspace(0, len(df) - 1, min(sample_size, len(df))).astype(int)
+    total = 0
+    for column in df.columns:
+        if df[column].dtype != object and not pd.api.types.is_string_dtype(df[column].dtype):
+            continue
+        sample = df[column].iloc[positions]
+        if pd.api.types.infer_dtype(sample, skipna=True) != "string":
+            continue
+        total += sum(len(value.encode("utf-8")) for value in sample if isinstance(value, str)) * len(df) / len(positions)
+    return int(total)
+
+
+def _rss(process: psutil.Process) -> tuple[int, int]:
+    children = 0
+    for child in process.children(recursive=True):
+        try:
+            children += child.memory_info().rss
+        except psutil.Error:  # child finished in the meantime
+            pass
+    return process.memory_info().rss, children
+
+
+@contextmanager
+def _rss_sampler(interval: float = RSS_SAMPLE_INTERVAL):
+    process = psutil.Process()
+    peak = list(_rss(process))
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            for i, rss in enumerate(_rss(process)):
+                peak[i] = max(peak[i], rss)
+
+    thread = threading.Thread(target=sample, name=THREAD_PREFIX + "rss", daemon=True)
+    thread.start()
+    try:
+        yield peak
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@contextmanager
+def measure(name: str, kind: str = "helper", df_in: pd.DataFrame | None = None):
+    """
+    Record the resources used by the block under name. Yields the record, so the block can add to it,
+    e.g. record["rows_out"] (or call add_frame_stats(record, df, "out")).
+    """
+    record = {"name": name, "kind": kind, "thread": threading.current_thread().name, "started_at": datetime.now().isoformat()}
+    if df_in is not None:
+        add_frame_stats(record, df_in, "in")
+
+    children_cpu = _children_cpu_seconds()
+    wall, cpu = time.perf_counter(), time.thread_time()
+    with _rss_sampler() as peak:
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = time.perf_counter() - wall
+            record["cpu_seconds"] = time.thread_time() - cpu
+            record["child_cpu_seconds"] = _children_cpu_seconds() - children_cpu
+    record["peak_rss_mb"] = peak[0] / 1e6
+    record["peak_rss_children_mb"] = peak[1] / 1e6
+    with _records_lock:
+        _records.append(record)
+
+
+def add_frame_stats(record: dict, df: pd.DataFrame, suffix: str):
+    record[f"rows_{suffix}"] = len(df)
+    record[f"text_bytes_{suffix}"] = text_bytes(df)
+
+
+def instrument(func=None, *, name: str | None = None):
+    """Decorator measuring every call of a (heavy) function, e.g. @instrument or @instrument(name="...")"""
+    if func is None:
+        return functools.partial(instrument, name=name)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with measure(name or func.__qualname__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def run_id() -> str:
+    """Name of the reports of this invocation"""
+    return f"{_started_at.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+
+
+def write_run_report(directory: str = PATH_RUN_REPORTS, **info) -> str:
+    """Write all records of this invocation (and info, e.g. the command line options) to a new JSON file in directory"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{run_id()}.json")
+    with _records_lock:
+        report = {
+            "started_at": _started_at.isoformat(),
+            "argv": sys.argv,
+            "wall_seconds": (datetime.now() - _started_at).total_seconds(),
+            **info,
+            "records": list(_records),
+        }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Wrote run report to {path}")
+    return path
+
+
+def _collapsed_stack(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+@contextmanager
+def sampling_profiler(path: str, interval: float = PROFILE_SAMPLE_INTERVAL):
+    """
+    Sample the Python stacks of all threads every interval seconds and write them to path in the collapsed
+    format ("outer;inner count" per line), e.g. for flamegraph.pl or speedscope. Worker processes are not sampled.
+    """
+    counts = collections.Counter()
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                name = names.get(thread_id, str(thread_id))
+                if name.startswith(THREAD_PREFIX):
+                    continue
+                counts[f"{name};{_collapsed_stack(frame)}"] += 1
+
+    thread = threading.Thread(target=sample, name=THREAD_PREFIX + "profiler", daemon=True)
+    thread.start()
+    try:
+        yield counts
+    finally:
+        stop.set()
+        thread.join()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            for stack, count in counts.most_common():
+                f.write(f"{stack} {count}\n")
+        print(f"Wrote profile ({sum(counts.values())} samples) to {path}")
@@ -0,0 +1,68 @@
+"""
+Lazy frame used by src/pipeline.py: instead of copying every column for each filter (df.loc[index]), it keeps
+the input frame unchanged, the positions of the rows that are left, and the columns written by the steps together
+with the positions they were written for. Rows are only gathered for the columns a step reads (lazy_project) and once
+for all columns at the end (lazy_materialize).
+
+A lazy frame is a dict with
+- "base": the input frame, never modified
+- "positions": positions (in base) of the remaining rows, ascending
+- "columns": all columns in order, mapped to None while they are the ones of base, else to (positions, values) of the last write
+- "bytes_saved": estimated bytes the copies of the eager filters (df.loc[index]) would have allocated
+"""
+
+import numpy as np
+import pandas as pd
+
+# bytes per value of extension columns (e.g. offsets of arrow strings), numpy columns use their itemsize
+POINTER_BYTES = 8
+
+
+def lazy_frame(df: pd.DataFrame) -> dict:
+    return {"base": df, "positions": np.arange(len(df)), "columns": dict.fromkeys(df.columns), "bytes_saved": 0}
+
+
+def lazy_index(frame: dict) -> pd.Index:
+    return frame["base"].index[frame["positions"]]
+
+
+def _values(frame: dict, column: str):
+    written = frame["columns"][column]
+    if written is None:
+        return frame["base"][column].array.take(frame["positions"])
+    positions, values = written
+    # rows are only removed, so the remaining positions are a subset of the ones the column was written for
+    return values.take(np.searchsorted(positions, frame["positions"]))
+
+
+def _row_bytes(frame: dict) -> int:
+    dtypes = [frame["base"][column].dtype if written is None else written[1].dtype for column, written in frame["columns"].items()]
+    return frame["base"].index.dtype.itemsize + sum(dtype.itemsize if isinstance(dtype, np.dtype) else POINTER_BYTES for dtype in dtypes)
+
+
+def lazy_project(frame: dict, columns: list[str]) -> pd.DataFrame:
+    """
+    Contiguous frame of the remaining rows and the given columns (in the order of the lazy frame). It owns its values
+    (they are taken from the columns), so a step can assign to it without a SettingWithCopyWarning
+    """
+    return pd.DataFrame({column: _values(frame, column) for column in frame["columns"] if column in columns}, index=lazy_index(frame))
+
+
+def lazy_materialize(frame: dict) -> pd.DataFrame:
+    return lazy_project(frame, list(frame["columns"]))
+
+
+def lazy_filter(frame: dict, index: pd.Index) -> dict:
+    """Keep only the rows with the labels in index, which has to be in the order of the frame"""
+    indexer = lazy_index(frame).get_indexer(index)
+    if (indexer < 0).any() or (np.diff(indexer) <= 0).any():
+        raise ValueError("Filters can only remove rows, not add or reorder them")
+    positions = frame["positions"][indexer]
+    return {**frame, "positions": positions, "bytes_saved": frame["bytes_saved"] + len(positions) * _row_bytes(frame)}
+
+
+def lazy_assign(frame: dict, df: pd.DataFrame) -> dict:
+    """Set the columns of df, which has to have exactly the remaining rows"""
+    if not df.index.equals(lazy_index(frame)):
+        raise ValueError("Assigned columns have to have exactly the remaining rows")
+    return {**frame, "columns": {**frame["columns"], **{column: (frame["positions"], df[column].array) for column in df.columns}}}
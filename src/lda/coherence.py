@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from gensim import corpora
+from gensim.models.coherencemodel import CoherenceModel
+
+# assume script is run from project root => path to be able to import src
+sys.path.append(str(Path.cwd()))
+from src.lda.lda_grid import dictionary_hash
+from src.lda.token_store import iter_documents, load_token_store, token_store_hash
+
+"""
+c_v coherence of many LDA models from one pass over the texts, see shared_coherence_model and score_models.
+"""
+
+COHERENCE = "c_v"
+COHERENCE_TOPN = 20
+PATH_COHERENCE_CACHE = "data/lda/coherence"
+
+# coherence model of a worker process of score_models
+_worker_coherence_model = None
+
+
+def model_topics(lda_model, dictionary: corpora.Dictionary, topn: int = COHERENCE_TOPN) -> list[list[str]]:
+    """Top words of every topic, as CoherenceModel(model=lda_model) would take them"""
+    return CoherenceModel.top_topics_as_word_lists(lda_model, dictionary, topn)
+
+
+def _new_coherence_model(words: list[str], texts, dictionary: corpora.Dictionary, window_size, processes) -> CoherenceModel:
+    # all words as one topic, its segmentation gives every word as relevant
+    return CoherenceModel(topics=[words], texts=texts, dictionary=dictionary, window_size=window_size, coherence=COHERENCE,
+                          topn=len(words), processes=processes)
+
+
+def shared_coherence_model(topics_per_model: list, token_store_path: str, dictionary: corpora.Dictionary, window_size=None,
+                           cache_dir: str = PATH_COHERENCE_CACHE, processes: int = -1) -> CoherenceModel:
+    """
+    CoherenceModel with the word (co-)occurrences of the union of the topic words of all models in topics_per_model,
+    accumulated over the documents of the token store (with processes processes) or loaded from the cache.
+    c_v only needs these (co-)occurrences, so scoring every model from them gives exactly the scores of separate
+    CoherenceModels. The cache (per token store, dictionary and window size) is accumulated again for the union of both
+    word sets if it misses words
+    """
+    words = sorted({word for topics in topics_per_model for topic in topics for word in topic})
+    key = json.dumps({"texts": token_store_hash(token_store_path), "dictionary": dictionary_hash(dictionary), "coherence": COHERENCE, "window_size": window_size})
+    cache_path = os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest()[:16] + ".pkl")
+
+    accumulator = None
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            accumulator = pickle.load(f)
+    if accumulator is not None and set(words) <= accumulator.relevant_words:
+        print("Loaded coherence statistics of", len(accumulator.relevant_words), "words from", cache_path)
+    else:
+        if accumulator is not None:
+            words = sorted(set(words) | accumulator.relevant_words)
+        print("Accumulating coherence statistics of", len(words), "words")
+        texts = iter_documents(load_token_store(token_store_path))
+        accumulator = _new_coherence_model(words, texts, dictionary, window_size, processes).estimate_probabilities()
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path + ".tmp", "wb") as f:
+            pickle.dump(accumulator, f)
+        os.replace(cache_path + ".tmp", cache_path)
+
+    # without texts (so it can be sent to worker processes), the accumulator holds everything c_v needs
+    coherence_model = _new_coherence_model(words, [], dictionary, window_size, processes)
+    # relies on gensim 4.x internals: get_coherence uses the private _accumulator if it is set instead of accumulating again
+    coherence_model._accumulator = accumulator
+    return coherence_model
+
+
+def _init_worker(coherence_model: CoherenceModel):
+    global _worker_coherence_model
+    _worker_coherence_model = coherence_model
+
+
+def _score(topics: list[list[str]]) -> float:
+    # the topic words are a subset of the accumulated ones, so setting them keeps the statistics
+    _worker_coherence_model.topics = topics
+    return _worker_coherence_model.get_coherence()
+
+
+def score_models(coherence_model: CoherenceModel, topics_per_model: list, n_workers: int | None = None) -> list[float]:
+    """Coherence of every model in topics_per_model from the statistics of shared_coherence_model, scored in a process pool"""
+    n_workers = min(n_workers or os.cpu_count() or 1, len(topics_per_model))
+    if n_workers <= 1:
+        _init_worker(coherence_model)
+        return [_score(topics) for topics in topics_per_model]
+    with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(coherence_model,)) as pool:
+        return list(pool.map(_score, topics_per_model))
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import optparse
+import os
+import sys
+from array import array
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from gensim import corpora
+from gensim.matutils import Sparse2Corpus
+
+# assume script is run from project root => path to be able to import src
+sys.path.append(str(Path.cwd()))
+from src.constants import PATH_CORPUS_IDS, PATH_CORPUS_STORE
+from src.schema import SPEECH_ID
+from src.stage_cache import begin_marked_write, end_marked_write, file_stamps, has_marker, hash_file, read_marker
+
+"""
+Binary corpus store of the bags of words of the speeches, keyed by speech id: instead of the Matrix Market text file of
+MmCorpus, which every consumer parses from the start, the corpus is kept as a CSR matrix (documents x terms) in
+indptr.npy, indices.npy (term ids) and counts.npy, next to the keys of the documents (keys.json, e.g. their speech ids).
+Document i is indices[indptr[i]:indptr[i + 1]] with its counts, so any document is read in O(1) from the memory-mapped arrays.
+
+A loaded store is a dict with "indptr", "indices", "counts", "keys", "num_terms" and "index" (pd.Index of the keys).
+as_corpus(store) streams it to gensim (e.g. as the corpus of an LdaModel), subset(store, keys) selects the documents of
+some speeches (e.g. only the ones of period 9) and from_mm_corpus / to_mm_corpus convert from and to MmCorpus.
+"""
+
+INDPTR_FILE = "indptr.npy"
+INDICES_FILE = "indices.npy"
+COUNTS_FILE = "counts.npy"
+META_FILE = "meta.json"
+KEYS_FILE = "keys.json"
+# the Matrix Market corpus written by src/lda/create_lda_models.py
+PATH_MM_CORPUS = "data/lda/corpus_final.c"
+
+
+def write_corpus_store(bows, keys, path: str, num_terms: int | None = None, source_paths: list[str] | None = None) -> dict:
+    """
+    Write the documents (bags of words) with their keys to the corpus store in directory path, returns the loaded store.
+    num_terms defaults to the highest term id + 1, source_paths: MmCorpus (and ids) the store was converted from (see is_current)
+    """
+    begin_marked_write(path, KEYS_FILE)
+    indptr, indices, counts = array("q", [0]), array("i"), array("i")
+    for bow in bows:
+        # sorted by term id like Dictionary.doc2bow
+        for term_id, count in sorted(bow):
+            indices.append(int(term_id))
+            counts.append(int(count))
+        indptr.append(len(indices))
+
+    np.save(os.path.join(path, INDPTR_FILE), np.frombuffer(indptr, dtype=np.int64))
+    np.save(os.path.join(path, INDICES_FILE), np.frombuffer(indices, dtype=np.int32))
+    np.save(os.path.join(path, COUNTS_FILE), np.frombuffer(counts, dtype=np.int32))
+    meta = {
+        "num_terms": int(num_terms if num_terms is not None else max(indices, default=-1) + 1),
+        # MmCorpus.serialize also writes an index file next to the corpus
+        "source": file_stamps(source_paths) if source_paths is not None else None,
+    }
+    with open(os.path.join(path, META_FILE), "w") as f:
+        json.dump(meta, f)
+    end_marked_write(path, KEYS_FILE, list(keys))
+    return load_corpus_store(path)
+
+
+def has_corpus_store(path: str) -> bool:
+    return has_marker(path, KEYS_FILE)
+
+
+def corpus_store_hash(path: str) -> str:
+    """Content hash of the documents of the store and their keys"""
+    return hashlib.sha256("".join(hash_file(os.path.join(path, file)) for file in (INDPTR_FILE, INDICES_FILE, COUNTS_FILE, KEYS_FILE)).encode()).hexdigest()
+
+
+def load_corpus_store(path: str) -> dict:
+    keys = read_marker(path, KEYS_FILE)
+    return {
+        "indptr": np.load(os.path.join(path, INDPTR_FILE), mmap_mode="r"),
+        "indices": np.load(os.path.join(path, INDICES_FILE), mmap_mode="r"),
+        "counts": np.load(os.path.join(path, COUNTS_FILE), mmap_mode="r"),
+        "keys": keys,
+        "num_terms": json.load(open(os.path.join(path, META_FILE)))["num_terms"],
+        "index": pd.Index(keys),
+    }
+
+
+def row(store: dict, i: int) -> tuple[np.ndarray, np.ndarray]:
+    """Term ids and counts of document i (views into the memory-mapped arrays)"""
+    start, end = store["indptr"][i], store["indptr"][i + 1]
+    return store["indices"][start:end], store["counts"][start:end]
+
+
+def document(store: dict, i: int) -> list[tuple[int, int]]:
+    """Bag of words of document i"""
+    indices, counts = row(store, i)
+    return list(zip(indices.tolist(), counts.tolist()))
+
+
+def positions(store: dict, keys) -> np.ndarray:
+    """Positions of the documents with the given keys (the first one for a duplicate key), raises if a key is not in the store"""
+    index = store["index"]
+    first = ~index.duplicated()
+    found = index[first].get_indexer(pd.Index(keys))
+    if (found < 0).any():
+        raise ValueError(f"{(found < 0).sum()} speeches are not in the LDA corpus, re-create it with src/lda/create_lda_models.py")
+    return np.flatnonzero(first)[found]
+
+
+def subset(store: dict, keys) -> dict:
+    """Store (in memory) of only the documents with the given keys in that order, e.g. the speech ids of one period"""
+    return take(store, positions(store, keys))
+
+
+def take(store: dict, rows) -> dict:
+    """Store (in memory) of only the documents at the given positions in that order"""
+    rows = np.asarray(rows, dtype=np.int64)
+    starts, ends = store["indptr"][rows], store["indptr"][rows + 1]
+    lengths = ends - starts
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    # positions of the entries of all selected rows in the full arrays
+    entries = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+    keys = [store["keys"][i] for i in rows]
+    return {
+        "indptr": indptr,
+        "indices": np.asarray(store["indices"][entries]),
+        "counts": np.asarray(store["counts"][entries]),
+        "keys": keys,
+        "num_terms": store["num_terms"],
+        "index": pd.Index(keys),
+    }
+
+
+def as_corpus(store: dict) -> Sparse2Corpus:
+    """Streamed gensim corpus of the store (len, iteration and corpus[i] for a document), without copying the term ids and counts"""
+    matrix = scipy.sparse.csr_matrix((store["counts"], store["indices"], store["indptr"]),
+                                     shape=(len(store["keys"]), store["num_terms"]), copy=False)
+    return Sparse2Corpus(matrix, documents_columns=False)
+
+
+def from_mm_corpus(mm_path: str, keys, path: str, source_paths: list[str] | None = None) -> dict:
+    """Convert the MmCorpus at mm_path, whose documents have the given keys, to a corpus store in directory path"""
+    mm_corpus = corpora.MmCorpus(mm_path)
+    keys = list(keys)
+    if len(keys) != len(mm_corpus):
+        raise ValueError(f"{len(keys)} keys for {len(mm_corpus)} documents in {mm_path}")
+    return write_corpus_store(mm_corpus, keys, path, num_terms=mm_corpus.num_terms, source_paths=source_paths or [mm_path])
+
+
+def to_mm_corpus(store: dict, mm_path: str):
+    """Write the documents of the store as MmCorpus to mm_path (in the order of the store)"""
+    corpora.MmCorpus.serialize(mm_path, as_corpus(store))
+
+
+def is_current(path: str, source_paths: list[str]) -> bool:
+    """Whether the store exists and was written from (or together with) the files at source_paths as they are now"""
+    if not has_corpus_store(path):
+        return False
+    return json.load(open(os.path.join(path, META_FILE)))["source"] == file_stamps(source_paths)
+
+
+def _mm_keys(mm_path: str, ids_path: str) -> list:
+    # speech ids of the documents in the order of the corpus, their positions if there are none
+    if os.path.exists(ids_path):
+        return pd.read_parquet(ids_path)[SPEECH_ID].tolist()
+    return list(range(len(corpora.MmCorpus(mm_path))))
+
+
+def get_corpus_store(path: str = PATH_CORPUS_STORE, mm_path: str = PATH_MM_CORPUS, ids_path: str = PATH_CORPUS_IDS) -> dict:
+    """
+    Corpus store of the MmCorpus at mm_path, converted (again) first if it does not exist or the MmCorpus changed since.
+    The documents are keyed by the speech ids in ids_path, or by their positions if there is no such file
+    """
+    if not is_current(path, [mm_path, ids_path]):
+        print("Converting corpus", mm_path, "to", path)
+        return from_mm_corpus(mm_path, _mm_keys(mm_path, ids_path), path, source_paths=[mm_path, ids_path])
+    return load_corpus_store(path)
+
+
+if __name__ == "__main__":
+    optParser = optparse.OptionParser()
+    optParser.add_option('-m', '--mm_corpus', action='store',
+                         default=PATH_MM_CORPUS, dest='mm_corpus',
+                         help='MmCorpus to convert from (or to, with --to_mm)')
+    optParser.add_option('-s', '--store', action='store',
+                         default=PATH_CORPUS_STORE, dest='store',
+                         help='Directory of the corpus store')
+    optParser.add_option('-i', '--ids', action='store',
+                         default=PATH_CORPUS_IDS, dest='ids',
+                         help='Speech ids of the documents of the MmCorpus, in its order')
+    optParser.add_option('--to_mm', action='store_true',
+                         default=False, dest='to_mm',
+                         help='Write the store as MmCorpus (and its speech ids) instead of converting the MmCorpus to a store')
+
+    opts, _ = optParser.parse_args()
+    if opts.to_mm:
+        store = load_corpus_store(opts.store)
+        to_mm_corpus(store, opts.mm_corpus)
+        pd.DataFrame({SPEECH_ID: store["keys"]}).to_parquet(opts.ids)
+        print("Wrote", len(store["keys"]), "documents of", opts.store, "to", opts.mm_corpus)
+    else:
+        store = from_mm_corpus(opts.mm_corpus, _mm_keys(opts.mm_corpus, opts.ids), opts.store, source_paths=[opts.mm_corpus, opts.ids])
+        print("Converted", len(store["keys"]), "documents of", opts.mm_corpus, "to", opts.store)
@@ -1,6 +1,7 @@
+import contextlib
+import optparse
 import os 
 from gensim import corpora
-from gensim.models import LdaMulticore
 from gensim.utils import simple_preprocess
 import spacy
 import logging
@@ -14,98 +15,182 @@ from pathlib import Path
 
 # assume script is run from project root => path to be able to import src
 sys.path.append(str(Path.cwd()))
-from src.constants import PATH_ALL_SPEECHES
+from src.constants import PATH_ALL_SPEECHES, PATH_CORPUS_IDS, PATH_CORPUS_STORE, PATH_DF_PROFILE, PATH_PREPROCESSED, PATH_TOKEN_STORE
+from src.lda.dictionary_profile import filter_stats, filtered_dictionary, get_profile
+from src.lda.corpus_store import write_corpus_store
+from src.lda.lda_grid import CONVERGENCE_TOLERANCE, LDA_RANDOM_STATE, LDA_WORKERS_PER_JOB, fit_models
+from src.lda.token_store import has_token_store, iter_bows, load_token_store, write_token_store
+from src.schema import SPEECH_ID
 
 
-def preprocess_documents(documents: List[str], custom_stopwords=[], test_first_k = None):     
+SPACY_MODEL = "en_core_web_sm"
+# components the lemmas depend on, all others (parser, ner, ...) are disabled
+LEMMATIZER_PIPES = ["tok2vec", "tagger", "attribute_ruler", "lemmatizer"]
+LEMMATIZE_BATCH_SIZE = 256
+
+
+def _load_nlp():
+    nlp = spacy.load(SPACY_MODEL)
+    nlp.select_pipes(enable=[pipe for pipe in LEMMATIZER_PIPES if pipe in nlp.pipe_names])
+    return nlp
+
+
+def read_lemmas(path) -> dict:
+    """
+    Lemmas of the documents in the JSONL file written by preprocess_documents, by key.
+    Cuts off a last line that was only partly written (e.g. when the process was killed), so the file can be appended to again
+    """
+    lemmas = {}
+    if not os.path.exists(path): 
+        return lemmas
+    with open(path, "rb+") as f: 
+        end = 0
+        for line in f: 
+            if not line.endswith(b"\n"): 
+                break
+            record = json.loads(line)
+            lemmas[record["key"]] = record["lemmas"]
+            end += len(line)
+        f.truncate(end)
+    return lemmas
+
+
+def preprocess_documents(documents: List[str], custom_stopwords=[], test_first_k = None, keys = None, output_path = None, 
+                         batch_size = LEMMATIZE_BATCH_SIZE, n_process = 1):     
+    """
+    Lemmas (without stopwords) of every document, lemmatized in batches of batch_size documents by n_process spaCy processes. 
+    If output_path is given, every result is appended to this JSONL file as {"key": ..., "lemmas": [...]} as soon as it is done, 
+    and documents whose key is already in the file are not processed again, so an interrupted run continues where it stopped. 
+    keys: one key per document (e.g. the speech ids), defaults to the positions of the documents
+    """
     logging.basicConfig(format ='%(asctime)s : %(levelname)s : %(message)s')
     logging.root.setLevel(level = logging.WARN)
-    nlp = spacy.load("en_core_web_sm", disable=["parser", "ner"])
-
-    def preprocess_document(document):    
-        # tokenize using gensim's default preprocessing
-        tokens = simple_preprocess(document)
-        document = nlp(" ".join(tokens))
-        # lemmatize and remove stopwords 
-        lemmas = [token.lemma_ for token in document if (not token.is_stop) and (not token.lemma_ in custom_stopwords)]
-        return lemmas
 
     if test_first_k: 
         documents = documents[:test_first_k]
-    
-    processed_data = [preprocess_document(doc) for doc in tqdm(documents, "preprocessing")]
-    return processed_data
+    keys = list(range(len(documents))) if keys is None else list(keys)[:len(documents)]
+
+    lemmas = read_lemmas(output_path) if output_path else {}
+    todo = [(document, key) for document, key in zip(documents, keys) if key not in lemmas]
+    if lemmas: 
+        print("Already preprocessed:", len(documents) - len(todo), "of", len(documents), "documents")
+    if not todo: 
+        return [lemmas[key] for key in keys]
+
+    nlp = _load_nlp()
+    # tokenize using gensim's default preprocessing
+    texts = ((" ".join(simple_preprocess(document)), key) for document, key in todo)
+    with (open(output_path, "a") if output_path else contextlib.nullcontext()) as output: 
+        processed = nlp.pipe(texts, as_tuples=True, batch_size=batch_size, n_process=n_process)
+        for i, (document, key) in enumerate(tqdm(processed, "preprocessing", total=len(todo))): 
+            # lemmatize and remove stopwords 
+            lemmas[key] = [token.lemma_ for token in document if (not token.is_stop) and (not token.lemma_ in custom_stopwords)]
+            if output is not None: 
+                output.write(json.dumps({"key": key, "lemmas": lemmas[key]}) + "\n")
+                # at most the current batch is lost when the process dies
+                if (i + 1) % batch_size == 0: 
+                    output.flush()
+    return [lemmas[key] for key in keys]
     
 
-def get_preprocessed_documents(preprocessed_full_path, df = None): 
-    if os.path.exists(preprocessed_full_path): 
-        print("Loading preprocessed data", preprocessed_full_path)
-        preprocessed_data = json.load(open(preprocessed_full_path))
-        # preprocessed_data = [preprocessed_data[i] for i in df_party_members.index.tolist()]  # align with filtered dataframe
-        json.dump(preprocessed_data, open(preprocessed_full_path, "w+"))
-    else: 
-        # if not exists: preprocess once and keep json 
-        preprocessed_data = preprocess_documents(documents = df["translatedText"].tolist())
-        json.dump(preprocessed_data, open(preprocessed_full_path, "w+"))
-    
-    return preprocessed_data 
-
-def fit_models(corpus, dictionary, n_topic_values = {50: [5, 7, 10], 60: [5], 80: [5], 100: [5], 120: [5]}, n_workers = 6):
-    runs = []
-    for n_topics, n_passes_values in n_topic_values.items(): 
-        for n_passes in n_passes_values: 
-            os.makedirs(f"data/lda/screens/{n_topics}_topics/{n_passes}", exist_ok=True)
-            out_path = f"data/lda/screens/{n_topics}_topics/{n_passes}/model.model"
-            workers = n_workers
-
-            print("Fitting model with", n_topics, "topics and", n_passes, "passes")
-            lda_model = LdaMulticore(corpus = corpus, id2word=dictionary, num_topics = n_topics, passes = n_passes, workers=workers)
-            lda_model.save(out_path)
-            
-            runs.append((n_topics, n_passes, lda_model))
-    return runs 
+def get_preprocessed_documents(preprocessed_full_path, df, batch_size = LEMMATIZE_BATCH_SIZE, n_process = 1): 
+    """
+    Lemmas of the speeches in df (in the order of df), keyed by speech id in the JSONL file at preprocessed_full_path, 
+    only the speeches that are not in the file yet are preprocessed
+    """
+    keys = df[SPEECH_ID].tolist() if SPEECH_ID in df.columns else None
+    return preprocess_documents(documents = df["translatedText"].tolist(), keys=keys, output_path=preprocessed_full_path, 
+                                batch_size=batch_size, n_process=n_process)
+
+
+def get_token_store(token_store_path, preprocessed_full_path, df, batch_size = LEMMATIZE_BATCH_SIZE, n_process = 1): 
+    """Token store of the lemmas of the speeches in df, only (re-)written if it does not have exactly these speeches"""
+    keys = df[SPEECH_ID].tolist() if SPEECH_ID in df.columns else list(range(len(df)))
+    if has_token_store(token_store_path): 
+        store = load_token_store(token_store_path)
+        if store["keys"] == keys: 
+            print("Loaded token store", token_store_path)
+            return store
+    preprocessed_data = get_preprocessed_documents(preprocessed_full_path, df, batch_size=batch_size, n_process=n_process)
+    print("Writing token store", token_store_path)
+    return write_token_store(preprocessed_data, keys, token_store_path)
 
 if __name__ == "__main__": 
     """
     Creates multiple LDA models for different topic values and n_passes
     """
 
-    PATH_PREPROCESSED = "data/lda/preprocessed_texts_all_translated.json"
     PATH_DICTIONARY = "data/lda/dictionary_final.d"
     PATH_CORPUS = "data/lda/corpus_final.c"
     PATH_CONFIGS = "data/lda/screen_configs.json"
 
+    optParser = optparse.OptionParser()
+    optParser.add_option('-b', '--batch_size', action='store', type='int',
+                         default=LEMMATIZE_BATCH_SIZE, dest='batch_size',
+                         help='Number of speeches spaCy lemmatizes per batch')
+    optParser.add_option('-n', '--n_process', action='store', type='int',
+                         default=1, dest='n_process',
+                         help='Number of spaCy processes lemmatizing the speeches')
+    optParser.add_option('-w', '--workers_per_job', action='store', type='int',
+                         default=LDA_WORKERS_PER_JOB, dest='workers_per_job',
+                         help='Number of LdaMulticore workers of every model that is fitted')
+    optParser.add_option('-j', '--jobs', action='store', type='int',
+                         default=None, dest='jobs',
+                         help='Number of models fitted at the same time (default: as many as fit on the cores)')
+    optParser.add_option('-t', '--tolerance', action='store', type='float',
+                         default=CONVERGENCE_TOLERANCE, dest='tolerance',
+                         help='Stop training a model once its held-out perplexity improves by less than this share in a pass')
+    optParser.add_option('--no_early_stopping', action='store_true',
+                         default=False, dest='no_early_stopping',
+                         help='Always train all passes of the configs')
+    optParser.add_option('-s', '--seed', action='store', type='int',
+                         default=LDA_RANDOM_STATE, dest='seed',
+                         help='Random state of the fitted models')
+
+    opts, _ = optParser.parse_args()
+
     df = pd.read_parquet(PATH_ALL_SPEECHES)
 
-    preprocessed_data = get_preprocessed_documents(PATH_PREPROCESSED, df)
+    store = get_token_store(PATH_TOKEN_STORE, PATH_PREPROCESSED, df, batch_size=opts.batch_size, n_process=opts.n_process)
 
     configs = json.load(open(PATH_CONFIGS))
 
     print("Creating dictionary")
-    dictionary = corpora.Dictionary(preprocessed_data)
+    # document frequencies of all tokens, cached per token store (try other thresholds with src/lda/dictionary_profile.py)
+    profile = get_profile(PATH_TOKEN_STORE, PATH_DF_PROFILE)
     print("Filtering dictionary")
 
-    n_before_filtering = len(dictionary)
+    n_before_filtering = len(profile["dfs"])
 
     # NOTE: these thresholds were identified manually => see the corresponding notebook to see how
-    
-    dictionary.filter_extremes(
+    thresholds = dict(
         no_below=10,     # Keep tokens appearing in at least 10 speeches
         no_above=0.152,    # Remove tokens appearing in more than 15.2% of speeches
         keep_n=100000    # Here: keep all tokens, because there are only 59173 words in the dictionary
     )
+    # same as to_dictionary(store).filter_extremes(**thresholds)
+    dictionary = filtered_dictionary(profile, store, **thresholds)
+    stats = filter_stats(profile, **thresholds)
 
     n_after_filtering = len(dictionary)
     print("Filtered dictionary: ")
     print("Before:",n_before_filtering)
     print("Now:", n_after_filtering, f"{'%.2f' % (n_after_filtering / n_before_filtering)}") 
-
-    corpus = [dictionary.doc2bow(l) for l in tqdm(preprocessed_data, "Preparing corpus")]
+    print("Kept lemmas:", f"{'%.2f' % stats['token_coverage']}", "empty speeches:", stats["empty_documents"])
 
     dictionary.save(PATH_DICTIONARY)
     print("Saved dictionary to", PATH_DICTIONARY)
-    corpora.MmCorpus.serialize(PATH_CORPUS, corpus)
+    # the models are fitted on the serialized corpus, so it does not have to be kept in memory
+    corpora.MmCorpus.serialize(PATH_CORPUS, tqdm(iter_bows(store, dictionary), "Preparing corpus", total=len(store["keys"])))
     print("Saved corpus to", PATH_CORPUS)
+    if SPEECH_ID in df.columns: 
+        # lets assign_topics join the documents to the speeches by id instead of by position
+        df[[SPEECH_ID]].reset_index(drop=True).to_parquet(PATH_CORPUS_IDS)
+        print("Saved speech ids of the corpus to", PATH_CORPUS_IDS)
+    # the same corpus keyed by speech id, for reading single documents without parsing the MmCorpus
+    write_corpus_store(iter_bows(store, dictionary), store["keys"], PATH_CORPUS_STORE, num_terms=len(dictionary), source_paths=[PATH_CORPUS, PATH_CORPUS_IDS])
+    print("Saved corpus store to", PATH_CORPUS_STORE)
 
     
-    fit_models(corpus, dictionary, configs)
\ No newline at end of file
+    fit_models(PATH_CORPUS, PATH_DICTIONARY, configs, workers_per_job=opts.workers_per_job, n_jobs=opts.jobs,
+               tolerance=None if opts.no_early_stopping else opts.tolerance, random_state=opts.seed)
\ No newline at end of file
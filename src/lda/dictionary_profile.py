@@ -0,0 +1,175 @@
+import itertools
+import optparse
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from gensim import corpora
+
+# assume script is run from project root => path to be able to import src
+sys.path.append(str(Path.cwd()))
+from src.constants import PATH_DF_PROFILE, PATH_TOKEN_STORE
+from src.lda.token_store import load_token_store, token_store_hash
+from src.stage_cache import begin_marked_write, end_marked_write, has_marker, read_marker
+
+"""
+Document frequency profile of the token store, to try thresholds of Dictionary.filter_extremes without building the
+dictionary and corpus again for each of them. The tokens are ranked by document frequency (descending, ties by token id,
+which is the order filter_extremes keeps them in), so the tokens any (no_below, no_above, keep_n) keeps are the ranks
+[a, c): a = number of tokens in more than no_above of the documents, c = a + at most keep_n tokens in at least no_below.
+- vocabulary size: c - a
+- token coverage (share of all lemmas that are kept): from the prefix sums of the collection frequencies in rank order
+- empty documents: a document loses all its tokens iff [a, c) lies in a gap between the ranks of two consecutive of its
+  (sorted) tokens. These gaps (p, q) are kept as one sorted array, grouped by the smallest possible a above p, so the
+  documents with p < a and q >= c are counted with one searchsorted per group.
+
+The profile is computed once per token store and cached in data/lda/df_profile as .npy files.
+"""
+
+PROFILE_ARRAYS = ["ranked_ids", "dfs", "cum_cfs", "boundaries", "gap_keys", "group_starts"]
+META_FILE = "meta.json"
+
+
+def compute_profile(store: dict) -> dict:
+    """Profile (see module docstring) of the documents of the token store"""
+    vocab_size, offsets = len(store["vocab"]), np.asarray(store["offsets"])
+    n_docs = len(offsets) - 1
+    token_ids = np.asarray(store["token_ids"], dtype=np.int64)
+    doc_of_token = np.repeat(np.arange(n_docs, dtype=np.int64), np.diff(offsets))
+
+    # unique tokens of every document, sorted by document
+    doc_tokens = np.unique(doc_of_token * vocab_size + token_ids)
+    unique_docs, unique_ids = doc_tokens // vocab_size, doc_tokens % vocab_size
+    dfs = np.bincount(unique_ids, minlength=vocab_size)
+    cfs = np.bincount(token_ids, minlength=vocab_size)
+
+    # same order as the good ids of filter_extremes: by document frequency, ties by id
+    ranked_ids = np.lexsort((np.arange(vocab_size), -dfs))
+    rank_of = np.empty(vocab_size, dtype=np.int64)
+    rank_of[ranked_ids] = np.arange(vocab_size)
+    ranked_dfs = dfs[ranked_ids]
+
+    # sorted ranks of the tokens of every document, between -1 and vocab_size as sentinels
+    ranks = np.unique(unique_docs * vocab_size + rank_of[unique_ids]) % vocab_size
+    doc_starts = np.searchsorted(unique_docs, np.arange(n_docs))
+    doc_ends = np.searchsorted(unique_docs, np.arange(n_docs), side="right")
+    gap_starts = np.insert(ranks, doc_starts, -1)
+    gap_ends = np.insert(ranks, doc_ends, vocab_size)
+
+    # all values a can take: the ranks at which the document frequency changes
+    boundaries = np.unique(np.concatenate([[0, vocab_size], np.flatnonzero(np.diff(ranked_dfs)) + 1]))
+    groups = np.searchsorted(boundaries, gap_starts, side="right")
+    gap_keys = np.sort(groups * (vocab_size + 1) + gap_ends)
+    group_starts = np.searchsorted(gap_keys, np.arange(len(boundaries) + 1) * (vocab_size + 1))
+
+    return {
+        "ranked_ids": ranked_ids,
+        "dfs": ranked_dfs,
+        "cum_cfs": np.concatenate([[0], np.cumsum(cfs[ranked_ids])]),
+        "boundaries": boundaries,
+        "gap_keys": gap_keys,
+        "group_starts": group_starts,
+        "num_docs": n_docs,
+        "num_pos": len(token_ids),
+        "num_nnz": len(unique_ids),
+    }
+
+
+def write_profile(profile: dict, path: str, store_hash: str | None = None):
+    begin_marked_write(path, META_FILE)
+    for name in PROFILE_ARRAYS:
+        np.save(os.path.join(path, f"{name}.npy"), profile[name])
+    meta = {key: int(profile[key]) for key in ["num_docs", "num_pos", "num_nnz"]}
+    end_marked_write(path, META_FILE, {**meta, "token_store": store_hash})
+
+
+def load_profile(path: str) -> dict:
+    meta = read_marker(path, META_FILE)
+    return {**{name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in PROFILE_ARRAYS}, **meta}
+
+
+def get_profile(token_store_path: str = PATH_TOKEN_STORE, path: str = PATH_DF_PROFILE) -> dict:
+    """Profile of the token store, computed (again) first if it is not cached for exactly these documents"""
+    store_hash = token_store_hash(token_store_path)
+    if not has_marker(path, META_FILE) or read_marker(path, META_FILE)["token_store"] != store_hash:
+        print("Computing document frequency profile of", token_store_path)
+        write_profile(compute_profile(load_token_store(token_store_path)), path, store_hash)
+    return load_profile(path)
+
+
+def _kept_ranks(profile: dict, no_below: int, no_above: float, keep_n: int | None) -> tuple[int, int]:
+    # [a, c) of the ranks filter_extremes keeps, dfs are sorted descending
+    no_above_abs = int(no_above * profile["num_docs"])
+    a = int(np.searchsorted(-profile["dfs"], -no_above_abs, side="left"))
+    b = max(a, int(np.searchsorted(-profile["dfs"], -no_below, side="right")))
+    return a, b if keep_n is None else min(b, a + keep_n)
+
+
+def filter_stats(profile: dict, no_below: int = 5, no_above: float = 0.5, keep_n: int | None = 100000) -> dict:
+    """Vocabulary size, share of the lemmas kept and number of empty documents after filter_extremes(no_below, no_above, keep_n)"""
+    a, c = _kept_ranks(profile, no_below, no_above, keep_n)
+    width = len(profile["dfs"]) + 1
+    # the gaps with a start below a are the ones of the groups up to a, count the ones that end at or after c
+    groups = np.arange(np.searchsorted(profile["boundaries"], a) + 1)
+    counted = profile["group_starts"][groups + 1] - np.searchsorted(profile["gap_keys"], groups * width + c)
+    return {
+        "no_below": no_below,
+        "no_above": no_above,
+        "keep_n": keep_n,
+        "vocabulary_size": c - a,
+        "token_coverage": float(profile["cum_cfs"][c] - profile["cum_cfs"][a]) / profile["num_pos"],
+        "empty_documents": int(counted.sum()),
+    }
+
+
+def filter_grid(profile: dict, no_below_values, no_above_values, keep_n_values=(100000,)) -> pd.DataFrame:
+    """filter_stats of every combination of the given thresholds"""
+    grid = pd.DataFrame([filter_stats(profile, *thresholds) for thresholds in itertools.product(no_below_values, no_above_values, keep_n_values)])
+    # keep_n None (keep all) stays missing instead of turning the column into floats
+    grid["keep_n"] = grid["keep_n"].astype("Int64")
+    return grid
+
+
+def filtered_dictionary(profile: dict, store: dict, no_below: int = 5, no_above: float = 0.5, keep_n: int | None = 100000) -> corpora.Dictionary:
+    """
+    gensim Dictionary of the token store filtered like to_dictionary(store).filter_extremes(no_below, no_above, keep_n),
+    from the profile (the documents are not read again)
+    """
+    a, c = _kept_ranks(profile, no_below, no_above, keep_n)
+    # compactify gives the kept tokens new ids in the order of their old ones
+    kept = np.sort(np.asarray(profile["ranked_ids"][a:c]))
+    rank_of = np.empty(len(profile["ranked_ids"]), dtype=np.int64)
+    rank_of[np.asarray(profile["ranked_ids"])] = np.arange(len(rank_of))
+    cfs = np.diff(np.asarray(profile["cum_cfs"]))
+
+    dictionary = corpora.Dictionary()
+    dictionary.token2id = {token: i for i, token in enumerate(store["vocab"][kept].tolist())}
+    dictionary.dfs = dict(enumerate(profile["dfs"][rank_of[kept]].tolist()))
+    dictionary.cfs = dict(enumerate(cfs[rank_of[kept]].tolist()))
+    # filter_extremes keeps the counts of the unfiltered documents
+    dictionary.num_docs = profile["num_docs"]
+    dictionary.num_pos = profile["num_pos"]
+    dictionary.num_nnz = profile["num_nnz"]
+    return dictionary
+
+
+if __name__ == "__main__":
+    optParser = optparse.OptionParser()
+    optParser.add_option('-b', '--no_below', action='store',
+                         default="5,10,20,50", dest='no_below',
+                         help='Comma separated values of no_below to try')
+    optParser.add_option('-a', '--no_above', action='store',
+                         default="0.1,0.152,0.2,0.5", dest='no_above',
+                         help='Comma separated values of no_above to try')
+    optParser.add_option('-n', '--keep_n', action='store',
+                         default="100000", dest='keep_n',
+                         help='Comma separated values of keep_n to try ("none" to keep all)')
+
+    opts, _ = optParser.parse_args()
+    profile = get_profile()
+    grid = filter_grid(profile, [int(value) for value in opts.no_below.split(",")], [float(value) for value in opts.no_above.split(",")],
+                       [None if value.lower() == "none" else int(value) for value in opts.keep_n.split(",")])
+    print("Tokens:", len(profile["dfs"]), "documents:", profile["num_docs"])
+    print(grid.to_string(index=False))
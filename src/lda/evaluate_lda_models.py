@@ -3,16 +3,27 @@ from gensim.models import LdaMulticore
 from gensim import corpora
 import json 
 import os 
+import sys
+from pathlib import Path
 
-def evaluate_model(lda_model, n_topics, k_words, processed_texts, corpus, dictionary, search_term = "migration", compute_coherence=True): 
+# assume script is run from project root => path to be able to import src
+sys.path.append(str(Path.cwd()))
+from src.constants import PATH_TOKEN_STORE
+from src.lda.lda_grid import read_manifest
+from src.lda.coherence import model_topics, score_models, shared_coherence_model
+
+def evaluate_model(lda_model, n_topics, k_words, processed_texts=None, corpus=None, dictionary=None, search_term = "migration", compute_coherence=True, coherence_score=None, topics=None): 
     """For the LDA model compute: 
     - coherence (a metric in LDA to express whether each word is associated with one topic (desireable, coherence => 1) or many (undesireable, coherence => 0)
     - highest probability that the search term is given in a topic
     - the most frequent position of the search term within the topics (e.g. if search term is most likely word in topic X, its most frequent position will be 0)
     - the indices of topics where the search term is within the k most likely words of that topic
-    
+
+    processed_texts, corpus, dictionary: only needed to compute the coherence
+    coherence_score: coherence computed beforehand (e.g. with src/lda/coherence.py), then it is not computed again
+    topics: lda_model.show_topics(formatted=False, num_topics=n_topics) if already taken, then lda_model is not needed
     """
-    if compute_coherence: 
+    if coherence_score is None and compute_coherence: 
         print("Computing coherence")
         coherence_model = CoherenceModel(
             model=lda_model, 
@@ -22,9 +33,6 @@ def evaluate_model(lda_model, n_topics, k_words, processed_texts, corpus, dictio
             coherence='c_v'  # most common coherence measure
         )
         coherence_score = coherence_model.get_coherence()
-    else: 
-        coherence_score = None 
-        
     
     # for each topic get probability of migration 
     # print k most likely words for 3 topics with highest probability 
@@ -35,7 +43,9 @@ def evaluate_model(lda_model, n_topics, k_words, processed_texts, corpus, dictio
     search_term_highest_pos = float("inf")
     indices_relevant_topics = []
     
-    for topic_index, topic in lda_model.show_topics(formatted=False, num_topics=n_topics):
+    if topics is None: 
+        topics = lda_model.show_topics(formatted=False, num_topics=n_topics)
+    for topic_index, topic in topics:
         topic_words, topic_probs = zip(*topic)
     
         if search_term in topic_words: 
@@ -56,71 +66,98 @@ def evaluate_model(lda_model, n_topics, k_words, processed_texts, corpus, dictio
     print(f"Relevant topics: {indices_relevant_topics} (n: {len(indices_relevant_topics)})")
     return coherence_score, search_term_max_prob, search_term_highest_pos, indices_relevant_topics
 
-def print_topics(model, n_topics, k_words=10):
-    for idx, topic in model.show_topics(formatted=False, num_topics=n_topics):
+def print_topics(topics, k_words=10):
+    """topics: show_topics(formatted=False) of a model"""
+    for idx, topic in topics:
         label = ", ".join([f"{word} ({'%.2f' % prob})" for word, prob in topic[:k_words]])
         print(f"Topic {idx}: {label}")
 
+def find_models(models_path): 
+    """
+    (n_topics, n_passes, model path, fit stats) of the fitted models, from the manifest of the grid (see src/lda/lda_grid.py) 
+    or, for models fitted before there was a manifest, from the folders (e.g. 50_topics/5 for 50 topics and 5 passes)
+    """
+    manifest = read_manifest(models_path)
+    if manifest is not None: 
+        for run in manifest: 
+            if run["status"] == "failed": 
+                print("Skipping model that failed to fit", run["n_topics"], "/", run["n_passes"])
+                continue
+            yield run["n_topics"], run["n_passes"], run["path"], {key: run[key] for key in ("wall_seconds", "peak_rss_mb") if key in run}
+        return
+
+    for folder_n_topics in sorted(os.listdir(models_path)): 
+        if not os.path.isdir(os.path.join(models_path, folder_n_topics)): 
+            continue
+        try: 
+            n_topics = int(folder_n_topics.split("_")[0]) # assume folder is named e.g. 50_topics
+        except: 
+            print("Could not read n_topics, skipping:", folder_n_topics)
+            continue
+        for folder_n_passes in sorted(os.listdir(os.path.join(models_path, folder_n_topics))): 
+            if not os.path.isdir(os.path.join(models_path, folder_n_topics, folder_n_passes)): 
+                continue
+            n_passes = int(folder_n_passes) # assume folder is just named e.g. 5 for 5 passes 
+            model_path = os.path.join(models_path, folder_n_topics, folder_n_passes, "model.model")
+            if not os.path.exists(model_path): 
+                print("Missing model", n_topics, "/", folder_n_passes)
+                continue
+            yield n_topics, n_passes, model_path, {}
+
 if __name__ == "__main__": 
     MODELS_PATH = "data/lda/screens"
     PATH_DICTIONARY = "data/lda/dictionary_final.d"
-    PATH_CORPUS = "data/lda/corpus_final.c"
     COMPARISON_RESULTS_PATH = "data/lda/screens/comparison.json"
-    PATH_PREPROCESSED = "data/lda/preprocessed_texts_all_translated.json"
 
     K_WORDS = 10 # check for relevant keyword (e.g. migration) as being in most probable k words of the topic 
 
     dictionary = corpora.Dictionary.load(PATH_DICTIONARY)
-    corpus = corpora.MmCorpus(PATH_CORPUS)
-    processed_texts = json.load(open(PATH_PREPROCESSED))
 
     # os.makedirs(FINAL_MODEL_PATH, exist_ok=True)
 
     
     best_coherence = 0
-    best_model = None 
+    best_topics = None 
     best_config = None 
 
     stats = []
 
-    for root, folders_n_topics, _ in os.walk(MODELS_PATH): 
-        for folder_n_topics in sorted(folders_n_topics): 
-            try: 
-                n_topics = int(folder_n_topics.split("_")[0]) # assume folder is named e.g. 50_topics
-            except: 
-                print("Could not read n_topics, skipping:", folder_n_topics)
-                continue
-            for _, folders_n_pases, _ in os.walk(os.path.join(root, folder_n_topics)): 
-                for folder_n_passes in sorted(folders_n_pases): 
-                    n_passes = int(folder_n_passes) # assume fjolder is just named e.g. 5 for 5 passes 
-
-                    if not os.path.exists(os.path.join(root, folder_n_topics, folder_n_passes, "model.model")): 
-                        print("Missing model", n_topics, "/", folder_n_passes)
-                        continue
-                    lda_model = LdaMulticore.load(os.path.join(root, folder_n_topics, folder_n_passes, "model.model"))
-                    
-                    print("\n"*2)
-                    print("Evaluating model with", n_topics, "topics and", n_passes, "n_passes")
-
-                    coherence, highest_prob, top_pos, indices_relevant_topics = evaluate_model(lda_model, n_topics, K_WORDS, processed_texts, corpus, dictionary)    
-                    stats.append({
-                        "n_topics": n_topics, 
-                        "n_passes": n_passes,
-                        "coherence": str(coherence),  
-                        "highest_prob": str(highest_prob), 
-                        "top_pos": top_pos, 
-                        "n_relevant_topics": len(indices_relevant_topics)
-                    })
-                    if not (len(indices_relevant_topics) == 1): 
-                        print("Ignoring model because it does not have exactly 1 relevant topic; has:", len(indices_relevant_topics))
-                    else: 
-                        if coherence is not None and coherence > best_coherence: 
-                            best_coherence = coherence
-                            best_model = lda_model 
-                            best_config = (n_topics, n_passes)
+    models = list(find_models(MODELS_PATH))
+    # the coherence of all models is computed from one pass over the texts, so every model is loaded once
+    # to collect its topic words for the coherence and its topics for the evaluation below
+    print("Collecting topic words of", len(models), "models")
+    topics_per_model, shown_topics = [], []
+    for n_topics, _, model_path, _ in models: 
+        lda_model = LdaMulticore.load(model_path)
+        topics_per_model.append(model_topics(lda_model, dictionary))
+        shown_topics.append(lda_model.show_topics(formatted=False, num_topics=n_topics))
+    coherence_model = shared_coherence_model(topics_per_model, PATH_TOKEN_STORE, dictionary)
+    coherences = score_models(coherence_model, topics_per_model)
+
+    for (n_topics, n_passes, model_path, fit_stats), coherence_score, topics in zip(models, coherences, shown_topics): 
+        print("\n"*2)
+        print("Evaluating model with", n_topics, "topics and", n_passes, "n_passes")
+
+        coherence, highest_prob, top_pos, indices_relevant_topics = evaluate_model(None, n_topics, K_WORDS, coherence_score=coherence_score, topics=topics)    
+        stats.append({
+            "n_topics": n_topics, 
+            "n_passes": n_passes,
+            "coherence": str(coherence),  
+            "highest_prob": str(highest_prob), 
+            "top_pos": top_pos, 
+            "n_relevant_topics": len(indices_relevant_topics),
+            **fit_stats,
+        })
+        if not (len(indices_relevant_topics) == 1): 
+            print("Ignoring model because it does not have exactly 1 relevant topic; has:", len(indices_relevant_topics))
+        else: 
+            if coherence is not None and coherence > best_coherence: 
+                best_coherence = coherence
+                best_topics = topics 
+                best_config = (n_topics, n_passes)
         
     if best_config is not None: 
         print("Best model is", best_config, "with coherence:", best_coherence)
         print("Best model topics:")
-        print_topics(best_model, best_config[0], K_WORDS)
+        print_topics(best_topics, K_WORDS)
     json.dump(stats, open(COMPARISON_RESULTS_PATH, "w"))
\ No newline at end of file
@@ -0,0 +1,145 @@
+import json
+import optparse
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+from gensim import matutils
+from gensim.matutils import dirichlet_expectation, mean_absolute_difference
+from gensim.models import LdaMulticore
+
+# assume script is run from project root => path to be able to import src
+sys.path.append(str(Path.cwd()))
+from src.constants import PATH_LDA_ARTIFACT, PATH_MODEL
+from src.stage_cache import begin_marked_write, end_marked_write, file_stamps, has_marker, read_marker
+
+"""
+Inference-only export of an LDA model: unpickling the gensim model loads its whole training state, although assigning
+topics only needs exp(E[log beta]) and alpha, and showing topics only needs the normalized topic-word matrix.
+export_lda_artifact writes these (and eta, the vocabulary and the random state of the model) as .npy files, which
+load_lda_artifact memory-maps, so loading takes milliseconds and worker processes share the pages.
+
+A loaded artifact is a dict with the arrays "topic_word", "exp_elogbeta", "alpha", "eta", the "vocab" (tokens by id),
+"num_topics", "iterations", "gamma_threshold" and the model's "random_state". inference and show_topics give exactly
+the results of LdaModel.inference and LdaModel.show_topics(formatted=False).
+"""
+
+ARRAYS = ["topic_word", "exp_elogbeta", "alpha", "eta"]
+META_FILE = "meta.json"
+
+
+def export_lda_artifact(lda_model, path: str = PATH_LDA_ARTIFACT, model_path: str | None = None):
+    """Write the artifact of lda_model to directory path (model_path: file the model was loaded from, to detect when it changes)"""
+    begin_marked_write(path, META_FILE)
+    lambdas = lda_model.state.get_lambda()
+    arrays = {
+        # normalized like in show_topics
+        "topic_word": np.stack([topic / topic.sum() for topic in lambdas]),
+        "exp_elogbeta": lda_model.expElogbeta,
+        "alpha": lda_model.alpha,
+        "eta": lda_model.eta,
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.asarray(array))
+    with open(os.path.join(path, "vocab.json"), "w") as f:
+        json.dump([lda_model.id2word[i] for i in range(lda_model.num_terms)], f)
+
+    kind, keys, pos, has_gauss, cached_gaussian = lda_model.random_state.get_state()
+    meta = {
+        "num_topics": lda_model.num_topics,
+        "iterations": lda_model.iterations,
+        "gamma_threshold": lda_model.gamma_threshold,
+        "random_state": [kind, keys.tolist(), pos, has_gauss, cached_gaussian],
+        "model": file_stamps([model_path]) if model_path is not None else None,
+    }
+    end_marked_write(path, META_FILE, meta)
+
+
+def is_current(path: str = PATH_LDA_ARTIFACT, model_path: str = PATH_MODEL) -> bool:
+    """Whether the artifact exists and was exported from the model at model_path as it is now"""
+    if not has_marker(path, META_FILE):
+        return False
+    return read_marker(path, META_FILE)["model"] == file_stamps([model_path])
+
+
+def load_lda_artifact(path: str = PATH_LDA_ARTIFACT) -> dict:
+    meta = read_marker(path, META_FILE)
+    kind, keys, pos, has_gauss, cached_gaussian = meta.pop("random_state")
+    random_state = np.random.RandomState()
+    random_state.set_state((kind, np.asarray(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    return {
+        **{name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ARRAYS},
+        "vocab": json.load(open(os.path.join(path, "vocab.json"))),
+        "random_state": random_state,
+        **meta,
+    }
+
+
+def get_lda_artifact(path: str = PATH_LDA_ARTIFACT, model_path: str = PATH_MODEL) -> dict:
+    """Artifact of the model at model_path, exported (again) first if it does not exist or the model changed since"""
+    if not is_current(path, model_path):
+        print("Exporting LDA model", model_path, "to", path)
+        export_lda_artifact(LdaMulticore.load(model_path), path, model_path)
+    return load_lda_artifact(path)
+
+
+def inference(artifact: dict, chunk) -> np.ndarray:
+    """Unnormalized topic distributions (gamma) of the documents (bags of words) of chunk, like LdaModel.inference"""
+    alpha, exp_elogbeta = np.asarray(artifact["alpha"]), artifact["exp_elogbeta"]
+    dtype = exp_elogbeta.dtype
+    epsilon = np.finfo(dtype).eps
+
+    gamma = artifact["random_state"].gamma(100., 1. / 100., (len(chunk), artifact["num_topics"])).astype(dtype, copy=False)
+    exp_elogtheta = np.exp(dirichlet_expectation(gamma))
+    for d, doc in enumerate(chunk):
+        ids = [int(idx) for idx, _ in doc]
+        cts = np.fromiter((cnt for _, cnt in doc), dtype=dtype, count=len(doc))
+        gammad, exp_elogthetad = gamma[d, :], exp_elogtheta[d, :]
+        exp_elogbetad = exp_elogbeta[:, ids]
+        phinorm = np.dot(exp_elogthetad, exp_elogbetad) + epsilon
+        # iterate between gamma and phi until convergence (see LdaModel.inference)
+        for _ in range(artifact["iterations"]):
+            lastgamma = gammad
+            gammad = alpha + exp_elogthetad * np.dot(cts / phinorm, exp_elogbetad.T)
+            exp_elogthetad = np.exp(dirichlet_expectation(gammad))
+            phinorm = np.dot(exp_elogthetad, exp_elogbetad) + epsilon
+            if mean_absolute_difference(gammad, lastgamma) < artifact["gamma_threshold"]:
+                break
+        gamma[d, :] = gammad
+    return gamma
+
+
+def show_topic(artifact: dict, topic_id: int, topn: int = 10) -> list:
+    """(word, probability) of the topn most probable words of the topic, like LdaModel.show_topic"""
+    topic = artifact["topic_word"][topic_id]
+    return [(artifact["vocab"][id], topic[id]) for id in matutils.argsort(topic, topn, reverse=True)]
+
+
+def show_topics(artifact: dict, num_topics: int = 10, num_words: int = 10) -> list:
+    """
+    (topic id, [(word, probability), ...]) of the num_words most probable words of the topics, like
+    LdaModel.show_topics(formatted=False): all topics if num_topics < 0 or >= the number of topics, otherwise the ones
+    with the lowest and highest alpha (without the random jitter of gensim)
+    """
+    if num_topics < 0 or num_topics >= artifact["num_topics"]:
+        chosen_topics = range(artifact["num_topics"])
+    else:
+        sorted_topics = list(matutils.argsort(np.asarray(artifact["alpha"])))
+        chosen_topics = sorted_topics[:num_topics // 2] + sorted_topics[-num_topics // 2:]
+
+    return [(i, show_topic(artifact, i, num_words)) for i in chosen_topics]
+
+
+if __name__ == "__main__":
+    optParser = optparse.OptionParser()
+    optParser.add_option('-m', '--model', action='store',
+                         default=PATH_MODEL, dest='model',
+                         help='LDA model to export')
+    optParser.add_option('-o', '--output', action='store',
+                         default=PATH_LDA_ARTIFACT, dest='output',
+                         help='Directory of the inference-only artifact')
+
+    opts, _ = optParser.parse_args()
+    export_lda_artifact(LdaMulticore.load(opts.model), opts.output, opts.model)
+    print("Exported", opts.model, "to", opts.output)
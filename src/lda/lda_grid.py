@@ -0,0 +1,227 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from gensim import corpora
+from gensim.models import LdaMulticore, ldamulticore
+
+# assume script is run from project root => path to be able to import src
+sys.path.append(str(Path.cwd()))
+from src.constants import PATH_CORPUS_IDS, PATH_CORPUS_STORE
+from src.instrumentation import measure
+from src.lda.corpus_store import document, get_corpus_store, load_corpus_store
+from src.stage_cache import hash_file
+
+"""
+Grid of LDA models for different numbers of topics and passes (see data/lda/screen_configs.json), fitted in parallel
+jobs with early stopping on a held-out perplexity, see fit_models.
+"""
+
+SCREENS_PATH = "data/lda/screens"
+MANIFEST_FILE = "manifest.json"
+PARAMS_FILE = "params.json"
+LDA_WORKERS_PER_JOB = 3
+CURVES_FILE = "curves.json"
+# documents held out from training to measure the perplexity after each pass
+HELD_OUT_EVERY = 20
+# stop when the held-out perplexity improves by less than this share in a pass (None: always train all passes)
+CONVERGENCE_TOLERANCE = 0.005
+# seed of every model of the grid, so a model stopped after k passes is the one fitted with passes=k
+LDA_RANDOM_STATE = 42
+
+
+def screen_path(n_topics: int, n_passes: int, screens_path: str = SCREENS_PATH) -> str:
+    return os.path.join(screens_path, f"{n_topics}_topics", str(n_passes))
+
+
+def dictionary_hash(dictionary: corpora.Dictionary) -> str:
+    # the saved file also contains timestamps (lifecycle events), so only the vocabulary is hashed
+    return hashlib.sha256(json.dumps(dictionary.token2id, sort_keys=True).encode()).hexdigest()
+
+
+def _is_fitted(path: str, params: dict) -> bool:
+    params_path = os.path.join(path, PARAMS_FILE)
+    if not os.path.exists(os.path.join(path, "model.model")) or not os.path.exists(params_path):
+        return False
+    return json.load(open(params_path)) == params
+
+
+def _mean_hellinger(topics: np.ndarray, previous_topics: np.ndarray) -> float:
+    return float(np.sqrt(0.5 * ((np.sqrt(topics) - np.sqrt(previous_topics)) ** 2).sum(axis=1)).mean())
+
+
+class _Converged(Exception):
+    pass
+
+
+class _MonitoredCorpus:
+    """
+    Training corpus of the documents at rows of the (memory-mapped) corpus store, read one document at a time.
+    LdaMulticore has no callbacks, but iterates the corpus once per pass after the previous pass is merged into the
+    model, so the curve of a pass is recorded when the next one starts, and training stops by raising _Converged there.
+    The model is trained in one update over all passes, so the learning rate decays exactly as with passes=n_passes
+    """
+    def __init__(self, store: dict, rows: np.ndarray, lda_model, held_out: list, tolerance: float | None):
+        self.store, self.rows, self.lda_model, self.held_out, self.tolerance = store, rows, lda_model, held_out, tolerance
+        self.curves, self.converged, self.start = [], False, None
+        self.topics = lda_model.get_topics()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        if self.start is not None:
+            self.end_pass()
+        self.start = time.perf_counter()
+        return (document(self.store, i) for i in self.rows)
+
+    def end_pass(self):
+        seconds = time.perf_counter() - self.start
+        previous_topics, self.topics = self.topics, self.lda_model.get_topics()
+        perplexity = float(np.exp2(-self.lda_model.log_perplexity(self.held_out))) if self.held_out else float("nan")
+        self.curves.append({"pass": len(self.curves) + 1, "seconds": seconds, "perplexity": perplexity, "topic_change": _mean_hellinger(self.topics, previous_topics)})
+        if self.tolerance is not None and len(self.curves) > 1 and (self.curves[-2]["perplexity"] - perplexity) / self.curves[-2]["perplexity"] < self.tolerance:
+            self.converged = True
+            raise _Converged()
+
+
+@contextmanager
+def _update_pools():
+    """Record the pool and queues LdaMulticore.update creates in the block, to shut them down when the update is left early"""
+    created = {"pools": [], "queues": []}
+    Pool, Queue = ldamulticore.Pool, ldamulticore.Queue
+
+    def pool(*args, **kwargs):
+        created["pools"].append(Pool(*args, **kwargs))
+        return created["pools"][-1]
+
+    def queue(*args, **kwargs):
+        created["queues"].append(Queue(*args, **kwargs))
+        return created["queues"][-1]
+
+    ldamulticore.Pool, ldamulticore.Queue = pool, queue
+    try:
+        yield created
+    finally:
+        ldamulticore.Pool, ldamulticore.Queue = Pool, Queue
+
+
+def _shut_down(created: dict, children_before: set):
+    # the workers still wait for chunks, the jobs left in the queues are dropped
+    for pool in created["pools"]:
+        pool.terminate()
+        pool.join()
+    for queue in created["queues"]:
+        queue.cancel_join_thread()
+        queue.close()
+    for child in set(multiprocessing.active_children()) - children_before:
+        child.terminate()
+        child.join()
+
+
+def _fit_model(params: dict, corpus_store_path: str, dictionary_path: str, workers: int, path: str) -> dict:
+    """
+    Fit and save the model of one config (in a worker process of the grid), returns its record. With a tolerance, every
+    HELD_OUT_EVERY-th document is held out from training; the held-out perplexity, time and change of the topics (mean
+    Hellinger distance) of every pass are written to curves.json next to the model
+    """
+    with measure(f"lda_{params['n_topics']}_topics_{params['n_passes']}_passes", kind="lda") as record:
+        store = load_corpus_store(corpus_store_path)
+        # only the held-out documents are read into memory, the training documents are read from the mapped store
+        is_held_out = np.arange(len(store["keys"])) % HELD_OUT_EVERY == 0 if params["tolerance"] is not None else np.zeros(len(store["keys"]), dtype=bool)
+        held_out = [bow for bow in (document(store, i) for i in np.flatnonzero(is_held_out)) if bow]
+        dictionary = corpora.Dictionary.load(dictionary_path)
+
+        lda_model = LdaMulticore(id2word=dictionary, num_topics=params["n_topics"], passes=params["n_passes"], workers=workers, random_state=params["random_state"])
+        corpus = _MonitoredCorpus(store, np.flatnonzero(~is_held_out), lda_model, held_out, params["tolerance"])
+        children_before = set(multiprocessing.active_children())
+        with _update_pools() as created:
+            try:
+                lda_model.update(corpus)
+                corpus.end_pass()
+            except _Converged:
+                _shut_down(created, children_before)
+                lda_model.passes = len(corpus.curves)
+        curves = corpus.curves
+
+        os.makedirs(path, exist_ok=True)
+        lda_model.save(os.path.join(path, "model.model"))
+        json.dump(curves, open(os.path.join(path, CURVES_FILE), "w"), indent=2)
+        # written after the model, so a model without it is refitted
+        json.dump(params, open(os.path.join(path, PARAMS_FILE), "w"))
+        record["passes_run"] = len(curves)
+        record["converged"] = corpus.converged
+        record["held_out_perplexity"] = curves[-1]["perplexity"]
+    return record
+
+
+def _write_manifest(runs: list[dict], screens_path: str):
+    # replaced at once, so a crash never leaves a half written manifest
+    tmp_path = os.path.join(screens_path, MANIFEST_FILE + ".tmp")
+    json.dump(sorted(runs, key=lambda run: (run["n_topics"], run["n_passes"])), open(tmp_path, "w"), indent=2, default=str)
+    os.replace(tmp_path, os.path.join(screens_path, MANIFEST_FILE))
+
+
+def fit_models(corpus_path, dictionary_path, n_topic_values = {50: [5, 7, 10], 60: [5], 80: [5], 100: [5], 120: [5]},
+               workers_per_job = LDA_WORKERS_PER_JOB, n_jobs = None, screens_path = SCREENS_PATH, tolerance = CONVERGENCE_TOLERANCE,
+               corpus_store_path = PATH_CORPUS_STORE, corpus_ids_path = PATH_CORPUS_IDS, random_state = LDA_RANDOM_STATE):
+    """
+    Fit an LDA model for every number of topics and (at most) passes in n_topic_values in parallel jobs (default: as many
+    as fit on the cores with workers_per_job workers each), the most expensive ones first, returns the manifest.
+    Every model gets a params.json with its config and the hashes of the corpus and vocabulary; configs whose model exists
+    with the same params are skipped, so an interrupted grid is resumed by running it again. The status, time and peak
+    memory of every config are written to the manifest (data/lda/screens/manifest.json) after each finished job.
+    tolerance: minimum relative improvement of the held-out perplexity per pass to keep training (None: no early stopping)
+    random_state: seed of the models, part of their params
+    """
+    n_jobs = n_jobs or max(1, (os.cpu_count() or 1) // (workers_per_job + 1))
+    os.makedirs(screens_path, exist_ok=True)
+    data_hashes = {"corpus": hash_file(corpus_path), "dictionary": dictionary_hash(corpora.Dictionary.load(dictionary_path))}
+    # converted here once if it is not up to date, the jobs only map it
+    get_corpus_store(corpus_store_path, corpus_path, corpus_ids_path)
+
+    previous_runs = {(run["n_topics"], run["n_passes"]): run for run in read_manifest(screens_path) or []}
+    runs, jobs = [], []
+    for n_topics, n_passes_values in n_topic_values.items():
+        for n_passes in n_passes_values:
+            params = {"n_topics": int(n_topics), "n_passes": int(n_passes), "tolerance": tolerance, "held_out_every": HELD_OUT_EVERY, "random_state": int(random_state), **data_hashes}
+            path = screen_path(params["n_topics"], params["n_passes"], screens_path)
+            run = {"n_topics": params["n_topics"], "n_passes": params["n_passes"], "path": os.path.join(path, "model.model")}
+            if _is_fitted(path, params):
+                print("Already fitted model with", n_topics, "topics and", n_passes, "passes")
+                runs.append({**previous_runs.get((params["n_topics"], params["n_passes"]), run), "status": "skipped"})
+            else:
+                jobs.append((params, path, run))
+    # the time of a model grows with topics * passes, start the longest ones first
+    jobs.sort(key=lambda job: job[0]["n_topics"] * job[0]["n_passes"], reverse=True)
+
+    print(f"Fitting {len(jobs)} models in {n_jobs} jobs with {workers_per_job} workers each")
+    with ProcessPoolExecutor(n_jobs) as pool:
+        futures = {pool.submit(_fit_model, params, corpus_store_path, dictionary_path, workers_per_job, path): run for params, path, run in jobs}
+        for future in as_completed(futures):
+            run = futures[future]
+            try:
+                record = future.result()
+                runs.append({**run, "status": "fitted", **{key: value for key, value in record.items() if key not in ("name", "kind", "thread")}})
+                print(f"Fitted model with {run['n_topics']} topics and {record['passes_run']} of {run['n_passes']} passes in {record['wall_seconds']:.0f}s"
+                      f" (held-out perplexity {record['held_out_perplexity']:.1f})")
+            except Exception:
+                runs.append({**run, "status": "failed", "error": traceback.format_exc()})
+                print(f"Failed to fit model with {run['n_topics']} topics and {run['n_passes']} passes:\n{traceback.format_exc()}")
+            _write_manifest(runs, screens_path)
+    _write_manifest(runs, screens_path)
+    return runs
+
+
+def read_manifest(screens_path: str = SCREENS_PATH) -> list[dict] | None:
+    """Runs of the last grid (see fit_models), None if there is no manifest"""
+    path = os.path.join(screens_path, MANIFEST_FILE)
+    return json.load(open(path)) if os.path.exists(path) else None
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import sys
+from array import array
+from pathlib import Path
+
+import numpy as np
+from gensim import corpora
+
+# assume script is run from project root => path to be able to import src
+sys.path.append(str(Path.cwd()))
+from src.stage_cache import begin_marked_write, end_marked_write, has_marker, read_marker
+
+"""
+Token store of the lemmatized speeches: instead of a JSON list of lists of strings, every document is stored as the ids
+of its tokens in one flat int32 array (token_ids.npy), with offsets.npy giving where each document starts and ends
+(document i is token_ids[offsets[i]:offsets[i + 1]]), next to the shared vocabulary (vocab.json) and the keys of the
+documents (keys.json, e.g. their speech ids).
+
+The arrays are memory-mapped when loading, so a store is opened without parsing a single token, and processes share its pages.
+Token ids are assigned in the same order as gensim's Dictionary (new tokens of a document in sorted order), so
+to_dictionary(store) equals corpora.Dictionary(documents) without another pass over the strings.
+
+A loaded store is a dict with "vocab" (numpy array of the tokens), "token_ids", "offsets" and "keys".
+"""
+
+TOKEN_IDS_FILE = "token_ids.npy"
+OFFSETS_FILE = "offsets.npy"
+VOCAB_FILE = "vocab.json"
+KEYS_FILE = "keys.json"
+
+
+def write_token_store(documents, keys, path: str) -> dict:
+    """Write the documents (lists of tokens) with their keys to the token store in directory path, returns the loaded store"""
+    begin_marked_write(path, KEYS_FILE)
+    token2id = {}
+    token_ids, offsets = array("i"), array("q", [0])
+    for document in documents:
+        # same order as Dictionary.doc2bow(allow_update=True)
+        for token in sorted(set(document) - token2id.keys()):
+            token2id[token] = len(token2id)
+        token_ids.extend(token2id[token] for token in document)
+        offsets.append(len(token_ids))
+
+    np.save(os.path.join(path, TOKEN_IDS_FILE), np.frombuffer(token_ids, dtype=np.int32))
+    np.save(os.path.join(path, OFFSETS_FILE), np.frombuffer(offsets, dtype=np.int64))
+    with open(os.path.join(path, VOCAB_FILE), "w") as f:
+        json.dump(list(token2id), f)
+    end_marked_write(path, KEYS_FILE, list(keys))
+    return load_token_store(path)
+
+
+def has_token_store(path: str) -> bool:
+    return has_marker(path, KEYS_FILE)
+
+
+def token_store_hash(path: str) -> str:
+    """Content hash of the documents of the store (not of their keys)"""
+    h = hashlib.sha256()
+    for file in (TOKEN_IDS_FILE, OFFSETS_FILE, VOCAB_FILE):
+        with open(os.path.join(path, file), "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def load_token_store(path: str) -> dict:
+    return {
+        "vocab": np.array(json.load(open(os.path.join(path, VOCAB_FILE))), dtype=object),
+        "token_ids": np.load(os.path.join(path, TOKEN_IDS_FILE), mmap_mode="r"),
+        "offsets": np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r"),
+        "keys": read_marker(path, KEYS_FILE),
+    }
+
+
+def document_ids(store: dict, i: int) -> np.ndarray:
+    """Token ids of document i (a view into the memory-mapped array)"""
+    return store["token_ids"][store["offsets"][i]:store["offsets"][i + 1]]
+
+
+def iter_documents(store: dict, positions=None):
+    """Tokens of the documents at the given positions (default: all), e.g. as texts for gensim"""
+    for i in range(len(store["keys"])) if positions is None else positions:
+        yield store["vocab"][document_ids(store, i)].tolist()
+
+
+def to_dictionary(store: dict) -> corpora.Dictionary:
+    """gensim Dictionary of the documents of the store, computed from the token ids"""
+    vocab, token_ids, offsets = store["vocab"], store["token_ids"], store["offsets"]
+    dfs = np.zeros(len(vocab), dtype=np.int64)
+    for i in range(len(offsets) - 1):
+        dfs[np.unique(token_ids[offsets[i]:offsets[i + 1]])] += 1
+    cfs = np.bincount(token_ids, minlength=len(vocab))
+
+    dictionary = corpora.Dictionary()
+    dictionary.token2id = {token: i for i, token in enumerate(vocab)}
+    dictionary.dfs = dict(enumerate(dfs.tolist()))
+    dictionary.cfs = dict(enumerate(cfs.tolist()))
+    dictionary.num_docs = len(offsets) - 1
+    dictionary.num_pos = len(token_ids)
+    dictionary.num_nnz = int(dfs.sum())
+    return dictionary
+
+
+def iter_bows(store: dict, dictionary: corpora.Dictionary, positions=None):
+    """Bag of words of the documents like dictionary.doc2bow(tokens), for a dictionary with (a subset of) the tokens of the store"""
+    store_ids = {token: i for i, token in enumerate(store["vocab"])}
+    # token id in the store => id in the dictionary, -1 for tokens that were filtered out
+    mapping = np.full(len(store["vocab"]), -1, dtype=np.int64)
+    for token, token_id in dictionary.token2id.items():
+        if token in store_ids:
+            mapping[store_ids[token]] = token_id
+    for i in range(len(store["keys"])) if positions is None else positions:
+        ids = mapping[document_ids(store, i)]
+        ids, counts = np.unique(ids[ids >= 0], return_counts=True)
+        yield list(zip(ids.tolist(), counts.tolist()))
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from gensim import corpora
+from gensim.models import LdaModel, LdaMulticore
+
+# assume script is run from project root => path to be able to import src
+sys.path.append(str(Path.cwd()))
+from src.constants import PATH_LDA_VERSIONS, PATH_MODEL
+from src.stage_cache import begin_marked_write, companion_files, end_marked_write, files_hash, has_marker, read_marker
+
+"""
+Online update of the final LDA model with newly ingested speeches (see ingest_incremental.py --update_lda), saved as
+versions in data/lda/final_model/versions instead of fitting and selecting the models again (see update_model).
+"""
+
+UPDATE_PASSES = 1
+VERSION_FILE = "version.json"
+MODEL_FILE = "model.model"
+DICTIONARY_FILE = "dictionary.d"
+# out-of-vocabulary lemmas kept in version.json
+N_OOV_TOKENS = 50
+
+
+def extend_dictionary(dictionary: corpora.Dictionary, documents: list[list[str]]) -> Counter:
+    """
+    Add the document statistics of the documents to the dictionary without adding tokens, returns the counts of the unknown lemmas.
+    The vocabulary stays frozen, so the token ids (and the columns of the topic-word matrix) stay as they are
+    """
+    oov = Counter()
+    for document in documents:
+        counts = Counter(document)
+        for token, count in counts.items():
+            if token in dictionary.token2id:
+                token_id = dictionary.token2id[token]
+                dictionary.dfs[token_id] = dictionary.dfs.get(token_id, 0) + 1
+                dictionary.cfs[token_id] = dictionary.cfs.get(token_id, 0) + count
+            else:
+                oov[token] += count
+        dictionary.num_docs += 1
+        # like filter_extremes, the counts of all lemmas are kept and not only of the known ones
+        dictionary.num_pos += len(document)
+        dictionary.num_nnz += len(counts)
+    return oov
+
+
+def list_versions(versions_path: str = PATH_LDA_VERSIONS) -> list[int]:
+    if not os.path.isdir(versions_path):
+        return []
+    return sorted(int(name) for name in os.listdir(versions_path) if name.isdigit() and has_marker(os.path.join(versions_path, name), VERSION_FILE))
+
+
+def version_path(version: int, versions_path: str = PATH_LDA_VERSIONS) -> str:
+    return os.path.join(versions_path, str(version))
+
+
+def read_version(version: int, versions_path: str = PATH_LDA_VERSIONS) -> dict:
+    return read_marker(version_path(version, versions_path), VERSION_FILE)
+
+
+def version_model_path(version: int, versions_path: str = PATH_LDA_VERSIONS) -> str:
+    return os.path.join(version_path(version, versions_path), MODEL_FILE)
+
+
+def _find_version(versions_path: str, **fields) -> int | None:
+    # newest version whose info has the given values
+    for version in reversed(list_versions(versions_path)):
+        info = read_version(version, versions_path)
+        if all(info.get(key) == value for key, value in fields.items()):
+            return version
+    return None
+
+
+def _copy_model(from_path: str, to_path: str):
+    for old in companion_files(to_path):
+        os.remove(old)
+    for file in companion_files(from_path):
+        shutil.copy(file, to_path + file[len(from_path):])
+
+
+def _save_version(lda_model, dictionary: corpora.Dictionary, info: dict, versions_path: str) -> str:
+    """Save the version (lda_model: the model, or the path of a saved model to copy), returns its directory"""
+    path = version_path(info["version"], versions_path)
+    begin_marked_write(path, VERSION_FILE)
+    if isinstance(lda_model, str):
+        _copy_model(lda_model, os.path.join(path, MODEL_FILE))
+    else:
+        lda_model.save(os.path.join(path, MODEL_FILE))
+    dictionary.save(os.path.join(path, DICTIONARY_FILE))
+    # for a copied model the same as of the original, identifies the base version of a fitted model
+    info["model_hash"] = files_hash([os.path.join(path, MODEL_FILE)])
+    end_marked_write(path, VERSION_FILE, info, indent=2)
+    return path
+
+
+def topic_drift(lda_model, previous_model) -> np.ndarray:
+    """Hellinger distance between the word distributions of every topic of the two models"""
+    drift, _ = lda_model.diff(previous_model, distance="hellinger", diagonal=True, annotation=False, normed=False)
+    return drift
+
+
+def _documents_hash(documents: list[list[str]]) -> str:
+    return hashlib.sha256(json.dumps(documents).encode()).hexdigest()
+
+
+def base_version(model_path: str = PATH_MODEL, dictionary_path: str | None = None, versions_path: str = PATH_LDA_VERSIONS) -> int:
+    """
+    Version of the fitted model at model_path (with its dictionary at dictionary_path), a copy of it is saved as a new
+    version without parent first if there is none. The fitted model itself is never replaced
+    """
+    model_hash = files_hash([model_path])
+    version = _find_version(versions_path, parent=None, model_hash=model_hash)
+    if version is None:
+        versions = list_versions(versions_path)
+        version = versions[-1] + 1 if versions else 0
+        print("Keeping the fitted LDA model as version", version)
+        _save_version(model_path, corpora.Dictionary.load(dictionary_path),
+                      {"version": version, "parent": None, "created": datetime.now().isoformat(), "source": model_path, "n_documents": 0}, versions_path)
+    return version
+
+
+def update_model(documents: list[list[str]], parent: int, versions_path: str = PATH_LDA_VERSIONS,
+                 source: str | None = None) -> tuple[LdaModel, corpora.Dictionary, dict]:
+    """
+    Update the model of version parent (see base_version for the fitted model) with the documents (lemmas of new speeches)
+    in UPDATE_PASSES online passes and save it as a new version, returns the updated model, its dictionary and the info of
+    the version (parent, number of new speeches, most frequent out-of-vocabulary lemmas for the next full refit and the
+    topic drift, see topic_drift). Nothing is installed, the caller keeps track of the current version. If parent was updated with the same documents
+    before, that version is returned. source: where the documents come from (e.g. the increment), kept in the version
+    """
+    documents_hash = _documents_hash(documents)
+    existing = _find_version(versions_path, parent=parent, documents_hash=documents_hash)
+    if existing is not None:
+        print(f"LDA model version {parent} was already updated with these speeches as version {existing}")
+        return (LdaMulticore.load(version_model_path(existing, versions_path)),
+                corpora.Dictionary.load(os.path.join(version_path(existing, versions_path), DICTIONARY_FILE)), read_version(existing, versions_path))
+
+    dictionary = corpora.Dictionary.load(os.path.join(version_path(parent, versions_path), DICTIONARY_FILE))
+    previous_model = LdaMulticore.load(version_model_path(parent, versions_path))
+    lda_model = LdaMulticore.load(version_model_path(parent, versions_path))
+
+    oov = extend_dictionary(dictionary, documents)
+    bows = [bow for bow in (dictionary.doc2bow(document) for document in documents) if bow]
+    print(f"Updating LDA model version {parent} with {len(bows)} speeches")
+    # one online update in this process, the pool of LdaMulticore.update does not pay off for the few new speeches
+    LdaModel.update(lda_model, bows, passes=UPDATE_PASSES)
+
+    drift = topic_drift(lda_model, previous_model)
+    n_lemmas = sum(len(document) for document in documents)
+    info = {
+        # after all versions, also the ones of failed ingests that never became current
+        "version": list_versions(versions_path)[-1] + 1,
+        "parent": parent,
+        "created": datetime.now().isoformat(),
+        "source": source,
+        "documents_hash": documents_hash,
+        "n_documents": len(bows),
+        "n_lemmas": n_lemmas,
+        "oov_share": sum(oov.values()) / max(n_lemmas, 1),
+        "oov_tokens": oov.most_common(N_OOV_TOKENS),
+        "topic_drift": drift.tolist(),
+        "mean_topic_drift": float(drift.mean()),
+        "max_topic_drift": float(drift.max()),
+    }
+    _save_version(lda_model, dictionary, info, versions_path)
+    print(f"Saved LDA model version {info['version']} (mean topic drift {info['mean_topic_drift']:.4f}, max {info['max_topic_drift']:.4f})")
+    return lda_model, dictionary, info
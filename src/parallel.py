@@ -0,0 +1,66 @@
+import itertools
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+
+# number of worker processes used by the text cleaning steps, change with set_n_workers (e.g. preprocess_data.py --workers)
+N_WORKERS = os.cpu_count() or 1
+# below this number of rows per worker, starting the pool costs more than it saves
+MIN_ROWS_PER_WORKER = 2000
+# split the rows into more shards than workers so that slow shards (long speeches) do not stall the pool
+SHARDS_PER_WORKER = 4
+# start method of the process pools: steps run concurrently in threads (see src/pipeline.py), and forking while another
+# thread holds a lock (e.g. of the allocator or of logging) can deadlock the child. The fork server is a clean process
+# started once, so func (and its module) has to be importable
+POOL_CONTEXT = multiprocessing.get_context("forkserver")
+
+
+def set_n_workers(n_workers: int):
+    global N_WORKERS
+    N_WORKERS = max(1, int(n_workers))
+
+
+def _serialize(table: pa.Table) -> pa.Buffer:
+    # the IPC stream only contains the rows of the (zero-copy) slice, not the buffers of the whole table
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def _deserialize(buffer: pa.Buffer) -> pa.Table:
+    return pa.ipc.open_stream(buffer).read_all()
+
+
+def _apply_to_shard(func, buffer: pa.Buffer) -> pa.Buffer:
+    shard = _deserialize(buffer)
+    columns = [column.to_pylist() for column in shard.columns]
+    results = [func(*values) for values in zip(*columns)]
+    return _serialize(pa.table({"result": pa.array(results)}))
+
+
+def parallel_apply(func, *columns: pd.Series, n_workers: int | None = None) -> pd.Series:
+    """
+    Row-wise func(*values) over the values of the given columns, like Series.apply but spread over a process pool.
+    Rows are passed to the workers (and results back) as Arrow buffers and the results keep the order and index of the input.
+    func has to be picklable, i.e. defined at module level (or a functools.partial of such a function).
+    """
+    index = columns[0].index
+    n_workers = N_WORKERS if n_workers is None else n_workers
+    n_workers = min(n_workers, len(index) // MIN_ROWS_PER_WORKER)
+
+    if n_workers <= 1:
+        return pd.Series([func(*values) for values in zip(*columns)], index=index, dtype=object)
+
+    table = pa.table({str(i): pa.array(column, from_pandas=True) for i, column in enumerate(columns)})
+    shard_size = math.ceil(len(table) / (n_workers * SHARDS_PER_WORKER))
+    shards = [_serialize(table.slice(offset, shard_size)) for offset in range(0, len(table), shard_size)]
+
+    with ProcessPoolExecutor(n_workers, mp_context=POOL_CONTEXT) as pool:
+        # map returns the results in the order of the shards
+        results = [_deserialize(buffer).column("result").to_pylist() for buffer in pool.map(_apply_to_shard, itertools.repeat(func), shards)]
+    return pd.Series(list(itertools.chain.from_iterable(results)), index=index, dtype=object)
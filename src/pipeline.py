@@ -0,0 +1,170 @@
+"""
+Runs the preprocessing steps as a DAG derived from the columns each step declares to read and write (see declare_step).
+
+Steps keep the order of the list they are given in, but only where it matters: a step depends on an earlier one if it
+reads a column the earlier one writes, writes a column the earlier one reads, or both write the same column.
+Filters write the pseudo-column ROWS, which every step reads, so nothing runs concurrently with a filter.
+Independent steps (e.g. cleaning the text while assigning party blocks) run concurrently in threads, each on a projection
+of the frame to the columns it declares.
+Filters do not copy the frame, it is kept as a lazy frame (see src/lazy_frame.py) that only gathers the remaining rows
+for the columns a step reads and once at the end. A step that filters rows itself and then assigns columns has to copy
+the filtered frame (e.g. the empty speeches dropped by remove_repeating_greetings).
+
+The output of each step is cached as a delta (its written columns and, for filters, the remaining rows) under a key
+derived from the step's code and the content hashes of the outputs of the steps that last wrote the columns it reads,
+so changing one step only invalidates the steps that (transitively) read its output, and only if the output changed.
+The keys are derived from the actual outputs and not from the keys of the earlier steps, so a step that is re-run
+(e.g. with --only) and gives a different output invalidates the steps reading it, too.
+"""
+
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pandas as pd
+
+from src.stage_cache import step_fingerprint, has_cached_step, load_cached_step, save_cached_step, cached_step_hash
+from src.instrumentation import measure, add_frame_stats
+from src.lazy_frame import lazy_frame, lazy_project, lazy_materialize, lazy_filter, lazy_assign
+
+# pseudo-column of the rows of the frame: written by steps that remove rows, read by every step
+ROWS = "rows"
+# number of independent steps run at the same time
+MAX_CONCURRENT_STEPS = 4
+
+
+def declare_step(reads: list[str] | None = None, writes: list[str] | None = None, filters: bool = False):
+    """Decorator declaring the columns a preprocessing step reads and writes, and whether it removes rows"""
+    def decorate(process):
+        process.reads = [*(reads or []), ROWS]
+        process.writes = [*(writes or []), *([ROWS] if filters else [])]
+        return process
+    return decorate
+
+
+def step_name(process) -> str:
+    return process.__name__
+
+
+def step_dependencies(steps: list) -> list[set[int]]:
+    """For every step, the earlier steps it has to wait for (read-after-write, write-after-read and write-after-write)"""
+    dependencies = []
+    for j, later in enumerate(steps):
+        reads, writes = set(later.reads), set(later.writes)
+        dependencies.append({
+            i for i, earlier in enumerate(steps[:j])
+            if writes & set(earlier.reads) or (reads | writes) & set(earlier.writes)
+        })
+    return dependencies
+
+
+def last_writers(steps: list) -> list[dict]:
+    """For every step, the earlier step that last wrote each column it reads (None for columns of the input)"""
+    last_writer = {}
+    writers = []
+    for i, process in enumerate(steps):
+        writers.append({column: last_writer.get(column) for column in set(process.reads)})
+        for column in process.writes:
+            last_writer[column] = i
+    return writers
+
+
+def step_cache_key(process, input_hashes: dict) -> str:
+    """
+    Merkle key of the output of a step: hash of the step's fingerprint and of the content hashes of the outputs
+    each column it reads comes from (the key of the input for columns no earlier step writes)
+    """
+    return hashlib.sha256(repr([step_fingerprint(process), sorted(input_hashes.items())]).encode()).hexdigest()
+
+
+def _project(frame: dict, process) -> pd.DataFrame:
+    return lazy_project(frame, [*process.reads, *process.writes])
+
+
+def _run_step(process, df: pd.DataFrame) -> pd.DataFrame:
+    n_before = len(df)
+    with measure(step_name(process), kind="step", df_in=df) as record:
+        df = process(df)
+        add_frame_stats(record, df, "out")
+    delta_n = n_before - len(df)
+    if not (delta_n == 0):
+        print(f"Removed {delta_n} rows ({'%.2f' % (delta_n / n_before)})")
+    return df[[column for column in df.columns if column in process.writes]]
+
+
+def _apply_delta(frame: dict, delta: pd.DataFrame, process) -> dict:
+    if ROWS in process.writes:
+        frame = lazy_filter(frame, delta.index)
+    return lazy_assign(frame, delta)
+
+
+def select_steps(steps: list, only: list[str] | None = None, from_step: str | None = None) -> set[int]:
+    """Indices of the steps to re-run regardless of the cache: the steps named in only, or from_step and all steps after it"""
+    names = [step_name(process) for process in steps]
+    for name in [*(only or []), *([from_step] if from_step else [])]:
+        if name not in names:
+            raise ValueError(f"Unknown step {name}, expected one of {names}")
+    selected = set()
+    if only:
+        selected |= {names.index(name) for name in only}
+    if from_step:
+        selected |= set(range(names.index(from_step), len(steps)))
+    return selected
+
+
+def run_pipeline(df: pd.DataFrame, steps: list, input_key: str, force: set[int] | None = None, use_cache: bool = True, max_concurrent: int = MAX_CONCURRENT_STEPS,
+                 outputs: dict | None = None) -> pd.DataFrame:
+    """
+    Apply the steps to df. Steps whose output is cached (and that are not in force) are replayed from the cache,
+    all others run as soon as the steps they depend on are done, up to max_concurrent at the same time.
+    outputs: dict with the names of steps whose output (delta) is needed afterwards as keys, the outputs are stored in it
+    """
+    outputs = {} if outputs is None else outputs
+    force = force or set()
+    dependencies = step_dependencies(steps)
+    writers = last_writers(steps)
+    # content hashes of the outputs of the finished steps, the keys of the steps reading them are derived from these
+    output_hashes, keys = {}, {}
+    input_columns = list(df.columns)
+    frame = lazy_frame(df)
+    done, running = set(), {}
+
+    with ThreadPoolExecutor(max_concurrent) as pool:
+        while len(done) < len(steps):
+            ready = [i for i in range(len(steps)) if i not in done and i not in running.values() and dependencies[i] <= done]
+            for i in ready:
+                keys[i] = step_cache_key(steps[i], {column: input_key if j is None else output_hashes[j] for column, j in writers[i].items()})
+            cached = [i for i in ready if use_cache and i not in force and has_cached_step(keys[i])]
+            if cached:
+                # replaying a delta is cheap, do it before starting anything so the new columns are available
+                for i in cached:
+                    print(f"Loading output of {step_name(steps[i])} from cache")
+                    with measure(step_name(steps[i]), kind="cached"):
+                        delta = load_cached_step(keys[i])
+                        frame = _apply_delta(frame, delta, steps[i])
+                    if step_name(steps[i]) in outputs:
+                        outputs[step_name(steps[i])] = delta
+                    output_hashes[i] = cached_step_hash(keys[i])
+                    done.add(i)
+                continue
+
+            for i in ready:
+                print(f"Running {step_name(steps[i])}")
+                running[pool.submit(_run_step, steps[i], _project(frame, steps[i]))] = i
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                delta = future.result()
+                output_hashes[i] = save_cached_step(keys[i], delta)
+                frame = _apply_delta(frame, delta, steps[i])
+                if step_name(steps[i]) in outputs:
+                    outputs[step_name(steps[i])] = delta
+                done.add(i)
+
+    with measure("materialize", kind="pipeline") as record:
+        df = lazy_materialize(frame)
+        record["bytes_saved"] = frame["bytes_saved"]
+    print(f"Filtering without copying the frame saved {frame['bytes_saved'] / 1e6:.1f} MB")
+    # new columns in the order of the steps writing them, independent of which concurrent step finished first
+    new_columns = [column for process in steps for column in process.writes if column in df.columns and column not in input_columns]
+    return df[[column for column in input_columns if column in df.columns] + list(dict.fromkeys(new_columns))]
@@ -1,15 +1,24 @@
 #%% 
 import pandas as pd 
-from tqdm import tqdm
 import optparse
+import contextlib
+import os
+from functools import partial, update_wrapper
 import sys
 from pathlib import Path
 
 # assume script is run from project root => path to be able to import src
 sys.path.append(str(Path.cwd()))
 
-from preprocessing import add_party_orientation_year_agenda, keep_relevant_legislation_years, remove_commentary, remove_duplicate_speeches, remove_non_party_speeches, remove_repeating_greetings, remove_repeating_endings, rename_party_duplicates, assign_topics
-from src.constants import PATH_TRANSLATED_DATA, PATH_ALL_SPEECHES, PATH_MIGRATION_SPEECHES, N_TOPICS
+from preprocessing import add_party_orientation_year_agenda, keep_relevant_legislation_years, remove_commentary, segment_sentences, remove_duplicate_speeches, remove_non_party_speeches, remove_repeating_greetings, remove_repeating_endings, rename_party_duplicates, assign_topics
+from preprocessing import find_near_duplicate_speeches, remove_near_duplicate_speeches, near_duplicate_report, NEAR_DUPLICATE_COLUMNS
+from src.constants import PATH_TRANSLATED_DATA, PATH_ALL_SPEECHES, PATH_MIGRATION_SPEECHES, PATH_DUPLICATE_CLUSTERS, PATH_RUN_REPORTS, N_TOPICS
+from preprocess_streaming import preprocess_streaming, STREAMING_TFIDF_BACKEND
+from src.parallel import set_n_workers
+from src.stage_cache import hash_file
+from src.pipeline import run_pipeline, select_steps
+from src.instrumentation import measure, add_frame_stats, sampling_profiler, write_run_report, run_id
+from src.schema import apply_schema, add_speech_ids
 # TODO: run through all scripts in preprocessing folder and manipulate df, then output cleaned df
 # TODO: is there a smarter way to do this that is less tedious? 
 # TODO: remove empty text / text of certain length ? 
@@ -21,15 +30,6 @@ def save_df(dataframe, path):
         dataframe.to_parquet(path)
     else: 
         raise ValueError(f"Unknown output file ending {path}")
-    
-def step(dataframe, process): 
-    n_before = len(dataframe) 
-    dataframe = process(dataframe)
-    n_now = len(dataframe) 
-    delta_n = n_before - n_now
-    if not (delta_n == 0): 
-        print(f"Removed {delta_n} rows ({'%.2f' % (delta_n / n_before)})")
-    return dataframe
 
 def main(): 
     optParser = optparse.OptionParser()
@@ -43,19 +43,109 @@ def main():
     optParser.add_option('-r', '--relevance_threshold', action="store",
                          default=0.25, dest="relevance_threshold", help="Probability threshold to label a speech as covering migration")
 
+    optParser.add_option('-n', '--no_cache', action='store_true',
+                         default=False, dest='no_cache',
+                         help='Re-run all steps instead of loading unchanged steps from the stage cache')
+
+    optParser.add_option('--only', action='store',
+                         default=None, dest='only',
+                         help='Comma-separated names of steps to re-run, all other steps are loaded from the stage cache if possible')
+
+    optParser.add_option('--from', action='store',
+                         default=None, dest='from_step',
+                         help='Name of the step from which on all steps are re-run, the steps before it are loaded from the stage cache if possible')
+
+    optParser.add_option('-s', '--streaming', action='store_true',
+                         default=False, dest='streaming',
+                         help='Process the dataset in chunks of rows instead of loading it into memory at once')
+
+    optParser.add_option('--chunk_rows', action='store', type='int',
+                         default=20000, dest='chunk_rows',
+                         help='Number of rows per chunk in streaming mode')
+
+    optParser.add_option('-w', '--workers', action='store', type='int',
+                         default=None, dest='workers',
+                         help='Number of worker processes for the text cleaning steps (default: number of cores)')
+
+    optParser.add_option('--tfidf_backend', action='store', type='choice', choices=['exact', 'hashed'],
+                         default=None, dest='tfidf_backend',
+                         help='TF-IDF vectorizer scoring the repeating sentences: exact (in-memory vocabulary) or hashed (constant memory, approximate). Default: exact, hashed with --streaming')
+
+    optParser.add_option('-d', '--near_duplicates', action='store_true',
+                         default=False, dest='near_duplicates',
+                         help='Also remove near-duplicate speeches (MinHash LSH), writing the clusters to ' + PATH_DUPLICATE_CLUSTERS)
+
+    optParser.add_option('--duplicate_threshold', action='store', type='float',
+                         default=0.9, dest='duplicate_threshold',
+                         help='Jaccard similarity of the word 5-grams above which speeches count as near-duplicates')
+
+    optParser.add_option('--profile', action='store_true',
+                         default=False, dest='profile',
+                         help='Sample the Python stacks while preprocessing and write them in collapsed (flamegraph) format next to the run report')
+
     opts, _ = optParser.parse_args()
+    if opts.streaming and opts.near_duplicates: 
+        optParser.error("--near_duplicates is not supported in streaming mode")
+
+    if opts.workers is not None: 
+        set_n_workers(opts.workers)
+
+    preprocessing_steps = build_steps(opts)
+    try: 
+        force = select_steps(preprocessing_steps, only=opts.only.split(",") if opts.only else None, from_step=opts.from_step)
+    except ValueError as e: 
+        optParser.error(str(e))
+
+    # wall/cpu time, memory, rows and bytes of every step are recorded in a run report (see src/instrumentation.py)
+    profile = sampling_profiler(os.path.join(PATH_RUN_REPORTS, f"{run_id()}.folded")) if opts.profile else contextlib.nullcontext()
+    with profile: 
+        preprocess(opts, preprocessing_steps, force)
+    write_run_report(options=vars(opts))
+
+
+def build_steps(opts): 
+    # the steps declare the columns they read and write (see src/pipeline.py), the order below only matters
+    # between steps touching the same columns, e.g. "add party orientation blocks" uses the party names before "rename party duplicates"
+    preprocessing_steps = [remove_non_party_speeches, keep_relevant_legislation_years, remove_duplicate_speeches, add_party_orientation_year_agenda, rename_party_duplicates, remove_commentary, segment_sentences, remove_repeating_greetings, remove_repeating_endings, assign_topics]
+    # options of single steps are bound to them, bound arguments are part of the stage cache keys
+    step_options = {}
+    if opts.tfidf_backend not in (None, "exact"): 
+        step_options[remove_repeating_greetings] = step_options[remove_repeating_endings] = dict(backend=opts.tfidf_backend)
+    if opts.near_duplicates: 
+        position = preprocessing_steps.index(remove_duplicate_speeches) + 1
+        preprocessing_steps[position:position] = [find_near_duplicate_speeches, remove_near_duplicate_speeches]
+        step_options[find_near_duplicate_speeches] = dict(threshold=opts.duplicate_threshold)
+    return [update_wrapper(partial(process, **step_options[process]), process) if process in step_options else process 
+            for process in preprocessing_steps]
+
+
+def preprocess(opts, preprocessing_steps, force): 
+    if opts.streaming: 
+        with measure("preprocess_streaming", kind="pipeline"): 
+            preprocess_streaming(PATH_TRANSLATED_DATA, PATH_ALL_SPEECHES, chunk_rows=opts.chunk_rows, 
+                                 path_migration=PATH_MIGRATION_SPEECHES if opts.lda_finished else None, 
+                                 topic_id=int(opts.topic_id), relevance_threshold=float(opts.relevance_threshold), tfidf_backend=opts.tfidf_backend or STREAMING_TFIDF_BACKEND)
+        return 
 
     print("Reading dataset")
-    df = pd.read_parquet(PATH_TRANSLATED_DATA)
-    # order of application matters! e.g. "rename party duplicates" should be run before "add party orientation blocks"
-    preprocessing_steps = [remove_non_party_speeches, keep_relevant_legislation_years, remove_duplicate_speeches, add_party_orientation_year_agenda, rename_party_duplicates, remove_commentary, remove_repeating_greetings, remove_repeating_endings, assign_topics]
+    with measure("read_dataset", kind="io") as record: 
+        # party, date, agenda as categoricals and the speech ids the later stages join on (see src/schema.py)
+        df = apply_schema(add_speech_ids(pd.read_parquet(PATH_TRANSLATED_DATA)))
+        add_frame_stats(record, df, "out")
+    print(f"Starting with {len(df)} rows and {len(df.columns)} columns")
 
-    n_columns_before = len(df.columns)
-    n_before = len(df)
-    print(f"Starting with {n_before} rows and {n_columns_before} columns")
-    
-    for process in tqdm(preprocessing_steps, "Preprocessing data"): 
-        df = step(df, process)
+    # each step's output is cached under a key derived from the input and the code of the steps it depends on,
+    # so only the steps reading the output of a changed one have to be re-run
+    outputs = {"find_near_duplicate_speeches": None} if opts.near_duplicates else {}
+    speeches = df
+    df = run_pipeline(df, preprocessing_steps, hash_file(PATH_TRANSLATED_DATA), force=force, use_cache=not opts.no_cache, outputs=outputs)
+    if opts.near_duplicates: 
+        # the metadata of the removed speeches is taken from the speeches as read
+        report = near_duplicate_report(outputs["find_near_duplicate_speeches"], speeches)
+        os.makedirs(os.path.dirname(PATH_DUPLICATE_CLUSTERS), exist_ok=True)
+        report.to_parquet(PATH_DUPLICATE_CLUSTERS)
+        print(f"Wrote {report['cluster'].nunique()} clusters of near-duplicate speeches to {PATH_DUPLICATE_CLUSTERS}")
+        df = df.drop(columns=NEAR_DUPLICATE_COLUMNS)
 
     print(f"Done. Now have {len(df)} rows and {len(df.columns)} columns")
     
@@ -0,0 +1,250 @@
+"""
+Out-of-core variant of preprocess_data.main: the translated speeches are read in chunks of rows and
+every intermediate result is spilled to parquet files, so the speeches are never held in memory at once.
+
+Row-local steps are applied to each chunk directly. The corpus-global steps are reducers over the chunks:
+- remove_duplicate_speeches: keeps hashes of all texts seen so far (first occurrence wins as in the full run)
+- remove_commentary: first pass counts every bracketed comment, second pass removes them with the corpus-wide counts
+- remove_repeating_greetings/_endings: first pass counts the n-gram document frequencies of all sentences
+  (split once by segment_sentences after removing the commentary),
+  second pass scores the first/last sentences, third pass removes the sentences below the percentile cut-off
+
+What remains proportional to the corpus are one hash per speech (8 bytes, kept in a sorted array) and one score per
+speech, but none of the speeches' texts. The n-gram document frequencies take constant memory with the hashed TF-IDF
+backend, which is the default here; with the exact one (as in the in-memory pipeline) they grow with the vocabulary of the
+corpus. With the same backend, the output is identical to the one of the in-memory pipeline.
+"""
+
+import contextlib
+import io
+import itertools
+import os
+import tempfile
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from preprocessing import add_party_orientation_year_agenda, keep_relevant_legislation_years, remove_commentary, remove_non_party_speeches, rename_party_duplicates, assign_topics_, topic_cache_path, load_topic_model, load_topic_cache, save_topic_cache, infer_uncached_topics, join_topics
+from preprocessing.remove_commentary import extract_commentary
+from preprocessing.remove_repeating_sentences import TFIDF_BACKENDS, GREETINGS_PERCENTILE, ENDINGS_PERCENTILE, remove_sentences
+from preprocessing.segment_sentences import segment_sentences, get_sentence_lists
+from src.constants import PATH_STREAMING_SPILL, PATH_CORPUS_IDS, N_TOPICS
+from src.lda.corpus_store import as_corpus
+from src.schema import SPEECH_ID, apply_schema, add_speech_ids
+
+TEXT_COLUMN = "translatedText"
+# first/last sentence of each speech, kept in the spilled chunks between counting and scoring
+BOUNDARY_COLUMN = "_boundary_sentence"
+# the exact backend keeps every distinct n-gram of the corpus in memory
+STREAMING_TFIDF_BACKEND = "hashed"
+
+
+def iter_chunks(path: str, chunk_rows: int, columns: list[str] | None = None):
+    """Read a parquet file in chunks of chunk_rows rows, keeping the row positions of the full file as index"""
+    offset = 0
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=columns):
+        chunk = batch.to_pandas()
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        offset += len(chunk)
+        yield chunk
+
+
+def _to_table(chunk: pd.DataFrame) -> pa.Table:
+    table = pa.Table.from_pandas(chunk, preserve_index=True)
+    # object columns that are all None in this chunk would otherwise get a null type that conflicts with other chunks,
+    # categoricals get the smallest integer type for their codes, which depends on the number of categories in the chunk
+    schema = pa.schema([_chunk_field(field) for field in table.schema], metadata=table.schema.metadata)
+    return table.cast(schema)
+
+
+def _chunk_field(field: pa.Field) -> pa.Field:
+    if pa.types.is_null(field.type):
+        return field.with_type(pa.string())
+    if pa.types.is_dictionary(field.type):
+        return field.with_type(pa.dictionary(pa.int32(), field.type.value_type))
+    return field
+
+
+def _spill(chunks, directory: str) -> list[str]:
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, chunk in enumerate(chunks):
+        path = os.path.join(directory, f"part-{i:05d}.parquet")
+        pq.write_table(_to_table(chunk), path)
+        paths.append(path)
+    return paths
+
+
+def _read_spilled(paths: list[str], columns: list[str] | None = None, desc: str | None = None):
+    for path in tqdm(paths, desc, disable=desc is None):
+        yield pd.read_parquet(path, columns=columns)
+
+
+def _quietly(process, chunk, **kwargs):
+    # the steps print a message on every call, which is noise when calling them once per chunk
+    with contextlib.redirect_stdout(io.StringIO()):
+        return process(chunk, **kwargs)
+
+
+def _drop_empty_texts(chunk: pd.DataFrame) -> pd.DataFrame:
+    chunk[TEXT_COLUMN] = chunk[TEXT_COLUMN].str.strip()
+    return chunk[chunk[TEXT_COLUMN].str.len() != 0].copy()
+
+
+def _count_boundary_sentences(chunks, position: int, counts, n_sentences: list[int], count_frequencies):
+    """
+    First pass of remove_repeating_greetings (position 0) / remove_repeating_endings (position -1):
+    count n-gram document frequencies over all sentences and keep the first/last sentence of each speech
+    """
+    for chunk in chunks:
+        chunk = _drop_empty_texts(chunk)
+        sentence_list = get_sentence_lists(chunk, TEXT_COLUMN)
+        n_sentences[0] += count_frequencies(sentence_list[sentence_list.str.len() != 0].explode(), counts)
+        chunk[BOUNDARY_COLUMN] = sentence_list.apply(lambda lst: lst[position] if len(lst) else "")
+        yield chunk
+
+
+def _score_boundary_sentences(paths: list[str], tfidf) -> list[np.ndarray]:
+    """Second pass: mean TF-IDF score of the first/last sentence of each speech, one array per chunk"""
+    return [np.asarray(tfidf.transform(chunk[BOUNDARY_COLUMN]).mean(axis=1)).flatten()
+            for chunk in _read_spilled(paths, columns=[BOUNDARY_COLUMN], desc="Scoring sentences")]
+
+
+def _remove_boundary_sentences(chunks, position: int, chunk_scores: list[np.ndarray], cut_off: float):
+    """Third pass: remove the first/last sentence of speeches scoring below the cut-off"""
+    for chunk, sentence_scores in zip(chunks, chunk_scores):
+        remove_mask = sentence_scores <= cut_off
+        keep = slice(1, None) if position == 0 else slice(None, -1)
+        chunk = remove_sentences(chunk, remove_mask, get_sentence_lists(chunk, TEXT_COLUMN), keep, TEXT_COLUMN)
+        chunk = chunk.drop(columns=BOUNDARY_COLUMN)
+        yield chunk[chunk[TEXT_COLUMN].str.len() != 0]
+
+
+def _remove_repeating_sentences(paths: list[str], spill_dir: str, position: int, percentile: float, next_chunks=lambda chunks: chunks, backend: str = STREAMING_TFIDF_BACKEND):
+    # the exact backend counts every distinct n-gram, the hashed one a fixed number of buckets (see remove_repeating_sentences.py)
+    new_counts, count_frequencies, vectorizer_from_frequencies = TFIDF_BACKENDS[backend]
+    counts, n_sentences = new_counts(), [0]
+    paths = _spill(_count_boundary_sentences(_read_spilled(paths, desc="Counting n-grams"), position, counts, n_sentences, count_frequencies), spill_dir + "_counted")
+    print(f"Counted {np.count_nonzero(counts) if backend == 'hashed' else len(counts)} {'hash buckets of ' if backend == 'hashed' else ''}n-grams in {n_sentences[0]} sentences")
+
+    chunk_scores = _score_boundary_sentences(paths, vectorizer_from_frequencies(counts, n_sentences[0]))
+    del counts
+    scores = np.concatenate(chunk_scores)
+    cut_off = np.percentile(scores, percentile)
+    # ties at the cut-off can remove more than percentile %
+    print(f"Removing {100 * (scores <= cut_off).mean():.2f}% of {'first' if position == 0 else 'last'} sentences")
+    del scores
+
+    chunks = _remove_boundary_sentences(_read_spilled(paths, desc="Removing sentences"), position, chunk_scores, cut_off)
+    return next_chunks(chunks)
+
+
+def _row_local_steps(chunks, seen_texts: list[np.ndarray], comment_counts: Counter, removed: Counter):
+    """First pass over the input: row-local steps, duplicate removal and counting of bracketed comments"""
+    for chunk in chunks:
+        chunk = apply_schema(add_speech_ids(chunk))
+        for process in [remove_non_party_speeches, keep_relevant_legislation_years]:
+            n_before = len(chunk)
+            chunk = _quietly(process, chunk)
+            removed[process.__name__] += n_before - len(chunk)
+
+        # same as remove_duplicate_speeches, but remembering the texts of previous chunks by their hash (seen_texts[0], sorted)
+        text_hashes = pd.util.hash_pandas_object(chunk["text"], index=False).to_numpy()
+        seen = seen_texts[0]
+        is_duplicate = pd.Series(text_hashes).duplicated().to_numpy()
+        if len(seen):
+            is_duplicate |= seen[np.minimum(np.searchsorted(seen, text_hashes), len(seen) - 1)] == text_hashes
+        seen_texts[0] = np.union1d(seen, text_hashes)
+        removed["remove_duplicate_speeches"] += int(is_duplicate.sum())
+        chunk = chunk[~is_duplicate]
+        if len(chunk) == 0: 
+            continue
+
+        chunk = _quietly(add_party_orientation_year_agenda, chunk)
+        chunk = _quietly(rename_party_duplicates, chunk)
+        comment_counts.update(extract_commentary(chunk, text_column=TEXT_COLUMN).tolist())
+        yield chunk
+
+
+def _remove_commentary(chunks, comment_counts: pd.Series):
+    for chunk in chunks:
+        if chunk[TEXT_COLUMN].str.contains(r"[(\[]", regex=True).any():
+            chunk = _quietly(remove_commentary, chunk, text_column=TEXT_COLUMN, comment_counts=comment_counts)
+        yield segment_sentences(chunk, TEXT_COLUMN)
+
+
+def _assign_topics(chunks):
+    topic_model = load_topic_model()
+    if topic_model is None:
+        yield from chunks
+        return
+    lda_model, corpus_store = topic_model
+    if os.path.exists(PATH_CORPUS_IDS): 
+        # like assign_topics_by_id, but the cache is read once and the inferred topics are added to it once at the end
+        cache_path = topic_cache_path()
+        cached, inferred = load_topic_cache(cache_path), []
+        for chunk in chunks: 
+            # the speeches of different chunks are different (duplicates are removed in the first pass)
+            new = infer_uncached_topics(chunk[SPEECH_ID], lda_model, corpus_store, cached)
+            if new is not None: 
+                inferred.append(new)
+            yield join_topics(chunk, cached, new)
+        if inferred: 
+            save_topic_cache(pd.concat([cached, *inferred]), cache_path)
+        return
+    # the corpus is aligned with the rows of the final dataframe, so it can be consumed chunk by chunk
+    corpus_iter = iter(as_corpus(corpus_store))
+    for chunk in chunks:
+        yield assign_topics_(chunk, lda_model, N_TOPICS, list(itertools.islice(corpus_iter, len(chunk))))
+    assert next(corpus_iter, None) is None, "Number of rows and elements in the corpus do not match. Was the dataframe modified after LDA?"
+
+
+def preprocess_streaming(path_in: str, path_out: str, chunk_rows: int = 20000, path_migration: str | None = None, topic_id: int = 19, relevance_threshold: float = 0.25, spill_dir: str = PATH_STREAMING_SPILL, tfidf_backend: str = STREAMING_TFIDF_BACKEND):
+    """
+    Run all preprocessing steps of preprocess_data.main out-of-core, writing the result to path_out.
+    If path_migration is given (i.e. LDA is finished), also write the speeches about migration there.
+    With tfidf_backend "hashed" (the default), the memory for the n-gram document frequencies stays constant (see remove_repeating_sentences.py),
+    with "exact" the output is the same as the one of preprocess_data.main.
+    """
+    os.makedirs(spill_dir, exist_ok=True)
+    removed = Counter()
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+        seen_texts, comment_counts = [np.array([], dtype=np.uint64)], Counter()
+        paths = _spill(_row_local_steps(iter_chunks(path_in, chunk_rows), seen_texts, comment_counts, removed), os.path.join(tmp_dir, "row_local"))
+        del seen_texts
+        print(f"Found {sum(comment_counts.values())} bracketed comments")
+
+        comment_counts = pd.Series(comment_counts, dtype=int)
+        paths = _spill(_remove_commentary(_read_spilled(paths, desc="Removing commentary, splitting sentences"), comment_counts), os.path.join(tmp_dir, "commentary"))
+        del comment_counts
+
+        paths = _remove_repeating_sentences(paths, os.path.join(tmp_dir, "greetings"), position=0, percentile=GREETINGS_PERCENTILE, next_chunks=lambda chunks: _spill(chunks, os.path.join(tmp_dir, "greetings_removed")), backend=tfidf_backend)
+        chunks = _remove_repeating_sentences(paths, os.path.join(tmp_dir, "endings"), position=-1, percentile=ENDINGS_PERCENTILE, next_chunks=_assign_topics, backend=tfidf_backend)
+
+        writer, migration_writer, n_rows = None, None, 0
+        for chunk in chunks:
+            if path_migration is not None:
+                chunk["migration_prob"] = chunk[f"topic_{topic_id}"]
+
+            table = _to_table(chunk)
+            writer = writer or pq.ParquetWriter(path_out, table.schema)
+            writer.write_table(table)
+            n_rows += len(chunk)
+
+            if path_migration is not None:
+                chunk = chunk[chunk["migration_prob"] >= relevance_threshold]
+                table = _to_table(chunk.drop(columns=[f"topic_{i}" for i in range(N_TOPICS)]))
+                migration_writer = migration_writer or pq.ParquetWriter(path_migration, table.schema)
+                migration_writer.write_table(table)
+
+        for w in [writer, migration_writer]:
+            if w is not None:
+                w.close()
+
+    for name, n in removed.items():
+        print(f"{name}: removed {n} rows")
+    print(f"Done. Now have {n_rows} rows")
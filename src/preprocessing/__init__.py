@@ -2,7 +2,8 @@ from preprocessing.add_party_orientation_year_agenda import add_party_orientatio
 from preprocessing.remove_non_party_speeches import remove_non_party_speeches
 from preprocessing.rename_party_duplicates import rename_party_duplicates
 from preprocessing.remove_commentary import remove_commentary
-from preprocessing.remove_duplicate_speeches import remove_duplicate_speeches
-from preprocessing.remove_repeating_sentences import remove_repeating_greetings, remove_repeating_endings
+from preprocessing.remove_duplicate_speeches import remove_duplicate_speeches, find_near_duplicate_speeches, remove_near_duplicate_speeches, near_duplicate_report, NEAR_DUPLICATE_COLUMNS
+from preprocessing.segment_sentences import segment_sentences
+from preprocessing.remove_repeating_sentences import remove_repeating_greetings, remove_repeating_endings, sweep_repeating_sentences
 from preprocessing.keep_relevant_legislation_years import keep_relevant_legislation_years
-from preprocessing.assign_lda_topics import assign_topics, assign_topics_
\ No newline at end of file
+from preprocessing.assign_lda_topics import assign_topics, assign_topics_, assign_topics_by_id, topic_cache_path, load_topic_model, load_topic_cache, save_topic_cache, infer_uncached_topics, join_topics
\ No newline at end of file
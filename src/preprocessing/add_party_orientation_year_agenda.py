@@ -1,3 +1,21 @@
+import pandas as pd
+
+from src.pipeline import declare_step
+from src.schema import as_categorical, lookup, concat_categorical
+from src.constants import ORDER_BLOCK
+
+PARTY_BLOCKS = {
+    'GUE/NGL': 'left', 'The Left': 'left',
+    'Greens/EFA': 'green',
+    'PSE': 'social_democratic', 'S&D': 'social_democratic',
+    'PPE-DE': 'christian_conservative', 'PPE': 'christian_conservative',
+    'ELDR': 'liberal', 'ALDE': 'liberal', 'Renew': 'liberal',
+    **dict.fromkeys(['EFDD', 'EFD', 'ITS', 'ENF', 'ID', 'IND/DEM', 'ECR', 'UEN', 'EDD'], '(extreme)_right'),
+}
+
+
+# the blocks are assigned from the original party names, so this has to run before rename_party_duplicates
+@declare_step(reads=["date", "agenda", "party"], writes=["year", "agenda", "block"])
 def add_party_orientation_year_agenda(df): 
     """
     Create year and unique agenda identifier
@@ -18,23 +36,15 @@ def add_party_orientation_year_agenda(df):
                 - National conservative, eurosceptic, right and extreme right groups
     """
 
-    # add year and unique agenda identifier
-    df["year"] = df.apply(lambda s: int(s["date"][:4]), axis=1)
-    df["agenda"] = df["agenda"]+df["date"]
-
-    df['block'] = None 
-
-    # left
-    df.loc[df['party'].isin(['GUE/NGL','The Left']), 'block'] = 'left'
-    # green
-    df.loc[df['party'].isin(['Greens/EFA']), 'block'] = 'green'
-    # social democratic
-    df.loc[df['party'].isin(['PSE', 'S&D']), 'block'] = 'social_democratic'
-    # christian conservative
-    df.loc[df['party'].isin(['PPE-DE', 'PPE']), 'block'] = 'christian_conservative'
-    # liberal
-    df.loc[df['party'].isin(['ELDR','ALDE', 'Renew']), 'block'] = 'liberal'
-    # right populist
-    df.loc[df['party'].isin(['EFDD', 'EFD','ITS', 'ENF', 'ID', 'IND/DEM', 'ECR', 'UEN', 'EDD', 'ITS']), 'block'] = '(extreme)_right'
-    
-    return df
\ No newline at end of file
+    # add year and unique agenda identifier, computed once per distinct date / (agenda, date) pair
+    dates = as_categorical(df["date"])
+    codes = dates.cat.codes.to_numpy()
+    years = dates.cat.categories.str[:4].astype(int).to_numpy()[codes]
+    # a missing date has code -1, which would take the year of the last date
+    df["year"] = pd.arrays.IntegerArray(years, codes < 0) if (codes < 0).any() else years
+    df["agenda"] = concat_categorical(df["agenda"], dates)
+
+    # parties that are in none of the blocks get NaN
+    df['block'] = lookup(df['party'], PARTY_BLOCKS, categories=ORDER_BLOCK)
+
+    return df
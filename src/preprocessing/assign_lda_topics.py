@@ -1,51 +1,189 @@
 from tqdm import tqdm 
-from gensim import corpora
+import collections
+import itertools
 import json 
-from gensim.models import LdaMulticore
+import math
 import numpy as np 
 import pandas as pd 
 import os 
-from src.constants import N_TOPICS
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from src.constants import N_TOPICS, PATH_CORPUS_IDS, PATH_CORPUS_STORE, PATH_LDA_ARTIFACT, PATH_TOPIC_CACHE
+from src.lda.corpus_store import as_corpus, corpus_store_hash, get_corpus_store, subset
+from src.lda.lda_artifact import get_lda_artifact
+from src.lda.lda_artifact import inference as lda_inference
+from src import parallel
+from src.pipeline import declare_step
+from src.instrumentation import instrument
+from src.schema import SPEECH_ID
+from src.stage_cache import files_hash
 
 FINAL_MODEL_PATH = "data/lda/final_model/model.model"
 PATH_CORPUS = "data/lda/corpus_final.c"
+PATH_DICTIONARY = "data/lda/dictionary_final.d"
 
-def assign_topics_(df, lda_model, n_topics, corpus): 
-    def assign_topics(lda_model, corpus):
-        topics = []
-        for bow in tqdm(corpus, desc="Assigning most probable topic to each speech"):
-            docs_topics = lda_model.get_document_topics(bow, minimum_probability=0)
-            topics.append(docs_topics)
-        return topics
+# documents per call of the model's inference (and per task of the process pool)
+INFERENCE_CHUNK_SIZE = 2000
+# probabilities below are left out by get_document_topics (so they are 0 in the topic matrix)
+MIN_TOPIC_PROBABILITY = 1e-8
 
+# model of a worker process of infer_topics
+_worker_model = None
+
+
+def _init_worker(lda_model): 
+    global _worker_model
+    _worker_model = lda_model
+
+
+def _random_state(lda_model) -> np.random.RandomState: 
+    return lda_model["random_state"] if isinstance(lda_model, dict) else lda_model.random_state
+
+
+def _infer_chunk(random_state, chunk) -> np.ndarray: 
+    """Normalized topic distributions of the documents of chunk, as get_document_topics(bow, minimum_probability=0) gives them"""
+    # same initial gamma as the model would draw when inferring the documents one by one
+    _random_state(_worker_model).set_state(random_state)
+    if isinstance(_worker_model, dict): 
+        gamma = lda_inference(_worker_model, chunk)
+    else: 
+        gamma, _ = _worker_model.inference(chunk)
+    # cumsum adds up in order like the sum() of get_document_topics, so the values are exactly the same
+    topic_dist = gamma / np.cumsum(gamma, axis=1)[:, -1:]
+    topic_dist[topic_dist < MIN_TOPIC_PROBABILITY] = 0
+    return topic_dist
+
+
+def _chunks_with_random_states(lda_model, corpus, n_topics, chunk_size: int): 
+    # the initial gammas are drawn here in the order of the documents, so the workers do not depend on each other
+    corpus_iter = iter(corpus)
+    while chunk := list(itertools.islice(corpus_iter, chunk_size)): 
+        random_state = _random_state(lda_model).get_state()
+        _random_state(lda_model).gamma(100., 1. / 100., (len(chunk), n_topics))
+        yield random_state, chunk
+
+
+def infer_topics(lda_model, corpus, n_topics, chunk_size = INFERENCE_CHUNK_SIZE, n_workers = None) -> np.ndarray: 
+    """
+    float32 matrix (documents x topics) of the topic probabilities of the documents of corpus, with the same values as 
+    get_document_topics(bow, minimum_probability=0) for one document after the other, but inferred in chunks of 
+    chunk_size documents by a pool of n_workers processes (default: the number of workers of the cleaning steps).
+    lda_model: gensim LdaModel or LDA artifact (see src/lda/lda_artifact.py)
+    """
+    topic_matrix = np.zeros((len(corpus), n_topics), dtype=np.float32)
+    n_workers = min(parallel.N_WORKERS if n_workers is None else n_workers, math.ceil(len(corpus) / chunk_size))
+    chunks = _chunks_with_random_states(lda_model, corpus, n_topics, chunk_size)
+    progress = tqdm(total=len(corpus), desc="Assigning topic probabilities to each speech")
+    start = 0
+
+    def write(topic_dist): 
+        nonlocal start
+        topic_matrix[start:start + len(topic_dist)] = topic_dist
+        start += len(topic_dist)
+        progress.update(len(topic_dist))
+
+    if n_workers <= 1: 
+        _init_worker(lda_model)
+        for chunk in chunks: 
+            write(_infer_chunk(*chunk))
+        _init_worker(None)
+    else: 
+        with ProcessPoolExecutor(n_workers, mp_context=parallel.POOL_CONTEXT, initializer=_init_worker, initargs=(lda_model,)) as pool: 
+            # only a few chunks per worker are read from the corpus ahead of the inference
+            pending = collections.deque(pool.submit(_infer_chunk, *chunk) for chunk in itertools.islice(chunks, 2 * n_workers))
+            while pending: 
+                write(pending.popleft().result())
+                pending.extend(pool.submit(_infer_chunk, *chunk) for chunk in itertools.islice(chunks, 1))
+    progress.close()
+    return topic_matrix
+
+
+@instrument(name="lda_inference")
+def assign_topics_(df, lda_model, n_topics, corpus, n_workers = None): 
     assert len(df) == len(corpus), "Number of rows and elements in the corpus do not match. Was the dataframe modified after LDA?"
-    corpus_topics = assign_topics(lda_model, corpus)
-    # set up df with topic probabilities
-
-    # corpus topics is a list of lists of (topic_id, probability) tuples for each document in the corpus
-    # this list is turned into dataframe of size (num_docs, num_topics) with probabilities
-    num_docs = len(corpus_topics)
-    
-    topic_prob_matrix = np.zeros((num_docs, n_topics))
-    for doc_idx, doc_topics in enumerate(corpus_topics):
-        for topic_id, prob in doc_topics:
-            topic_prob_matrix[doc_idx, topic_id] = prob
-            
+    # matrix of size (num_docs, num_topics) with probabilities
+    topic_prob_matrix = infer_topics(lda_model, corpus, n_topics, n_workers=n_workers)
     topic_prob_df = pd.DataFrame(topic_prob_matrix, columns=[f"topic_{i}" for i in range(n_topics)], index=df.index)
 
     # append topic probabilities to df_party_members
     return pd.concat([df, topic_prob_df], axis=1)
 
-def assign_topics(df): 
-    # TODO: rerun LDA after data is cleaned and make sure preprocessed texts are now just aligned with the df
-
+def load_topic_model(): 
+    """Inference-only artifact of the final LDA model and its corpus store, or None if LDA was not run yet"""
     if not os.path.exists(FINAL_MODEL_PATH): 
         print("No LDA model found. Not assigning topics yet. Create LDA model with intermediate dataset and find topic threshold, then re-run preprocessing.")
-        return df 
+        return None 
 
-    lda_model = LdaMulticore.load(FINAL_MODEL_PATH)
+    # the artifact is exported once per model, loading it only maps its arrays
+    lda_model = get_lda_artifact(PATH_LDA_ARTIFACT, FINAL_MODEL_PATH)
+
+    # converted from the MmCorpus once, then documents are read by speech id from the memory-mapped arrays
+    corpus_store = get_corpus_store(PATH_CORPUS_STORE, PATH_CORPUS, PATH_CORPUS_IDS)
+    return lda_model, corpus_store
+
+def topic_cache_path(corpus_store_path: str = PATH_CORPUS_STORE) -> str: 
+    """Topic cache of the current final model and documents of the speeches (see assign_topics_by_id)"""
+    # the documents of a speech id change when the LDA corpus is created again (e.g. with another dictionary)
+    h = hashlib.sha256((files_hash([FINAL_MODEL_PATH]) + corpus_store_hash(corpus_store_path)).encode())
+    return os.path.join(PATH_TOPIC_CACHE, f"{h.hexdigest()[:16]}.parquet")
+
+
+def load_topic_cache(cache_path: str | None): 
+    """Cached topics (indexed by speech id), None if there are none"""
+    return pd.read_parquet(cache_path) if cache_path is not None and os.path.exists(cache_path) else None
+
+
+def save_topic_cache(cached, cache_path: str): 
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    cached.to_parquet(cache_path)
+
+
+def infer_uncached_topics(ids, lda_model, corpus_store, cached = None): 
+    """Topics (indexed by speech id) of the speech ids that are not in cached, None if all of them are"""
+    ids = ids.drop_duplicates()
+    missing = ids if cached is None else ids[~ids.isin(cached.index)]
+    if len(missing) == 0: 
+        return None
+    print(f"Inferring topics of {len(missing)} of {len(ids)} speeches, the others are cached")
+    documents = as_corpus(subset(corpus_store, missing))
+    return assign_topics_(pd.DataFrame(index=pd.Index(missing, name=SPEECH_ID)), lda_model, N_TOPICS, documents)
+
+
+def join_topics(df, *topic_frames): 
+    """df with the topics of its speeches looked up by speech id in the topic frames (the first frame with a speech wins)"""
+    ids = pd.Index(df[SPEECH_ID])
+    topics = pd.DataFrame(np.nan, index=ids, columns=[f"topic_{i}" for i in range(N_TOPICS)], dtype=np.float32)
+    for frame in reversed([frame for frame in topic_frames if frame is not None]): 
+        found = frame.reindex(ids)
+        topics = found.where(found.notna(), topics)
+    topics.index = df.index
+    return pd.concat([df, topics], axis=1)
+
+
+def assign_topics_by_id(df, lda_model, corpus_store, cache_path: str | None = None): 
+    """
+    Topics of the speeches in df with their documents in the corpus store joined by speech id. Topics of speeches
+    already in cache_path (keyed by speech id) are reused, only the other ones are inferred and added to it.
+    """
+    cached = load_topic_cache(cache_path)
+    inferred = infer_uncached_topics(df[SPEECH_ID], lda_model, corpus_store, cached)
+    if inferred is not None and cache_path is not None: 
+        save_topic_cache(pd.concat([cached, inferred]), cache_path)
+    return join_topics(df, cached, inferred)
+
+
+# only needs the rows (and their ids), which have to be in the LDA corpus
+@declare_step(reads=[SPEECH_ID], writes=[f"topic_{i}" for i in range(N_TOPICS)])
+def assign_topics(df): 
+    topic_model = load_topic_model()
+    if topic_model is None: 
+        return df 
+    lda_model, corpus_store = topic_model
 
-    # dictionary = corpora.Dictionary.load(PATH_DICTIONARY)
-    corpus = corpora.MmCorpus(PATH_CORPUS)
+    if SPEECH_ID in df.columns and os.path.exists(PATH_CORPUS_IDS): 
+        return assign_topics_by_id(df, lda_model, corpus_store, topic_cache_path())
+    # corpus without ids: the rows have to be exactly the ones the corpus was created from
+    return assign_topics_(df, lda_model, N_TOPICS, as_corpus(corpus_store))
 
-    return assign_topics_(df, lda_model, N_TOPICS, corpus)
\ No newline at end of file
+# topics change whenever the final model or its corpus is replaced, even if the input speeches did not (see src/stage_cache.py)
+assign_topics.depends_on = [FINAL_MODEL_PATH, PATH_CORPUS, PATH_CORPUS_IDS]
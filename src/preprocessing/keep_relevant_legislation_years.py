@@ -1,4 +1,7 @@
+from src.pipeline import declare_step
 
+
+@declare_step(reads=["period"], filters=True)
 def keep_relevant_legislation_years(df, keep_periods=[8, 9]): 
     print("Kept only speeches from legislation periods", keep_periods)
     return df[df["period"].isin(keep_periods)]
\ No newline at end of file
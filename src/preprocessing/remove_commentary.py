@@ -1,4 +1,30 @@
+import re
 import pandas as pd
+from collections import Counter
+from functools import partial
+
+from src.parallel import parallel_apply
+from src.pipeline import declare_step
+from src.instrumentation import instrument
+
+# only the bracket characters matter when looking for comments, the regex skips over all other characters at once
+BRACKET_PATTERN = re.compile(r"[()\[\]]")
+
+# rules of identify_removable_parts, in the order the comments used to be removed
+# speaker: lowercase comment contains "speaker" or "mep"
+# microphone: lowercase comment does not contain "speaker", but "microphone" or "mic"
+# the rules below only apply to comments without "speaker" that occur more than once in the corpus
+# short: at most two words
+# beginnings: more than two words, starts with one of REPEATING_BEGINNINGS
+# contained: more than two words, contains one of the CONTAINED_PATTERN (case-sensitive)
+RULES = ["speaker", "microphone", "short", "beginnings", "contained"]
+SPEAKER_PATTERN = re.compile("speaker|mep")
+MICROPHONE_PATTERN = re.compile("microphone|mic")
+CONTAINED_PATTERN = re.compile("applause|rule 1|speaking session")
+REPEATING_BEGINNINGS = ('parliament', 'the parliament', 'the sitting', 'the mep', 'the president',
+                        'end of', 'the oral amendment',
+                        'explanation of vote', 'article', 'rule')
+
 
 def extract_parentheses(text: str, parenthese_chars: str = "()") -> list[str]:
     # Returns every piece of text inside parenthesis, if we are dealing with nested parenthesis we won't consider inner substrings only outermost one.
@@ -16,46 +42,81 @@ def extract_parentheses(text: str, parenthese_chars: str = "()") -> list[str]:
     return result
 
 
+def find_commentary_spans(text: str) -> list[int]:
+    """
+    Positions [open_0, close_0, open_1, close_1, ...] of the outermost () and [] pairs in one scan of the text,
+    first all () then all [] pairs. Same pairs as extract_parentheses with "()" and "[]" (each type has its own stack).
+    """
+    stacks = {"(": [], "[": []}
+    closing = {")": "(", "]": "["}
+    spans = {"(": [], "[": []}
+    for match in BRACKET_PATTERN.finditer(text):
+        ch, idx = match.group(), match.start()
+        if ch in stacks:
+            stacks[ch].append(idx)
+        else:
+            stack = stacks[closing[ch]]
+            if stack:
+                start = stack.pop()
+                if not stack:
+                    spans[closing[ch]] += [start, idx]
+    return spans["("] + spans["["]
 
-def extract_commentary(df: pd.DataFrame, text_column: str = 'text') -> pd.Series:
-    inside_parenthesis = df[text_column].apply(lambda text: extract_parentheses(text))
-    inside_brackets = df[text_column].apply(lambda text: extract_parentheses(text, parenthese_chars="[]"))
-    combined = pd.concat([inside_parenthesis, inside_brackets])
-    combined = combined.explode()  # One comment may include several bracketed text so we need to flatten our entries
-    return combined[~combined.isna()]
-
-
-
-def identify_removable_parts(commentary) -> list[pd.Series]:
-    # Most straightforward, take all comments that include speaker
-    print("Found", len(commentary), "bracketed comments")
-    speaker_commentary = commentary[commentary.str.lower().str.contains('speaker|mep')]
 
-    # considering rest
-    non_speaker_commentary = commentary[~commentary.str.lower().str.contains('speaker')]
+def comments_from_spans(text: str, spans: list[int]) -> list[str]:
+    return [text[spans[i] + 1:spans[i + 1]] for i in range(0, len(spans), 2)]
 
-    microphone_commentary = non_speaker_commentary[(non_speaker_commentary.str.lower().str.contains('microphone|mic')) ]
 
-    # This is all the unique bracketed texts, based on my brief scan of these texts I haven't seen anything we can discard
-    leave_in = non_speaker_commentary.value_counts()[non_speaker_commentary.value_counts() == 1].index
-    non_speaker_commentary = non_speaker_commentary[~non_speaker_commentary.apply(lambda text: text in leave_in)]
+def extract_commentary(df: pd.DataFrame, text_column: str = 'text', n_workers: int | None = None) -> pd.Series:
+    spans = parallel_apply(find_commentary_spans, df[text_column], n_workers=n_workers)
+    combined = pd.Series([comments_from_spans(text, s) for text, s in zip(df[text_column], spans)], index=df.index, dtype=object)
+    combined = combined.explode()  # One comment may include several bracketed text so we need to flatten our entries
+    return combined[~combined.isna()]
 
-    # text inside the parenthesis which is part of the real debate is probably longer, I don't see any comments that might be important to infer the context
-    short_non_speaker_commentary = non_speaker_commentary[non_speaker_commentary.str.split().str.len() <= 2]
 
-    
-    long_non_speaker_commentary = non_speaker_commentary[non_speaker_commentary.str.split().str.len() > 2]
-    lowercase_longer_comments = non_speaker_commentary.str.lower()
-    contained_patterns = long_non_speaker_commentary[long_non_speaker_commentary.str.contains('applause|rule 1|speaking session')]
-    repeating_commentary_beginnings = long_non_speaker_commentary[long_non_speaker_commentary.str.startswith(('parliament', 'the parliament', 'the sitting', 'the mep', 'the president',
-                                                                                                     'end of', 'the oral amendment',
-                                                                                                     'explanation of vote', 'article', 'rule'))]
-    # There are still 2.9K unique comments left all of them are infrequent and also seemed relevant for the context
-    # I couldn't find any other patterns
-    n_residual = len(non_speaker_commentary) - len(microphone_commentary) - len(short_non_speaker_commentary) - len(contained_patterns) - len(repeating_commentary_beginnings)
-    print("Leaving",n_residual, "bracketed comments")
-    return [speaker_commentary, microphone_commentary, short_non_speaker_commentary, 
-             repeating_commentary_beginnings, contained_patterns]
+def classify_comment(comment: str, count: int) -> tuple[str, ...]:
+    """Rules (see RULES) that make a comment removable, count is its number of occurrences in the corpus"""
+    rules = []
+    lower = comment.lower()
+    if SPEAKER_PATTERN.search(lower):
+        rules.append("speaker")
+    if "speaker" in lower:
+        return tuple(rules)
+
+    if MICROPHONE_PATTERN.search(lower):
+        rules.append("microphone")
+    # comments that occur only once seemed relevant for the context, they are left in
+    if count == 1:
+        return tuple(rules)
+
+    # text inside the parenthesis which is part of the real debate is probably longer
+    if len(comment.split()) <= 2:
+        rules.append("short")
+    else:
+        if comment.startswith(REPEATING_BEGINNINGS):
+            rules.append("beginnings")
+        if CONTAINED_PATTERN.search(comment):
+            rules.append("contained")
+    return tuple(rules)
+
+
+def identify_removable_parts(comment_counts: Counter, corpus_counts: pd.Series | Counter | None = None) -> dict[str, tuple[str, ...]]:
+    """
+    Classify every distinct comment once. Returns the removable comments with the rules they match.
+    comment_counts: occurrences of each comment in the speeches to clean
+    corpus_counts: occurrences in the whole corpus, if the speeches are only a part of it (see src/preprocess_streaming.py)
+    """
+    if corpus_counts is None:
+        corpus_counts = comment_counts
+    elif isinstance(corpus_counts, pd.Series):
+        corpus_counts = corpus_counts.to_dict()
+    get_count = corpus_counts.get
+    removable = {}
+    for comment in comment_counts:
+        rules = classify_comment(comment, get_count(comment, 0))
+        if rules:
+            removable[comment] = rules
+    return removable
 
 
 def remove_from_text(original: str, strings_to_remove: list[str] ) -> str:
@@ -69,17 +130,58 @@ def remove_from_text(original: str, strings_to_remove: list[str] ) -> str:
     return original.strip()
 
 
-def remove_commentary(df: pd.DataFrame, text_column: str = "translatedText") -> pd.DataFrame:
-    commentary = extract_commentary(df, text_column=text_column)
-    commentary = pd.concat(identify_removable_parts(commentary))
-    
-    commentary.name = 'commentary'
-    commentary = commentary.groupby(commentary.index).agg(lambda comments: list(comments))
-
-    merged = pd.merge(df, commentary, left_index=True, right_index=True, how='left')
-    merged[text_column] = merged[[text_column, 'commentary']].apply(lambda row: remove_from_text(row['translatedText'], row['commentary']), axis=1)
-    return merged.drop('commentary', axis=1)
-
-
-
-    
\ No newline at end of file
+def remove_commentary_spans(text: str, spans: list[int], removable: dict[str, tuple[str, ...]]) -> str:
+    """
+    Cut the removable comments out of the text at their spans. Gives the same text as calling remove_from_text
+    with the removable comments in the order of RULES, which is done instead whenever splicing could differ from it:
+    comments containing brackets, overlapping () and [] spans, or other occurrences of a removed "(comment)" or "[comment]"
+    """
+    pairs = [(spans[i], spans[i + 1]) for i in range(0, len(spans), 2)]
+    removed = sorted((start, end) for start, end in pairs if text[start + 1:end] in removable)
+    if not removed:
+        return text
+
+    comments = {text[start + 1:end] for start, end in removed}
+    overlapping = any(removed[i][1] > removed[i + 1][0] for i in range(len(removed) - 1))
+    if not overlapping and not any(BRACKET_PATTERN.search(comment) for comment in comments):
+        pieces, position = [], 0
+        for start, end in removed:
+            pieces.append(text[position:start])
+            position = end + 1
+        pieces.append(text[position:])
+        spliced = "".join(pieces)
+        if not any(f"({comment})" in spliced or f"[{comment}]" in spliced for comment in comments):
+            return spliced.strip()
+
+    all_comments = comments_from_spans(text, spans)
+    return remove_from_text(text, [comment for rule in RULES for comment in all_comments if rule in removable.get(comment, ())])
+
+
+@instrument
+def strip_commentary(texts: pd.Series, comment_counts: pd.Series | Counter | None = None, n_workers: int | None = None) -> tuple[pd.Series, Counter]:
+    """
+    Remove the removable bracketed comments from texts, scanning every text once for its outermost () and [] pairs.
+    Returns the cleaned texts and the number of removed comments per rule (a comment can match several rules).
+    """
+    spans = parallel_apply(find_commentary_spans, texts, n_workers=n_workers)
+    counts = Counter(comment for text, s in zip(texts, spans) if s for comment in comments_from_spans(text, s))
+    removable = identify_removable_parts(counts, comment_counts)
+    n_removed = sum(counts[comment] for comment in removable)
+    print("Found", sum(counts.values()), "bracketed comments, leaving", sum(counts.values()) - n_removed)
+
+    hits = Counter({rule: 0 for rule in RULES})
+    for comment, rules in removable.items():
+        for rule in rules:
+            hits[rule] += counts[comment]
+
+    cleaned = parallel_apply(partial(remove_commentary_spans, removable=removable), texts, spans, n_workers=n_workers)
+    return cleaned, hits
+
+
+@declare_step(reads=["translatedText"], writes=["translatedText"])
+def remove_commentary(df: pd.DataFrame, text_column: str = "translatedText", comment_counts: pd.Series | None = None, n_workers: int | None = None) -> pd.DataFrame:
+    # n_workers: size of the process pool for the row-wise text processing, defaults to src.parallel.N_WORKERS
+    # comment_counts: occurrences of each comment in the whole corpus, if df is only a part of it (see src/preprocess_streaming.py)
+    df[text_column], hits = strip_commentary(df[text_column], comment_counts, n_workers=n_workers)
+    print("Removed bracketed comments per rule:", dict(hits))
+    return df
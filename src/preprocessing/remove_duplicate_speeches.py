@@ -1,9 +1,157 @@
+import functools
+import re
+import numpy as np
+import pandas as pd
+from functools import partial
+from datasketch import MinHash, MinHashLSH, LeanMinHash
+
+from src.parallel import parallel_apply
+from src.pipeline import declare_step
+from src.instrumentation import instrument
+from src.schema import SPEECH_ID
+
+# speeches are compared as sets of word n-grams of this length
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+# random seed of the MinHash permutations, has to be the same for all signatures that are compared
+MINHASH_SEED = 1
+# written by find_near_duplicate_speeches: speech id of the first speech of the cluster, estimated Jaccard similarity
+# to it and whether the speech is removed as its near-duplicate
+NEAR_DUPLICATE_CLUSTER = "near_duplicate_cluster"
+NEAR_DUPLICATE_JACCARD = "near_duplicate_jaccard"
+NEAR_DUPLICATE = "near_duplicate"
+NEAR_DUPLICATE_COLUMNS = [NEAR_DUPLICATE_CLUSTER, NEAR_DUPLICATE_JACCARD, NEAR_DUPLICATE]
+# metadata of the speeches in the report of the clusters
+REPORT_COLUMNS = ["date", "speaker", "party", "speechnumber", "written"]
+
+
+def shingles(text: str, k: int = SHINGLE_SIZE) -> set[bytes]:
+    """Word k-grams of the lowercased text, so differences in whitespace or case do not matter"""
+    if not isinstance(text, str):
+        return set()
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < k:
+        return {" ".join(words).encode()} if words else set()
+    return {" ".join(words[i:i + k]).encode() for i in range(len(words) - k + 1)}
+
+
+@functools.lru_cache
+def _permutations(num_perm: int):
+    # generating the permutations is the expensive part of creating a MinHash, so do it once per (worker) process
+    return MinHash(num_perm=num_perm, seed=MINHASH_SEED).permutations
+
+
+def minhash_signature(text: str, num_perm: int = NUM_PERM) -> list[int] | None:
+    text_shingles = shingles(text)
+    if not text_shingles:  # nothing to compare, e.g. missing text
+        return None
+    minhash = MinHash(num_perm=num_perm, seed=MINHASH_SEED, permutations=_permutations(num_perm))
+    minhash.update_batch(list(text_shingles))
+    return minhash.hashvalues.tolist()
+
+
+def _find(parent: np.ndarray, i: int) -> int:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+@instrument
+def find_near_duplicates(texts: pd.Series, threshold: float = 0.9, num_perm: int = NUM_PERM, n_workers: int | None = None) -> pd.DataFrame:
+    """
+    Clusters of speeches whose shingles have an (estimated) Jaccard similarity of at least threshold, without comparing all pairs:
+    the MinHash signatures (computed in a process pool) are put into an LSH index and only the candidates returned by the index
+    are compared. Clusters are the connected components of the similar pairs.
+    As the pairs chain, a speech can end up in the cluster of a first speech it is not similar to itself, so only the
+    speeches that are similar to the first speech of their cluster are its duplicates.
+
+    Returns one row per speech in a cluster with its position in texts, the cluster (= position of its first speech),
+    the estimated Jaccard similarity to that first speech and whether it is a duplicate of it.
+    """
+    signatures = parallel_apply(partial(minhash_signature, num_perm=num_perm), texts, n_workers=n_workers)
+    positions = np.array([i for i, signature in enumerate(signatures) if signature is not None], dtype=np.int64)
+    hashvalues = np.zeros((len(texts), num_perm), dtype=np.uint64)
+    if len(positions):
+        hashvalues[positions] = np.array(signatures.iloc[positions].tolist(), dtype=np.uint64)
+
+    lsh = MinHashLSH(threshold=threshold, num_perm=num_perm)
+    minhashes = {i: LeanMinHash(seed=MINHASH_SEED, hashvalues=hashvalues[i]) for i in positions}
+    with lsh.insertion_session() as session:
+        for i, minhash in minhashes.items():
+            session.insert(i, minhash, check_duplication=False)
+
+    parent = np.arange(len(texts))
+    for i, minhash in minhashes.items():
+        candidates = np.array([j for j in lsh.query(minhash) if j > i], dtype=np.int64)
+        if len(candidates) == 0:
+            continue
+        # the index also returns some pairs below the threshold, keep only the ones whose signatures agree often enough
+        similarity = (hashvalues[candidates] == hashvalues[i]).mean(axis=1)
+        for j in candidates[similarity >= threshold]:
+            root_i, root_j = _find(parent, i), _find(parent, j)
+            if root_i != root_j:
+                # the root is always the first speech of the cluster
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    clusters = np.array([_find(parent, i) for i in range(len(texts))], dtype=np.int64)
+    in_cluster = np.flatnonzero(np.bincount(clusters, minlength=len(texts))[clusters] > 1)
+    # same estimate as MinHash.jaccard of the two signatures
+    jaccard = (hashvalues[in_cluster] == hashvalues[clusters[in_cluster]]).mean(axis=1)
+    return pd.DataFrame({
+        "position": in_cluster,
+        "cluster": clusters[in_cluster],
+        "jaccard": jaccard,
+        "duplicate": (in_cluster != clusters[in_cluster]) & (jaccard >= threshold),
+    })
+
+
+@declare_step(reads=["text", SPEECH_ID], writes=NEAR_DUPLICATE_COLUMNS)
+def find_near_duplicate_speeches(df, threshold: float = 0.9, text_column: str = "text"):
+    """
+    Mark the speeches that are near-duplicates (e.g. re-submitted written speeches with whitespace or typo differences)
+    of an earlier speech, see find_near_duplicates. Speeches in no cluster have no cluster and Jaccard similarity,
+    the clusters are kept in the output (see near_duplicate_report) and removed by remove_near_duplicate_speeches
+    """
+    clusters = find_near_duplicates(df[text_column], threshold=threshold)
+    rows = df.index[clusters["position"]]
+    df[NEAR_DUPLICATE_CLUSTER] = pd.Series(df[SPEECH_ID].to_numpy()[clusters["cluster"]], index=rows, dtype=object)
+    df[NEAR_DUPLICATE_JACCARD] = pd.Series(clusters["jaccard"].to_numpy(), index=rows)
+    df[NEAR_DUPLICATE] = pd.Series(clusters["duplicate"].to_numpy(), index=rows).reindex(df.index, fill_value=False)
+    print(f"Found {df[NEAR_DUPLICATE].sum()} near-duplicate speeches in {clusters['cluster'].nunique()} clusters (Jaccard >= {threshold})")
+    return df
+
+
+@declare_step(reads=[NEAR_DUPLICATE], filters=True)
+def remove_near_duplicate_speeches(df):
+    """Remove the speeches find_near_duplicate_speeches marked as near-duplicates, the first speech of each cluster is kept"""
+    print("Removed near-duplicate speeches")
+    return df[~df[NEAR_DUPLICATE]]
+
+
+def near_duplicate_report(marked: pd.DataFrame, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row per speech in a cluster of near-duplicates: the cluster, whether the speech was kept, its Jaccard similarity
+    to the first speech of the cluster and its metadata from df.
+    marked: output of find_near_duplicate_speeches (e.g. from run_pipeline(outputs=...)), df: the speeches it ran on
+    """
+    marked = marked[marked[NEAR_DUPLICATE_CLUSTER].notna()]
+    report = df.loc[marked.index, [column for column in REPORT_COLUMNS if column in df.columns]]
+    report.insert(0, "cluster", marked[NEAR_DUPLICATE_CLUSTER])
+    report.insert(1, "kept", ~marked[NEAR_DUPLICATE])
+    report.insert(2, "jaccard", marked[NEAR_DUPLICATE_JACCARD])
+    return report
+
+
+@declare_step(reads=["text"], filters=True)
 def remove_duplicate_speeches(df):
     """
     Remove (row-wise) duplicate speeches if written, i.e. for each written speech track if duplicate
     and only keep the first occurrence
     Remove speeches of speakers without party
 
+    Near-duplicates are removed by find_near_duplicate_speeches and remove_near_duplicate_speeches.
+
     Information loss: drops ??? rows (~ ?? %) with (written) duplicate speech/text
     -> Leaves us with ??? remaining duplicate speeches (non-written)
     """
@@ -32,4 +180,4 @@ def remove_duplicate_speeches(df):
     # print(f"Number (& Percentage) of rows removed: {rows_removed_by_condition} ({'%.2f' % (rows_removed_by_condition / initial_rows_count)})")
 
 
-    # return df_filtered_by_written_duplicates
\ No newline at end of file
+    # return df_filtered_by_written_duplicates
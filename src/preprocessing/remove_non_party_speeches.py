@@ -1,4 +1,7 @@
+from src.pipeline import declare_step
 
+
+@declare_step(reads=["party"], filters=True)
 def remove_non_party_speeches(df): 
     """
     Remove speeches of speakers without party 
@@ -1,78 +1,251 @@
 import pandas as pd
 import numpy as np
+from collections import Counter
 
 
-import nltk
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer, HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import Pipeline, make_pipeline
 
+from preprocessing.segment_sentences import SENTENCE_OFFSETS_COLUMN, segment_sentences, get_sentence_lists, join_sentences
+from src.pipeline import declare_step
+from src.instrumentation import instrument
 
-def remove_repeating_greetings(df: pd.DataFrame, text_column: str = "translatedText", percentile: float = 6.2) -> pd.DataFrame:
-    df[text_column] = df[text_column].str.strip()
-    df = df[df[text_column].str.len() != 0]  # remove empty speeches
-
-    sentence_list = df[text_column].apply(lambda txt: nltk.sent_tokenize(txt))
-
-    print("Fitting TF-IDF vectorizer...")
-    vectorizer = TfidfVectorizer(
+# every sentence is one document for the TF-IDF scores
+TFIDF_PARAMS = dict(
     ngram_range=(1, 2),
     min_df=2,       
     max_df=0.99
-    )
+)
+# share (in %) of the first / last sentences with the lowest scores that are removed
+GREETINGS_PERCENTILE = 6.2
+ENDINGS_PERCENTILE = 4.2
+# number of hash buckets of the "hashed" backend, its memory does not grow with the number of distinct n-grams
+HASHED_N_FEATURES = 2 ** 21
+# sentences vectorized at once when accumulating the document frequencies of the "hashed" backend
+HASHED_CHUNK_SIZE = 100000
+
+
+def count_ngram_frequencies(sentences, counts: Counter) -> int: 
+    """
+    Add the document frequency of every n-gram in sentences to counts (in place) and return the number of sentences.
+    Lets the TF-IDF vectorizer be fitted on a corpus that is read in chunks, see vectorizer_from_frequencies.
+    """
+    sentences = list(sentences)
+    counter = CountVectorizer(ngram_range=TFIDF_PARAMS["ngram_range"], binary=True)
+    try: 
+        X = counter.fit_transform(sentences)
+    except ValueError: 
+        # chunk without any n-gram (e.g. only empty sentences)
+        return len(sentences)
+    counts.update(dict(zip(counter.get_feature_names_out(), np.asarray(X.sum(axis=0)).ravel().tolist())))
+    return len(sentences)
+
+
+def vectorizer_from_frequencies(counts: Counter, n_sentences: int) -> TfidfVectorizer: 
+    """Fitted TF-IDF vectorizer equivalent to fitting TfidfVectorizer(**TFIDF_PARAMS) on all counted sentences at once"""
+    min_count, max_count = TFIDF_PARAMS["min_df"], TFIDF_PARAMS["max_df"] * n_sentences
+    vocabulary = sorted(term for term, count in counts.items() if min_count <= count <= max_count)
+    document_frequencies = np.array([counts[term] for term in vocabulary], dtype=np.int64)
+
+    vectorizer = TfidfVectorizer(**TFIDF_PARAMS, vocabulary=vocabulary)
+    # same smoothed idf as sklearn computes when fitting
+    vectorizer.idf_ = np.log((n_sentences + 1) / (document_frequencies + 1)) + 1
+    return vectorizer
+
+
+def _hashing_vectorizer(n_features: int = HASHED_N_FEATURES) -> HashingVectorizer: 
+    # raw n-gram counts as TfidfVectorizer would see them, only with hashed instead of learned column indices
+    return HashingVectorizer(ngram_range=TFIDF_PARAMS["ngram_range"], n_features=n_features, alternate_sign=False, norm=None)
+
+
+def count_hashed_ngram_frequencies(sentences, counts: np.ndarray) -> int: 
+    """
+    Like count_ngram_frequencies, but adds the document frequencies of the hashed n-grams to a fixed size array,
+    so the memory for the counts stays constant however many distinct n-grams the corpus has.
+    """
+    sentences = list(sentences)
+    X = _hashing_vectorizer(len(counts)).transform(sentences)
+    X.sum_duplicates()
+    # every stored entry of a row is a different bucket => counting the column indices gives the document frequencies
+    counts += np.bincount(X.indices, minlength=len(counts))
+    return len(sentences)
+
+
+def hashed_vectorizer_from_frequencies(counts: np.ndarray, n_sentences: int) -> Pipeline: 
+    """
+    TF-IDF "vectorizer" on hashed n-grams with the min_df/max_df pruning and smoothed idf of TFIDF_PARAMS.
+    Pruned buckets get an idf of 0, which drops them from the (l2 normalized) vectors just like a missing vocabulary entry.
+    Colliding n-grams share a bucket, so the scores only approximate the ones of the exact vectorizer.
+    """
+    min_count, max_count = TFIDF_PARAMS["min_df"], TFIDF_PARAMS["max_df"] * n_sentences
+    keep = (counts >= min_count) & (counts <= max_count)
+
+    transformer = TfidfTransformer()
+    transformer.idf_ = np.where(keep, np.log((n_sentences + 1) / (counts + 1)) + 1, 0.0)
+    transformer.n_features_in_ = len(counts)
+    return make_pipeline(_hashing_vectorizer(len(counts)), transformer)
+
+
+def fit_hashed_vectorizer(sentences: pd.Series, n_features: int = HASHED_N_FEATURES, chunk_size: int = HASHED_CHUNK_SIZE) -> Pipeline: 
+    """Hashed TF-IDF vectorizer with the document frequencies accumulated over chunks of sentences"""
+    counts = np.zeros(n_features, dtype=np.int64)
+    n_sentences = 0
+    for start in range(0, len(sentences), chunk_size): 
+        n_sentences += count_hashed_ngram_frequencies(sentences.iloc[start:start + chunk_size], counts)
+    return hashed_vectorizer_from_frequencies(counts, n_sentences)
+
+
+# per backend: empty document frequency counts, function adding a chunk of sentences to them, and vectorizer from the counts
+TFIDF_BACKENDS = {
+    "exact": (Counter, count_ngram_frequencies, vectorizer_from_frequencies), 
+    "hashed": (lambda: np.zeros(HASHED_N_FEATURES, dtype=np.int64), count_hashed_ngram_frequencies, hashed_vectorizer_from_frequencies), 
+}
+
+
+def remove_sentences(df: pd.DataFrame, remove_mask: np.ndarray, sentence_list: pd.Series, keep: slice, text_column: str = "translatedText") -> pd.DataFrame: 
+    """Replace the text of the masked speeches by their sentences[keep] and update their sentence offsets accordingly"""
+    texts = df[text_column].to_numpy(dtype=object, copy=True)
+    offsets = df[SENTENCE_OFFSETS_COLUMN].to_numpy(dtype=object, copy=True)
+    for i in np.flatnonzero(remove_mask): 
+        texts[i], offsets[i] = join_sentences(sentence_list.iloc[i][keep])
+    df[text_column] = texts
+    df[SENTENCE_OFFSETS_COLUMN] = offsets
+    return df
 
-    tfidf = vectorizer.fit(sentence_list[sentence_list.str.len() != 0].explode())
 
+@instrument
+def fit_vectorizer(sentences: pd.Series, backend: str = "exact") -> TfidfVectorizer | Pipeline: 
+    """
+    TF-IDF vectorizer fitted on all sentences, each sentence being one document.
+    backend "exact" fits TfidfVectorizer(**TFIDF_PARAMS), "hashed" fit_hashed_vectorizer (constant memory, approximate).
+    """
+    if backend not in TFIDF_BACKENDS: 
+        raise ValueError(f"Unknown TF-IDF backend {backend}, expected one of {list(TFIDF_BACKENDS)}")
+    if backend == "hashed": 
+        return fit_hashed_vectorizer(sentences)
+    return TfidfVectorizer(**TFIDF_PARAMS).fit(sentences)
+
+
+@instrument
+def boundary_sentence_scores(sentence_list: pd.Series, position: int, vectorizer: TfidfVectorizer | Pipeline | None = None, backend: str = "exact") -> np.ndarray: 
+    """
+    Mean TF-IDF score of the first (position 0) / last (position -1) sentence of every speech.
+    The vectorizer is fitted once on all sentences (see fit_vectorizer), unless an already fitted one is passed.
+    Scores of the two backends are averaged over different numbers of columns, only their ranks are comparable.
+    """
+    if vectorizer is None: 
+        print(f"Fitting TF-IDF vectorizer ({backend})...")
+        vectorizer = fit_vectorizer(sentence_list[sentence_list.str.len() != 0].explode(), backend)
+
+    boundary_sentences = sentence_list.apply(lambda lst: lst[position] if len(lst) else "")
+    print(f"Extracted {len(boundary_sentences)} {'first' if position == 0 else 'last'} sentences")
+
+    return np.asarray(vectorizer.transform(boundary_sentences).mean(axis=1)).flatten()
+
+
+def score_percentiles(sorted_scores: np.ndarray, scores) -> np.ndarray: 
+    """Percentile of each score, i.e. the share of sorted_scores strictly below it, found by binary search"""
+    return np.searchsorted(sorted_scores, scores, side="left") / len(sorted_scores) * 100
+
+
+def percentile_sweep(scores: np.ndarray, percentiles: list[float], groups: pd.DataFrame | None = None) -> tuple[pd.DataFrame, pd.DataFrame]: 
+    """
+    Answer a list of candidate percentiles with one set of scores instead of fitting again for every percentile.
+
+    Returns the removal masks (one boolean column per percentile, rows aligned with groups) and the number
+    of removed sentences per percentile for every combination of the columns in groups (e.g. block and year).
+    """
+    sorted_scores = np.sort(scores)
+    # np.percentile interpolates between the same order statistics on the sorted array
+    cut_offs = np.percentile(sorted_scores, percentiles)
+    index = None if groups is None else groups.index
+    masks = pd.DataFrame(scores[:, None] <= cut_offs[None, :], columns=list(percentiles), index=index)
+
+    if groups is None: 
+        # number of scores <= cut-off, without touching the masks
+        counts = pd.DataFrame([np.searchsorted(sorted_scores, cut_offs, side="right")], columns=list(percentiles))
+    else: 
+        counts = masks.groupby([groups[column] for column in groups.columns], dropna=False, observed=True).sum()
+    return masks, counts
+
+
+def sweep_repeating_sentences(df: pd.DataFrame, percentiles: list[float], position: int = 0, text_column: str = "translatedText", group_columns: list[str] = ["block", "year"], backend: str = "exact") -> tuple[pd.DataFrame, pd.DataFrame]: 
+    """
+    Masks and counts (see percentile_sweep) of the first (position 0) / last (position -1) sentences that
+    remove_repeating_greetings / remove_repeating_endings would remove for each of the given percentiles.
+    """
+    df = df[df[text_column].str.strip().str.len() != 0]
+    if SENTENCE_OFFSETS_COLUMN not in df.columns: 
+        df = segment_sentences(df.copy(), text_column)
+
+    scores = boundary_sentence_scores(get_sentence_lists(df, text_column), position, backend=backend)
+    return percentile_sweep(scores, percentiles, df[group_columns])
+
+
+def repeating_sentences_cut_off(df: pd.DataFrame, position: int, percentile: float, text_column: str = "translatedText", backend: str = "exact") -> tuple[TfidfVectorizer | Pipeline, float]: 
+    """
+    Vectorizer fitted on the sentences of df and the score at or below which remove_repeating_greetings (position 0) /
+    remove_repeating_endings (position -1) remove the first / last sentence, e.g. to freeze them (see src/ingest_incremental.py)
+    """
+    df = df[df[text_column].str.strip().str.len() != 0]
+    if SENTENCE_OFFSETS_COLUMN not in df.columns: 
+        df = segment_sentences(df.copy(), text_column)
+    sentence_list = get_sentence_lists(df, text_column)
+    vectorizer = fit_vectorizer(sentence_list[sentence_list.str.len() != 0].explode(), backend)
+    return vectorizer, float(np.percentile(boundary_sentence_scores(sentence_list, position, vectorizer=vectorizer), percentile))
+
+
+# vectorizer, cut_off: frozen vectorizer and score cut-off (see repeating_sentences_cut_off) used instead of fitting them on df
+@declare_step(reads=["translatedText", SENTENCE_OFFSETS_COLUMN], writes=["translatedText", SENTENCE_OFFSETS_COLUMN], filters=True)
+def remove_repeating_greetings(df: pd.DataFrame, text_column: str = "translatedText", percentile: float = GREETINGS_PERCENTILE, backend: str = "exact", vectorizer: TfidfVectorizer | Pipeline | None = None, cut_off: float | None = None) -> pd.DataFrame:
+    df[text_column] = df[text_column].str.strip()
+    # copied, so the text and offsets of the remaining speeches can be replaced below
+    df = df[df[text_column].str.len() != 0].copy()  # remove empty speeches
 
-    first_sentences = sentence_list.apply(lambda lst: lst[0] if len(lst) else "")
-    print(f"Extracted {len(first_sentences)} first sentences")
+    if SENTENCE_OFFSETS_COLUMN not in df.columns: 
+        df = segment_sentences(df.copy(), text_column)
+    # sentences are sliced from the offsets computed once by segment_sentences instead of tokenizing again
+    sentence_list = get_sentence_lists(df, text_column)
 
-    X = tfidf.transform(first_sentences)
-    sentence_scores = np.asarray(X.mean(axis=1)).flatten()
-    cut_off = np.percentile(sentence_scores, percentile)
+    sentence_scores = boundary_sentence_scores(sentence_list, position=0, vectorizer=vectorizer, backend=backend)
+    if cut_off is None: 
+        cut_off = np.percentile(sentence_scores, percentile)
 
     remove_mask = sentence_scores <= cut_off
     
 
-    print(f"Removing {percentile:.2f}% of first sentences")
+    print(f"Removing {100 * remove_mask.mean():.2f}% of first sentences")
 
-    df.loc[remove_mask, text_column] = sentence_list[remove_mask].apply(lambda sentences: " ".join(sentences[1:]))
+    df = remove_sentences(df, remove_mask, sentence_list, slice(1, None), text_column)
     
     df = df[df[text_column].str.len() != 0]
 
     return df
 
 
-def remove_repeating_endings(df: pd.DataFrame, text_column: str = "translatedText", percentile: float = 4.2) -> pd.DataFrame:
+@declare_step(reads=["translatedText", SENTENCE_OFFSETS_COLUMN], writes=["translatedText", SENTENCE_OFFSETS_COLUMN], filters=True)
+def remove_repeating_endings(df: pd.DataFrame, text_column: str = "translatedText", percentile: float = ENDINGS_PERCENTILE, backend: str = "exact", vectorizer: TfidfVectorizer | Pipeline | None = None, cut_off: float | None = None) -> pd.DataFrame:
 
     df[text_column] = df[text_column].str.strip()
-    df = df[df[text_column].str.len() != 0]  # remove empty speeches
-
-    sentence_list = df[text_column].apply(lambda txt: nltk.sent_tokenize(txt))
-
-    print("Fitting TF-IDF vectorizer...")
-    vectorizer = TfidfVectorizer(
-    ngram_range=(1, 2),
-    min_df=2,       
-    max_df=0.99
-    )
-
+    # copied, so the text and offsets of the remaining speeches can be replaced below
+    df = df[df[text_column].str.len() != 0].copy()  # remove empty speeches
 
-    tfidf = vectorizer.fit(sentence_list[sentence_list.str.len() != 0].explode())
+    if SENTENCE_OFFSETS_COLUMN not in df.columns: 
+        df = segment_sentences(df.copy(), text_column)
+    # sentences are sliced from the offsets computed once by segment_sentences instead of tokenizing again
+    sentence_list = get_sentence_lists(df, text_column)
 
-
-    first_sentences = sentence_list.apply(lambda lst: lst[-1] if len(lst) else "")
-    print(f"Extracted {len(first_sentences)} last sentences")
-
-    X = tfidf.transform(first_sentences)
-    sentence_scores = np.asarray(X.mean(axis=1)).flatten()
-    cut_off = np.percentile(sentence_scores, percentile)
+    sentence_scores = boundary_sentence_scores(sentence_list, position=-1, vectorizer=vectorizer, backend=backend)
+    if cut_off is None: 
+        cut_off = np.percentile(sentence_scores, percentile)
 
     remove_mask = sentence_scores <= cut_off
     
 
-    print(f"Removing {percentile:.2f}% of last sentences")
+    print(f"Removing {100 * remove_mask.mean():.2f}% of last sentences")
 
-    df.loc[remove_mask, text_column] = sentence_list[remove_mask].apply(lambda sentences: " ".join(sentences[:-1]))
+    df = remove_sentences(df, remove_mask, sentence_list, slice(None, -1), text_column)
     
     df = df[df[text_column].str.len() != 0]
 
-    return df
\ No newline at end of file
+    return df
@@ -1,3 +1,8 @@
+from src.pipeline import declare_step
+from src.schema import lookup
+
+
+@declare_step(reads=["party"], writes=["party"])
 def rename_party_duplicates(df): 
     """
     Merge parties that changed over time
@@ -8,8 +13,6 @@ def rename_party_duplicates(df):
     URL: https://www.europarl.europa.eu/RegData/etudes/BRIE/2023/757568/EPRS_BRI(2023)757568_EN.pdf
     """
     
-    df['party_adj'] = None 
-
     pse_snd = ['PSE', 'S&D']
     ppe = ['PPE-DE', 'PPE']
     efd = ['EDD', 'IND/DEM', 'EFDD', 'EFD']
@@ -26,17 +29,16 @@ def rename_party_duplicates(df):
     ]
     assert df['party'].isin(valid_party_values).all(), f"Invalid party values: {df[~df['party'].isin(valid_party_values)]['party'].unique()}"
 
-    df.loc[df['party'].isin(pse_snd), 'party_adj'] = 'PSE/S&D' # PSE becomes S&D
-    df.loc[df['party'].isin(ppe), 'party_adj'] = 'PPE' # PPE-DE' becomes 'PPE'
-    df.loc[df['party'].isin(efd), 'party_adj'] = 'EDD/INDDEM/EFD' # 'EDD' becomes 'IND/DEM' becomes 'EFDD' becomes 'EFD'
-    df.loc[df['party'].isin(enf_id), 'party_adj'] = 'ENF/ID' # ENF becomes ID in 2019
-    df.loc[df['party'].isin(eldr_alde_renew), 'party_adj'] = 'ELDR/ALDE/Renew' # ELDR becomes ALDE becomes Renew
-    df.loc[df['party'].isin(ngl_theleft), 'party_adj'] = 'NGL/The Left' # GUE/NGL becomes The Left
-
-    # if it is none of the above, keep original party name
-    df.loc[df['party_adj'].isna(), 'party_adj'] = df.loc[df['party_adj'].isna(), 'party']
-
-    df.drop('party', axis=1, inplace=True)
-    df = df.rename(columns={'party_adj': 'party'})
+    renamed = {
+        **dict.fromkeys(pse_snd, 'PSE/S&D'), # PSE becomes S&D
+        **dict.fromkeys(ppe, 'PPE'), # PPE-DE' becomes 'PPE'
+        **dict.fromkeys(efd, 'EDD/INDDEM/EFD'), # 'EDD' becomes 'IND/DEM' becomes 'EFDD' becomes 'EFD'
+        **dict.fromkeys(enf_id, 'ENF/ID'), # ENF becomes ID in 2019
+        **dict.fromkeys(eldr_alde_renew, 'ELDR/ALDE/Renew'), # ELDR becomes ALDE becomes Renew
+        **dict.fromkeys(ngl_theleft, 'NGL/The Left'), # GUE/NGL becomes The Left
+        # if it is none of the above, keep original party name
+        **{party: party for party in others},
+    }
+    df['party'] = lookup(df['party'], renamed)
 
-    return df 
\ No newline at end of file
+    return df
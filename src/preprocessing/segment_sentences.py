@@ -0,0 +1,62 @@
+import functools
+import numpy as np
+import pandas as pd
+from nltk.tokenize.punkt import PunktTokenizer
+
+from src.parallel import parallel_apply
+from src.pipeline import declare_step
+from src.instrumentation import measure
+
+# sentence boundaries of each speech as flat int32 array [start_0, end_0, start_1, end_1, ...] of character offsets
+SENTENCE_OFFSETS_COLUMN = "sentence_offsets"
+
+
+@functools.lru_cache
+def _get_tokenizer(language: str = "english") -> PunktTokenizer:
+    # same tokenizer as nltk.sent_tokenize, loaded once per (worker) process
+    return PunktTokenizer(language)
+
+
+def sentence_offsets(text: str) -> list[int]:
+    """Flat start/end offsets of the sentences nltk.sent_tokenize(text) returns"""
+    return [offset for span in _get_tokenizer().span_tokenize(text) for offset in span]
+
+
+def sentences_from_offsets(text: str, offsets) -> list[str]:
+    return [text[offsets[i]:offsets[i + 1]] for i in range(0, len(offsets), 2)]
+
+
+def join_sentences(sentences: list[str]) -> tuple[str, np.ndarray]:
+    """Join sentences with a space (as the removal steps do) and return the text together with its sentence offsets"""
+    offsets = np.zeros(2 * len(sentences), dtype=np.int32)
+    start = 0
+    for i, sentence in enumerate(sentences):
+        offsets[2 * i], offsets[2 * i + 1] = start, start + len(sentence)
+        start += len(sentence) + 1
+    return " ".join(sentences), offsets
+
+
+@declare_step(reads=["translatedText"], writes=["translatedText", SENTENCE_OFFSETS_COLUMN])
+def segment_sentences(df: pd.DataFrame, text_column: str = "translatedText", n_workers: int | None = None) -> pd.DataFrame:
+    """
+    Split every speech into sentences once, so that the steps after it can slice sentences from the stored offsets
+    instead of tokenizing the speeches again. Tokenizes the stripped text in a process pool (see src/parallel.py).
+
+    Creates new column "sentence_offsets", which remove_repeating_greetings and remove_repeating_endings keep in sync with the text
+    """
+    df[text_column] = df[text_column].str.strip()
+    with measure("sentence_tokenize") as record: 
+        record["rows_in"] = len(df)
+        offsets = parallel_apply(sentence_offsets, df[text_column], n_workers=n_workers)
+    # filled element-wise, pandas would turn a list of equally long arrays into a 2d array
+    offsets_column = np.empty(len(offsets), dtype=object)
+    for i, o in enumerate(offsets): 
+        offsets_column[i] = np.asarray(o, dtype=np.int32)
+    df[SENTENCE_OFFSETS_COLUMN] = offsets_column
+    return df
+
+
+def get_sentence_lists(df: pd.DataFrame, text_column: str = "translatedText") -> pd.Series:
+    """Sentences of every speech, sliced from the offsets column created by segment_sentences"""
+    return pd.Series([sentences_from_offsets(text, offsets) for text, offsets in zip(df[text_column], df[SENTENCE_OFFSETS_COLUMN])],
+                     index=df.index, dtype=object)
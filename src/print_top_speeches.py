@@ -1,13 +1,20 @@
 import textwrap
-def print_top_speeches(df, topic_id, n_speeches=5):
+from src.lda.lda_artifact import show_topic
+
+
+def print_top_speeches(df, topic_id, n_speeches=5, lda_artifact=None, k_words=5):
     '''
     Print the n most probable speeches for a given topic id
+    (with the k most probable words of the topic if the artifact of the lda model is given, see src/lda/lda_artifact.py)
     '''
     # get topic distribution for each document
     prob_column = "topic_" + str(topic_id)
     top_speeches = df.sort_values(by=prob_column, ascending=False).head(n_speeches)['translatedText']
     
-    print(f"\nMost representative speeches for Topic {topic_id}:\n")
+    label = ""
+    if lda_artifact is not None:
+        label = " (" + ", ".join(word for word, prob in show_topic(lda_artifact, topic_id, k_words)) + ")"
+    print(f"\nMost representative speeches for Topic {topic_id}{label}:\n")
     for i, speech in enumerate(top_speeches):
         print(textwrap.fill(speech, width=80))
         print("\n" + "-"*80 + "\n")
\ No newline at end of file
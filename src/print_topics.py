@@ -1,7 +1,11 @@
+from src.lda.lda_artifact import show_topics
+
+
 def print_topics(model, n_topics=30, k_words=5):
     '''
-    print all n topics of the lda model 
+    print all n topics of the lda model (a gensim model or its artifact, see src/lda/lda_artifact.py)
     '''
-    for idx, topic in model.show_topics(formatted=False, num_topics=n_topics):
+    topics = show_topics(model, num_topics=n_topics) if isinstance(model, dict) else model.show_topics(formatted=False, num_topics=n_topics)
+    for idx, topic in topics:
         label = ", ".join([word for word, prob in topic[:k_words]])
         print(f"Topic {idx}: {label}")
\ No newline at end of file
@@ -6,6 +6,9 @@ from ipywidgets import Button, Output
 from IPython.display import display
 import textwrap
 
+from preprocessing.segment_sentences import SENTENCE_OFFSETS_COLUMN
+from preprocessing.remove_repeating_sentences import score_percentiles
+
 
 def rate_tfidf_threshold(df, score_range=(5,15), n_samples=100, min_df=2, max_df=0.99):
     """
@@ -26,13 +29,23 @@ def rate_tfidf_threshold(df, score_range=(5,15), n_samples=100, min_df=2, max_df
     print("Tokenizing sentences...")
     text_column = "translatedText"
     
+    # Use the sentence offsets of the preprocessed data (see preprocessing/segment_sentences.py) if available
+    if SENTENCE_OFFSETS_COLUMN in df.columns:
+        offsets_list = df[SENTENCE_OFFSETS_COLUMN]
+    else:
+        offsets_list = [None] * len(df)
+
     # Collect the first sentence from each document
     all_sentences_list = []
-    for idx, txt in enumerate(df[text_column]):
+    for txt, offsets in zip(df[text_column], offsets_list):
         # Skip empty or invalid entries
         if pd.notna(txt) and isinstance(txt, str) and len(txt.strip()) > 0:
-            # Split text into sentences using NLTK
-            sentences = nltk.sent_tokenize(txt)
+            if offsets is not None:
+                # Slice the first sentence instead of tokenizing the whole speech again
+                sentences = [txt[offsets[0]:offsets[1]]] if len(offsets) else []
+            else:
+                # Split text into sentences using NLTK
+                sentences = nltk.sent_tokenize(txt)
             # Extract only the first sentence if it exists and is non-empty
             if sentences and len(sentences[0].strip()) > 0:
                 all_sentences_list.append(sentences[0])
@@ -57,10 +70,11 @@ def rate_tfidf_threshold(df, score_range=(5,15), n_samples=100, min_df=2, max_df
     print("Calculating TF-IDF scores...")
     X = tfidf.transform(all_sentences_list)  # Transform sentences to TF-IDF vectors
     sentence_scores = np.asarray(X.mean(axis=1)).flatten()  # Average TF-IDF across all terms in each sentence
+    sorted_scores = np.sort(sentence_scores)  # Sorted once for all percentile lookups below
     
     # Step 4: Filter sentences by specified percentile range
     # Convert percentile range to actual score thresholds
-    min_score, max_score = np.percentile(sentence_scores, score_range[0]), np.percentile(sentence_scores, score_range[1])
+    min_score, max_score = np.percentile(sorted_scores, score_range)
     # Create boolean mask for sentences within the score range
     mask = (sentence_scores >= min_score) & (sentence_scores <= max_score)
     
@@ -79,7 +93,8 @@ def rate_tfidf_threshold(df, score_range=(5,15), n_samples=100, min_df=2, max_df
     sampled = candidates.sample(n=min(n_samples, len(candidates))).reset_index(drop=True)
     sampled['rating'] = None  # Placeholder for manual ratings
     # Calculate what percentile each sentence's score represents
-    sampled['percentile'] = sampled['score'].apply(lambda x: (sentence_scores < x).sum() / len(sentence_scores) * 100)
+    # (share of scores strictly below it, found by binary search on the sorted scores)
+    sampled['percentile'] = score_percentiles(sorted_scores, sampled['score'].to_numpy())
     
     # Step 6: Set up interactive rating interface
     ratings = []  # Store ratings as they're collected
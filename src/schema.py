@@ -0,0 +1,79 @@
+"""
+Typed schema of the speeches: columns with few distinct values (parties, blocks, agendas, dates) are stored as
+pandas categoricals (dictionary-encoded in parquet), so they take one small integer code per row, and values derived
+from them are computed once per distinct value and joined back by code (see lookup) instead of once per row.
+
+Note that groupby on categoricals has to be called with observed=True to leave out empty categories.
+
+Every speech is identified by SPEECH_ID (see speech_ids), which the stages use to join their results
+(translations, LDA corpus, topics, embeddings) instead of relying on the positions of the rows.
+"""
+
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+CATEGORICAL_COLUMNS = ["party", "date", "agenda", "block"]
+SPEECH_ID = "speech_id"
+
+
+def as_categorical(values: pd.Series) -> pd.Series:
+    return values if isinstance(values.dtype, pd.CategoricalDtype) else values.astype("category")
+
+
+def apply_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """Store the columns of CATEGORICAL_COLUMNS that df has as categoricals"""
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns:
+            df[column] = as_categorical(df[column])
+    return df
+
+
+def _from_codes(codes: np.ndarray, categories: pd.Index, like: pd.Series) -> pd.Series:
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=pd.CategoricalDtype(categories)), index=like.index, name=like.name)
+
+
+def lookup(values: pd.Series, table: dict, categories: list | None = None) -> pd.Series:
+    """
+    Categorical of table[value] for every value, evaluated once per distinct value (missing keys become NaN).
+    categories: categories of the result (e.g. to fix their order), defaults to the values of the table that occur
+    """
+    values = as_categorical(values)
+    mapped = values.cat.categories.map(table)
+    categories = pd.Index(mapped.dropna().unique() if categories is None else categories)
+    # the extra last code maps missing values (code -1) to missing
+    codes = np.append(categories.get_indexer(mapped), -1)
+    return _from_codes(codes[values.cat.codes.to_numpy()], categories, values)
+
+
+def concat_categorical(left: pd.Series, right: pd.Series) -> pd.Series:
+    """Categorical of the string concatenation left + right, built from the distinct pairs of values"""
+    left, right = as_categorical(left), as_categorical(right)
+    left_codes, right_codes = left.cat.codes.to_numpy(np.int64), right.cat.codes.to_numpy(np.int64)
+    valid = (left_codes >= 0) & (right_codes >= 0)
+    n_right = len(right.cat.categories)
+    pairs, inverse = np.unique(left_codes[valid] * n_right + right_codes[valid], return_inverse=True)
+    strings = left.cat.categories.astype(str)[pairs // n_right] + right.cat.categories.astype(str)[pairs % n_right]
+    # different pairs can give the same string (e.g. "a1" + "2" and "a" + "12")
+    codes, categories = pd.factorize(strings)
+    result = np.full(len(left), -1)
+    result[valid] = codes[inverse]
+    return _from_codes(result, categories, left)
+
+
+def speech_ids(df: pd.DataFrame) -> pd.Series:
+    """
+    Stable id of every speech from its session date, speech number and a hash of its original text, e.g. "2019-07-15_12_3f2a9c0d1e4b5a67".
+    Changes whenever the text changes, so results keyed by it are only reused for unchanged speeches.
+    """
+    digests = [hashlib.blake2b((text if isinstance(text, str) else "").encode(), digest_size=8).hexdigest() for text in df["text"]]
+    return pd.Series([f"{date}_{number}_{digest}" for date, number, digest in zip(df["date"].astype(str), df["speechnumber"], digests)],
+                     index=df.index, dtype=object, name=SPEECH_ID)
+
+
+def add_speech_ids(df: pd.DataFrame) -> pd.DataFrame:
+    """Add the SPEECH_ID column to speeches that were read from a file without it (created before the ids existed)"""
+    if SPEECH_ID not in df.columns:
+        df[SPEECH_ID] = speech_ids(df)
+    return df
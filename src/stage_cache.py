@@ -0,0 +1,211 @@
+import ast
+import glob
+import hashlib
+import importlib.util
+import inspect
+import functools
+import json
+import os
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+from src.constants import PATH_STAGE_CACHE
+
+# bump to invalidate every cached stage at once (e.g. after changing the cache format)
+# 2: steps store only the columns they write (see src/pipeline.py)
+CACHE_VERSION = 2
+# least recently used entries are removed once the cache grows beyond this size
+MAX_CACHE_BYTES = 20 * 1024 ** 3
+# root of the project: modules defined below it are part of the fingerprints of the steps importing them
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+# project modules that only run the steps and do not change their output
+RUNNER_MODULES = {"src/pipeline.py", "src/stage_cache.py", "src/instrumentation.py", "src/lazy_frame.py"}
+
+
+def hash_file(path: str, block_size: int = 1 << 20) -> str:
+    """Content hash of a file on disk, used as key of the (unparsed) pipeline input"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def companion_files(path: str) -> list[str]:
+    """
+    The file at path and the files next to it whose names start with its name: gensim stores large arrays of a model
+    in separate files next to it (e.g. model.model.expElogbeta.npy), MmCorpus its index (corpus.c.index)
+    """
+    return sorted(glob.glob(glob.escape(path) + "*"))
+
+
+def file_stamps(paths: list[str]) -> dict:
+    """Size and modification time of the files at paths and their companion files, a cheap stand-in for hashing large files"""
+    return {file: [os.stat(file).st_size, os.stat(file).st_mtime_ns] for path in paths for file in companion_files(path)}
+
+
+def files_hash(paths: list[str]) -> str:
+    """Content hash of the files at paths and their companion files"""
+    return hashlib.sha256("".join(hash_file(file) for path in paths for file in companion_files(path)).encode()).hexdigest()
+
+
+def begin_marked_write(path: str, marker: str):
+    """
+    Start (re)writing the files of directory path, end_marked_write completes it by writing the marker file last.
+    The marker is removed first, so a directory without it was not written completely (see has_marker)
+    """
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, marker)):
+        os.remove(os.path.join(path, marker))
+
+
+def end_marked_write(path: str, marker: str, content, indent: int | None = None):
+    """Write content as JSON to the marker file of directory path, after all its other files"""
+    with open(os.path.join(path, marker + ".tmp"), "w") as f:
+        json.dump(content, f, indent=indent)
+    os.replace(os.path.join(path, marker + ".tmp"), os.path.join(path, marker))
+
+
+def has_marker(path: str, marker: str) -> bool:
+    return os.path.exists(os.path.join(path, marker))
+
+
+def read_marker(path: str, marker: str):
+    with open(os.path.join(path, marker)) as f:
+        return json.load(f)
+
+
+def _project_file(module) -> str | None:
+    # path of the module's file relative to the project root, None for modules outside of it (e.g. pandas)
+    path = getattr(module, "__file__", None)
+    if path is None:
+        return None
+    path = Path(path).resolve()
+    # packages installed into a virtual environment inside the project are not part of it
+    if not path.is_relative_to(PROJECT_ROOT) or "site-packages" in path.parts:
+        return None
+    return path.relative_to(PROJECT_ROOT).as_posix()
+
+
+def project_modules(module) -> dict:
+    """The module and all project modules it (transitively) imports, by their path relative to the project root"""
+    modules, stack = {}, [module]
+    while stack:
+        module = stack.pop()
+        path = _project_file(module)
+        if path is None or path in modules or path in RUNNER_MODULES:
+            continue
+        modules[path] = module
+        stack.extend(sys.modules[name] for name in _imported_names(module) if name in sys.modules)
+    return modules
+
+
+def _imported_names(module) -> list[str]:
+    # names of the modules of the import statements of the module, for "from a import b" both a and a.b (b may be a module)
+    names = []
+    for node in ast.walk(ast.parse(_module_source(module))):
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = importlib.util.resolve_name("." * node.level + (node.module or ""), module.__package__) if node.level else node.module
+            names.append(base)
+            names.extend(f"{base}.{alias.name}" for alias in node.names)
+    return names
+
+
+def _module_source(module) -> str:
+    try:
+        return inspect.getsource(module)
+    except (OSError, TypeError):
+        return ""
+
+
+def step_fingerprint(process) -> str:
+    """
+    Hash of everything that determines the output of a step apart from its input frame:
+    - the source of the module defining the step and of all project modules it imports (so edits to helper functions
+      invalidate the cache, too, also in other modules)
+    - arguments bound with functools.partial and the defaults of the step's signature
+    - files the step declares to depend on via a `depends_on` attribute (e.g. the LDA model)
+    """
+    bound_args, bound_kwargs = (), {}
+    func = process
+    while isinstance(func, functools.partial):
+        bound_args = func.args + bound_args
+        bound_kwargs = {**func.keywords, **bound_kwargs}
+        func = func.func
+
+    modules = project_modules(sys.modules[func.__module__])
+    source = [(path, _module_source(module)) for path, module in sorted(modules.items())] or inspect.getsource(func)
+
+    defaults = {
+        name: param.default for name, param in inspect.signature(func).parameters.items()
+        if param.default is not inspect.Parameter.empty
+    }
+    depends_on = file_stamps(getattr(func, "depends_on", []))
+
+    h = hashlib.sha256()
+    for part in [CACHE_VERSION, func.__qualname__, source, bound_args, sorted(bound_kwargs.items()), sorted(defaults.items()), depends_on]:
+        h.update(repr(part).encode())
+    return h.hexdigest()
+
+
+def _cache_path(key: str, cache_dir: str = PATH_STAGE_CACHE) -> str:
+    return os.path.join(cache_dir, f"{key}.parquet")
+
+
+def has_cached_step(key: str, cache_dir: str = PATH_STAGE_CACHE) -> bool:
+    return os.path.exists(_cache_path(key, cache_dir))
+
+
+def load_cached_step(key: str, cache_dir: str = PATH_STAGE_CACHE) -> pd.DataFrame:
+    path = _cache_path(key, cache_dir)
+    # the modification time marks the last use, see prune_cache
+    os.utime(path)
+    return pd.read_parquet(path)
+
+
+def save_cached_step(key: str, df: pd.DataFrame, cache_dir: str = PATH_STAGE_CACHE, max_bytes: int = MAX_CACHE_BYTES) -> str:
+    """Cache the output of a step under key, returns its content hash (see cached_step_hash)"""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(key, cache_dir)
+    # write to a temporary file first so an interrupted run never leaves a truncated cache entry behind
+    df.to_parquet(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    output_hash = hash_file(path)
+    with open(path + ".sha256.tmp", "w") as f:
+        f.write(output_hash)
+    os.replace(path + ".sha256.tmp", path + ".sha256")
+    prune_cache(cache_dir, max_bytes)
+    return output_hash
+
+
+def cached_step_hash(key: str, cache_dir: str = PATH_STAGE_CACHE) -> str:
+    """Content hash of the cached output of a step, the steps reading the output are keyed by it"""
+    path = _cache_path(key, cache_dir)
+    if os.path.exists(path + ".sha256"):
+        with open(path + ".sha256") as f:
+            return f.read()
+    return hash_file(path)
+
+
+def prune_cache(cache_dir: str = PATH_STAGE_CACHE, max_bytes: int = MAX_CACHE_BYTES) -> int:
+    """Remove the least recently used entries until the cache takes at most max_bytes, returns the number of removed entries"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".parquet"):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime_ns, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        for path in [os.path.join(cache_dir, name), os.path.join(cache_dir, name + ".sha256")]:
+            if os.path.exists(path):
+                os.remove(path)
+        total -= size
+        removed += 1
+    return removed
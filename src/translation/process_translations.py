@@ -1,5 +1,6 @@
 # %%
 import json 
+import numpy as np 
 import pandas as pd 
 from google import genai 
 import os 
@@ -11,7 +12,9 @@ from pathlib import Path
 
 # assume script is run from project root => path to be able to import src
 sys.path.append(str(Path.cwd()))
-from src.constants import PATH_RAW_DATA, PATH_TRANSLATED_DATA, PATH_DF_TRANSLATION_TEST
+from src.constants import PATH_TRANSLATED_DATA, PATH_DF_TRANSLATION_TEST
+from src.ingest_raw_data import read_raw_data
+from src.schema import SPEECH_ID
 
 def load_job(job_file_path, results_path): 
     """Assumes the job_name is saved in JOB_FILE_PATH. Downloads Gemini's responses if job is done and saves them in a RESULTS_PATH jsonl file"""
@@ -71,34 +74,53 @@ def process_responses(results_path):
             translations[id] = response_text
     return (translations, total_tokens)
 
+def _request_positions(df, ids) -> list[int]: 
+    """
+    Rows of df the requests with the given ids belong to. Requests are keyed by speech id, older ones by
+    r_{index}_{date}_{speechnumber} (index: position in the raw CSV)
+    """
+    speech_positions = pd.Series(np.arange(len(df)), index=df[SPEECH_ID])
+    speech_positions = speech_positions[~speech_positions.index.duplicated()]
+    positions = []
+    for id in ids: 
+        if id.startswith("r_"): 
+            assert len(id.split("_")) == 4
+            r, index, date, speechnum = id.split("_")
+            index = int(index)
+            # sanity checks to be absolutely sure the mapping of original speech => translation is correct
+            assert df.iloc[index]["date"] == date
+            assert df.iloc[index]["speechnumber"] == int(speechnum)
+            positions.append(index)
+        else: 
+            # a missing id means the speech changed since the request was sent
+            positions.append(speech_positions.get(id, -1))
+    return positions
+
+
 def add_translations_to_df(df, translations, is_test=False): 
     """After mapping the responsed to their ids, add the results to the dataframe"""
-    for id in translations: 
-        assert len(id.split("_")) == 4
-        r, index, date, speechnum = id.split("_")
-        
-        col_text = "translatedText" if not is_test else "translationTest"
-        col_source = "translationSource" if not is_test else "translationTestSource"
-
-        index = int(index)
-        speechnum = int(speechnum)
-        # sanity checks to be absolutely sure the mapping of original speech => translation is correct
-        assert df.iloc[index]["date"] == date
-        assert df.iloc[index]["speechnumber"] == speechnum
+    col_text = "translatedText" if not is_test else "translationTest"
+    col_source = "translationSource" if not is_test else "translationTestSource"
+    text_column, source_column = df.columns.get_loc(col_text), df.columns.get_loc(col_source)
+
+    for id, index in zip(translations, _request_positions(df, translations)): 
+        if index < 0: 
+            print("Speech of request changed or is missing, skipping", id)
+            continue
         
         if "no translation needed" == translations[id]: 
             # text was in English already, copy it to translatedText
-            df.at[index, col_text] = df.iloc[index]["text"]
+            df.iat[index, text_column] = df.iloc[index]["text"]
             # keep track that Gemini assumed the text was in English 
-            df.at[index, col_source] = "original_gm"
+            df.iat[index, source_column] = "original_gm"
         else: 
             if "no translation needed" in translations[id]: 
                 # sanity check that if no translation is needed model really only has returned "no translation needed" without anything else.
                 print("Warning: gemini response contained no translation sentence but also something else")
                 print(translations[id])
                 
-            df.at[index, col_text] = translations[id]
-            df.at[index, col_source] = "machine_gm"
+            df.iat[index, text_column] = translations[id]
+            df.iat[index, source_column] = "machine_gm"
 
 
 if __name__ == "__main__": 
@@ -114,8 +136,8 @@ if __name__ == "__main__":
     
     #%%
     print("Reading data")
-    df = pd.read_csv(PATH_RAW_DATA)
-    df = df.reset_index()
+    # indexed by the position in the raw CSV, as used in the ids of the requests
+    df = read_raw_data()
     # %%
     # create new column translationSource
     df["translationSource"] = None 
@@ -176,6 +198,5 @@ if __name__ == "__main__":
 
     # %%
     df.drop("translationInSpeech", axis=1, inplace=True)
-    df.drop("index", axis=1, inplace=True)
     df.to_parquet(path_out, index=False)
     print("Written data to", path_out)
\ No newline at end of file
@@ -1,5 +1,4 @@
 #%% 
-import pandas as pd
 import json
 from google import genai
 import os 
@@ -14,7 +13,8 @@ from pathlib import Path
 # assume script is run from project root => path to be able to import src
 sys.path.append(str(Path.cwd()))
 
-from src.constants import PATH_RAW_DATA
+from src.ingest_raw_data import read_raw_data
+from src.schema import SPEECH_ID
 
 # %% 
 GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
@@ -47,8 +47,8 @@ def process_rows(df_missing, FILENAME, FROM_ROWS, TO_ROWS, c=True):
         """Create a jsonl file where each line is a request to the Gemini API""" 
         requests = [] 
         for _, row in df.iterrows():
-            # as a key for the request, keep the index (row.name) but also for sanity check date and speechnumber
-            key = f"r_{row.name}_{row['date']}_{row['speechnumber']}" 
+            # the speech id is the key of the request, so the translation can only be joined to the same (unchanged) speech
+            key = row[SPEECH_ID]
             speech = row["text"]
             request = {
                 "id": key, 
@@ -158,9 +158,8 @@ if __name__ == "__main__":
     os.makedirs("data/translation/results", exist_ok=True)
     #%%
     print("Reading data")
-    df = pd.read_csv(PATH_RAW_DATA)
-    # keep track of original indices: 
-    df = df.reset_index()
+    # indexed by the position in the raw CSV, which identifies the speeches in the requests
+    df = read_raw_data(columns=["text", "party", "date", "speechnumber", "translatedText", SPEECH_ID])
 
 
     # only translate speeches where speaker is member of a party because only these we need for our project